@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Mesures de détourage.py (hors Streamlit)
+
+    python detourage_bench.py photo1.jpg photo2.jpg --modele u2net --cotes 768,1024,1536 --out bench_detourage.jsonl
+    python detourage_bench.py --retouche 12,40
+
+Détourage : référence = chemin pleine résolution (rembg sur l'image entière). Pour chaque mode réduit on mesure la
+latence et l'écart du masque alpha à la référence : MAE sur toute l'image, MAE sur la bande de bord, IoU (alpha >= 128).
+Retouche (sans modèle, images synthétiques de N mégapixels) : ancien calcul du bouton « Appliquer la retouche »
+contre MoteurRetouche ; temps, pic mémoire numpy (tracemalloc) et nombre d'images PIL créées par application.
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageOps
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test")) # cfm_spans, importé par detourage_core
+from detourage_core import SessionsRembg, MoteurRetouche, masques_canevas, detourer, detourer_reduit, MODELES, MODELE_DEFAUT
+
+
+def _chrono(fn, *args, repeat=1):
+    meilleur, out = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        dt = time.perf_counter() - t0
+        meilleur = dt if meilleur is None else min(meilleur, dt)
+    return meilleur, out
+
+
+def ecarts_alpha(alpha, alpha_ref):
+    """MAE (0-255) globale et sur les bords de la référence, IoU des masques binarisés."""
+    alpha = alpha.astype(np.int16)
+    alpha_ref = alpha_ref.astype(np.int16)
+    bord = ((alpha_ref > 0) & (alpha_ref < 255)).astype(np.uint8) * 255
+    bord = np.asarray(Image.fromarray(bord).filter(ImageFilter.MaxFilter(9))) > 0
+    err = np.abs(alpha - alpha_ref)
+    a, b = alpha >= 128, alpha_ref >= 128
+    union = (a | b).sum()
+    return {
+        "mae": round(float(err.mean()), 3),
+        "mae_bord": round(float(err[bord].mean()), 3) if bord.any() else 0.0,
+        "iou": round(float((a & b).sum() / union), 5) if union else 1.0,
+    }
+
+
+def comparer(chemin, session, cotes, repeat=1):
+    """Toutes les mesures pour une image -> liste d'enregistrements (un par mode / côté)."""
+    with open(chemin, "rb") as f:
+        image_bytes = f.read()
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes))).convert("RGBA")
+    base = {"image": chemin, "largeur": image.width, "hauteur": image.height}
+
+    t_ref, out = _chrono(detourer, image_bytes, session, repeat=repeat)
+    alpha_ref = np.asarray(Image.open(io.BytesIO(out)).getchannel("A"))
+    resultats = [{**base, "mode": "pleine", "cote": max(image.size), "secondes": round(t_ref, 4)}]
+    for cote in cotes:
+        for raffinement in ("bilineaire", "guide"):
+            dt, out = _chrono(detourer_reduit, image, session, cote, raffinement, repeat=repeat)
+            resultats.append({
+                **base, "mode": raffinement, "cote": cote, "secondes": round(dt, 4),
+                "acceleration": round(t_ref / dt, 2), **ecarts_alpha(np.asarray(out.getchannel("A")), alpha_ref),
+            })
+    return resultats
+
+
+# =========================
+# Retouche
+# =========================
+
+def retouche_ancienne(image_data, processed_image, original_image):
+    """Calcul d'origine du bouton « Appliquer la retouche » (restaurer seulement)."""
+    mask_drawing_np_resized = image_data[:, :, 3] > 0
+    mask_restore_np_resized = (mask_drawing_np_resized * 255).astype('uint8')
+    mask_restore_pil = Image.fromarray(mask_restore_np_resized, 'L')
+    original_size = processed_image.size
+    mask_restore_pil_original_size = mask_restore_pil.resize(original_size, Image.Resampling.NEAREST)
+    mask_restore_np = np.array(mask_restore_pil_original_size)
+    alpha_rembg_np = np.array(processed_image.split()[3])
+    final_alpha_np = np.maximum(alpha_rembg_np, mask_restore_np)
+    final_image = original_image.copy()
+    final_image.putalpha(Image.fromarray(final_alpha_np, 'L'))
+    return final_image
+
+
+def images_retouche(megapixels, largeur_canevas=700, seed=0):
+    """Originale / détourée synthétiques (4:3) et un canevas avec quelques traits rouges."""
+    rng = np.random.default_rng(seed)
+    W = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    H = int(W * 3 / 4)
+    originale = Image.fromarray(rng.integers(0, 256, (H, W, 3), dtype=np.uint8), "RGB").convert("RGBA")
+    detouree = originale.copy()
+    detouree.putalpha(Image.fromarray(rng.integers(0, 256, (H, W), dtype=np.uint8), "L"))
+    h = int(H * largeur_canevas / W)
+    canevas = Image.new("RGBA", (largeur_canevas, h))
+    dessin = ImageDraw.Draw(canevas)
+    for _ in range(8):
+        points = [tuple(int(v) for v in rng.integers(0, (largeur_canevas, h))) for _ in range(6)]
+        dessin.line(points, fill=(255, 0, 0, 178), width=20)
+    return originale, detouree, np.asarray(canevas)
+
+
+def _mesurer(fn, repeat):
+    stats0 = Image.core.get_stats()["new_count"]
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = fn()
+    premier = time.perf_counter() - t0
+    pic = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    images_pil = Image.core.get_stats()["new_count"] - stats0
+    secondes, _ = _chrono(fn, repeat=repeat)
+    return out, {"secondes": round(secondes, 4), "premier": round(premier, 4), "pic_numpy_mo": round(pic / 2**20, 1), "images_pil": images_pil}
+
+
+def comparer_retouche(megapixels, repeat=3):
+    """Ancien calcul contre MoteurRetouche.appliquer (moteur créé une fois, comme dans l'application)."""
+    originale, detouree, image_data = images_retouche(megapixels)
+    ancienne, r_ancienne = _mesurer(lambda: retouche_ancienne(image_data, detouree, originale), repeat)
+    moteur, r_init = _mesurer(lambda: MoteurRetouche(detouree, originale), 1)
+    nouvelle, r_moteur = _mesurer(lambda: moteur.appliquer(*masques_canevas(image_data)), repeat)
+    return {
+        "megapixels": megapixels, "largeur": originale.width, "hauteur": originale.height,
+        "ancienne": r_ancienne, "moteur_creation": r_init, "moteur_application": r_moteur,
+        "identique": bool(np.array_equal(np.asarray(ancienne), np.asarray(nouvelle))),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Qualité / latence : détourage réduit + agrandissement du masque contre pleine résolution.")
+    parser.add_argument("images", nargs="*")
+    parser.add_argument("--retouche", help="mégapixels des images synthétiques pour la mesure de la retouche (ex: 12,40)")
+    parser.add_argument("--modele", choices=list(MODELES), default=MODELE_DEFAUT)
+    parser.add_argument("--cotes", default="768,1024,1536", help="plus grands côtés envoyés au modèle")
+    parser.add_argument("--repeat", type=int, default=1, help="mesures par cas, la meilleure est gardée")
+    parser.add_argument("--out", help="ajoute les résultats (JSON, une ligne par cas) à ce fichier")
+    args = parser.parse_args(argv)
+    if not args.images and not args.retouche:
+        parser.error("donner des images et/ou --retouche")
+
+    for megapixels in [float(m) for m in args.retouche.split(",")] if args.retouche else []:
+        r = comparer_retouche(megapixels, args.repeat)
+        print(f"retouche {r['largeur']}x{r['hauteur']} ({megapixels:g} MP) - résultats identiques : {r['identique']}")
+        for nom in ("ancienne", "moteur_creation", "moteur_application"):
+            m = r[nom]
+            print(f"  {nom:<20}{m['secondes']:>8.3f} s  pic numpy {m['pic_numpy_mo']:>7} Mo  images PIL créées {m['images_pil']}")
+        if args.out:
+            with open(args.out, "a") as f:
+                f.write(json.dumps({"mesure": "retouche", **r}) + "\n")
+
+    if not args.images:
+        return 0
+    session = SessionsRembg().get(args.modele)
+    cotes = [int(c) for c in args.cotes.split(",")]
+    for chemin in args.images:
+        resultats = comparer(chemin, session, cotes, args.repeat)
+        print(f"{chemin} ({resultats[0]['largeur']}x{resultats[0]['hauteur']}) - pleine résolution : {resultats[0]['secondes']:.2f} s")
+        for r in resultats[1:]:
+            print(f"  {r['mode']:<11}{r['cote']:>6} px  {r['secondes']:>7.2f} s  x{r['acceleration']:<6} "
+                  f"MAE {r['mae']:>6}  MAE bords {r['mae_bord']:>7}  IoU {r['iou']}")
+        if args.out:
+            with open(args.out, "a") as f:
+                for r in resultats:
+                    f.write(json.dumps({"modele": args.modele, **r}) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
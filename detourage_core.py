@@ -0,0 +1,801 @@
+# -*- coding: utf-8 -*-
+"""
+Fonctions de détourage partagées, sans Streamlit (utilisées par détourage.py)
+"""
+
+import io
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter, ImageOps
+
+from cfm_spans import recording, span, log_spans # mesures par étape des applis CFM (test/ est mis sur le chemin par les points d'entrée)
+
+MODELES = {
+    "u2net": "U²-Net (qualité, par défaut)",
+    "u2netp": "U²-Net-p (léger, rapide)",
+    "isnet-general-use": "IS-Net (contours fins)",
+    "silueta": "Silueta (U²-Net compressé)",
+}
+MODELE_DEFAUT = "u2net"
+THREADS_MAX = os.cpu_count() or 1
+
+# résolution d'inférence : U²-Net travaille de toute façon en 320x320
+MODES_INFERENCE = {
+    "guide": "Image réduite + masque agrandi par filtre guidé",
+    "bilineaire": "Image réduite + masque agrandi (bilinéaire)",
+    "pleine": "Pleine résolution (lent sur les grandes photos)",
+}
+MODE_INFERENCE_DEFAUT = "pleine" # modes réduits : à valider par detourage_bench.py sur de vraies photos avant d'en faire le défaut
+COTE_INFERENCE_DEFAUT = 1024 # plus grand côté de l'image envoyée au modèle
+RAYON_GUIDE = 2 # rayon du filtre guidé, en pixels de l'image réduite
+EPS_GUIDE = 1e-2 # régularisation : plus petit = bords plus collés à la photo (et à son bruit)
+BANDE_LIGNES = 512 # agrandissement du masque par bandes de lignes (mémoire bornée)
+
+# formats de téléchargement : (format PIL, type MIME, extension)
+FORMATS_SORTIE = {
+    "png": ("PNG", "image/png", "png"),
+    "webp_lossless": ("WEBP", "image/webp", "webp"),
+    "webp": ("WEBP", "image/webp", "webp"),
+}
+NOMS_FORMATS_SORTIE = {
+    "png": "PNG (sans perte)",
+    "webp_lossless": "WebP sans perte (encodage rapide, fichier plus léger)",
+    "webp": "WebP qualité 90 (le plus léger)",
+}
+NIVEAU_COMPRESSION_DEFAUT = 1 # 0-9 ; en PNG, 1 est ~4x plus rapide que 6 (défaut PIL) pour une taille proche
+
+COTE_APERCU = 1400 # plus grand côté des images affichées (colonne ~700 px, x2 pour les écrans HiDPI)
+
+# grandes images (affiches scannées) : au-delà du seuil, ou si le mode normal dépasse le budget, stockage compact
+SEUIL_GRANDE_IMAGE = 40_000_000 # pixels
+BUDGET_SESSION_MO = int(os.environ.get("DETOURAGE_BUDGET_SESSION_MO", 1536)) # mémoire max des images d'une session
+BUDGET_GLOBAL_MO = int(os.environ.get("DETOURAGE_BUDGET_GLOBAL_MO", 4096)) # toutes sessions confondues
+INACTIVITE_EVICTION_S = 300 # une session n'est vidée qu'après ce délai sans rerun
+PIXELS_MAX = 400_000_000 # garde-fou « decompression bomb » de PIL relevé pour les affiches (défaut ~89 MP)
+Image.MAX_IMAGE_PIXELS = PIXELS_MAX
+
+EXTENSIONS_IMAGES = (".png", ".jpg", ".jpeg", ".webp")
+TRAVAILLEURS_LOT_DEFAUT = max(1, min(4, THREADS_MAX))
+
+
+# =========================
+# Sessions rembg / onnxruntime
+# =========================
+
+def remove(*args, **kwargs):
+    # rembg (onnxruntime, scipy, pooch...) coûte ~1,5 s d'import : importé au premier détourage, pas à l'ouverture de la page
+    from rembg import remove as remove_rembg
+    return remove_rembg(*args, **kwargs)
+
+
+def new_session(*args, **kwargs):
+    from rembg import new_session as new_session_rembg
+    return new_session_rembg(*args, **kwargs)
+
+
+def options_onnxruntime(intra_threads=0, inter_threads=0):
+    """SessionOptions onnxruntime (0 = choix d'onnxruntime, tous les cœurs physiques)."""
+    import onnxruntime as ort
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = intra_threads
+    sess_opts.inter_op_num_threads = inter_threads
+    return sess_opts
+
+
+def prechauffer_session(session):
+    # une première inférence alloue les buffers onnxruntime : le premier vrai clic ne la paie pas
+    remove(Image.new("RGB", (320, 320)), session=session)
+
+
+class SessionsRembg:
+    """
+    Sessions rembg chargées une seule fois par (modèle, threads) et partagées par tout le process.
+    onnxruntime accepte des inférences concurrentes sur une même session.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._verrous = {} # un verrou de chargement par clé
+        self._lock = threading.Lock() # protège seulement _verrous
+
+    def get(self, modele=MODELE_DEFAUT, intra_threads=0, inter_threads=0):
+        key = (modele, intra_threads, inter_threads)
+        session = self._sessions.get(key) # session déjà chargée : aucun verrou
+        if session is not None:
+            return session
+        with self._lock:
+            verrou = self._verrous.setdefault(key, threading.Lock())
+        with verrou: # un seul chargement par clé ; les autres modèles ne l'attendent pas
+            session = self._sessions.get(key)
+            if session is None:
+                session = new_session(modele, sess_opts=options_onnxruntime(intra_threads, inter_threads))
+                prechauffer_session(session)
+                self._sessions[key] = session
+        return session
+
+    def prechauffer(self, modele=MODELE_DEFAUT, intra_threads=0, inter_threads=0):
+        """Charge la session en arrière-plan (au démarrage), sans bloquer l'affichage de la page."""
+        thread = threading.Thread(target=self.get, args=(modele, intra_threads, inter_threads), daemon=True)
+        thread.start()
+        return thread
+
+    def chargees(self):
+        return list(self._sessions)
+
+
+# =========================
+# Détourage
+# =========================
+
+def detourer(image_bytes, session):
+    """Image (bytes) -> PNG RGBA détouré (bytes), pleine résolution."""
+    with span("inference", resolution="pleine"): # décodage et encodage PNG de rembg compris
+        return remove(image_bytes, session=session)
+
+
+def ouvrir_image(image_bytes):
+    """Bytes d'une image -> RGBA, orientation EXIF appliquée."""
+    with span("decodage"):
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+    with span("exif_transpose"):
+        image = ImageOps.exif_transpose(image)
+    with span("conversion_rgba"):
+        return image.convert("RGBA")
+
+
+def detourer_image(image_bytes, session, mode=MODE_INFERENCE_DEFAUT, cote_max=COTE_INFERENCE_DEFAUT, image=None):
+    """
+    Détourage selon le mode d'inférence (voir MODES_INFERENCE) -> image RGBA. image : bytes déjà décodés, si on les a.
+    Pour une ImageCompacte le résultat est une ImageCompacte (même RGB + alpha), toujours via une copie réduite.
+    """
+    if isinstance(image, ImageCompacte):
+        return detourer_compacte(image, session, cote_max, "bilineaire" if mode == "bilineaire" else "guide")
+    if mode == "pleine":
+        png = detourer(image_bytes, session)
+        with span("decodage_png"):
+            return Image.open(io.BytesIO(png)).convert("RGBA")
+    return detourer_reduit(ouvrir_image(image_bytes) if image is None else image, session, cote_max, mode)
+
+
+def taille_reduite(taille, cote_max):
+    w, h = taille
+    ratio = cote_max / max(w, h)
+    return max(1, round(w * ratio)), max(1, round(h * ratio))
+
+
+def detourer_reduit(image, session, cote_max=COTE_INFERENCE_DEFAUT, raffinement="guide"):
+    """
+    Image PIL déjà décodée -> RGBA détourée, le modèle ne voyant qu'une copie réduite (plus grand côté = cote_max).
+    Seul le masque alpha est agrandi (raffinement "guide" ou "bilineaire"), puis posé une fois sur l'image pleine résolution.
+    """
+    image_rgb = image.convert("RGB")
+    if max(image_rgb.size) <= cote_max:
+        with span("inference"):
+            masque = remove(image_rgb, session=session, only_mask=True)
+    else:
+        with span("reduction"):
+            petite = image_rgb.resize(taille_reduite(image_rgb.size, cote_max), Image.Resampling.BOX)
+        with span("inference"):
+            masque_petit = remove(petite, session=session, only_mask=True)
+        with span("agrandissement_masque", raffinement=raffinement):
+            if raffinement == "guide":
+                masque = agrandir_masque_guide(masque_petit, petite, image_rgb)
+            else:
+                masque = masque_petit.resize(image_rgb.size, Image.Resampling.BILINEAR)
+    image_rgb.putalpha(masque)
+    return image_rgb
+
+
+def apercu(image, cote_max=COTE_APERCU):
+    """Copie réduite pour l'affichage (st.image, fond du canevas) ; l'image elle-même si elle est déjà assez petite."""
+    if isinstance(image, ImageCompacte):
+        return image.reduite(cote_max, Image.Resampling.BICUBIC)
+    if max(image.size) <= cote_max:
+        return image
+    # reducing_gap : réduction entière rapide (reduce) puis rééchantillonnage final sur une image déjà petite
+    return image.resize(taille_reduite(image.size, cote_max), Image.Resampling.BICUBIC, reducing_gap=2.0)
+
+
+def encoder_image(image, format_sortie="png", niveau=NIVEAU_COMPRESSION_DEFAUT):
+    """Image PIL -> bytes du fichier à télécharger. niveau 0-9 : compression PNG, effort WebP (0 = le plus rapide)."""
+    if isinstance(image, ImageCompacte):
+        with span("composition"):
+            image = image.composer() # RGBA sur fichier temporaire, le temps de l'encodage
+    buf = io.BytesIO()
+    with span("encodage", format=format_sortie, niveau=niveau):
+        if format_sortie == "png":
+            image.save(buf, format="PNG", compress_level=niveau)
+        elif format_sortie == "webp_lossless":
+            image.save(buf, format="WEBP", lossless=True, quality=round(niveau * 100 / 9), method=round(niveau * 6 / 9))
+        else:
+            image.save(buf, format="WEBP", quality=90, method=round(niveau * 6 / 9))
+    return buf.getvalue()
+
+
+# =========================
+# Retouche du masque
+# =========================
+
+class MoteurRetouche:
+    """
+    Retouche de l'alpha sur place : une image RGBA résultat allouée une fois par image détourée, dont le canal alpha
+    est modifié directement (même mémoire que l'image PIL renvoyée).
+    - synchroniser(traits) : ne trace que les traits nouveaux du canevas, chacun dans sa boîte englobante ;
+      historique annuler / rétablir = un diff par trait : sa boîte, les pixels peints (1 bit) et leur ancien alpha.
+    - appliquer(restaurer, effacer) : repart de l'alpha IA et peint des masques au format du canevas.
+    """
+
+    def __init__(self, image_ia, originale):
+        if isinstance(image_ia, ImageCompacte):
+            # grande image : le résultat partage le RGB de l'image IA, seul son alpha est alloué
+            self.alpha_ia = image_ia.alpha
+            self.image = image_ia.avec_alpha(image_ia.alpha.copy())
+            self.alpha = self.image.alpha
+        else:
+            self.alpha_ia = np.array(image_ia.getchannel("A")) # alpha IA, état sans retouche
+            rgba = np.array(originale if originale.mode == "RGBA" else originale.convert("RGBA"))
+            self.alpha = rgba[:, :, 3] # vue sur le canal alpha du résultat
+            np.copyto(self.alpha, self.alpha_ia)
+            h, w = self.alpha.shape
+            self.image = Image.frombuffer("RGBA", (w, h), rgba, "raw", "RGBA", 0, 1) # même mémoire que rgba
+        self.traits = [] # traits appliqués, dans l'ordre
+        self.historique = [] # diff (y0, x0, taille, pixels peints, ancien alpha) par trait appliqué
+        self.annules = [] # (trait, diff) annulés, pour rétablir
+        self.taille_canevas = None # taille du canevas des traits (pour les rejouer)
+
+    def appliquer(self, restaurer=None, effacer=None):
+        """restaurer / effacer : masques booléens à la résolution du canevas (None = rien). Renvoie self.image (modifiée)."""
+        np.copyto(self.alpha, self.alpha_ia)
+        self.traits, self.historique, self.annules = [], [], []
+        for masque, valeur in ((restaurer, 255), (effacer, 0)):
+            if masque is not None and masque.any():
+                self._peindre(masque, valeur)
+        return self.image
+
+    def synchroniser(self, traits, taille_canevas):
+        """
+        Met l'alpha dans l'état des traits du canevas (liste de traits_canevas, taille (largeur, hauteur) du canevas).
+        Les traits déjà appliqués restent ; ceux retirés du canevas (annuler, corbeille) sont défaits par leur diff,
+        un trait qui revient (rétablir) reprend son diff sans être retracé. Renvoie self.image (modifiée).
+        """
+        self.taille_canevas = taille_canevas
+        commun = 0
+        for a, b in zip(self.traits, traits):
+            if a != b:
+                break
+            commun += 1
+        while len(self.traits) > commun:
+            self.annuler()
+        for trait in traits[commun:]:
+            if self.annules and self.annules[-1][0] == trait:
+                self.retablir()
+            else:
+                self.annules.clear() # nouvelle branche : l'historique à rétablir ne s'applique plus
+                self._tracer(trait, taille_canevas)
+        return self.image
+
+    def annuler(self):
+        trait, diff = self.traits.pop(), self.historique.pop()
+        self._echanger(diff)
+        self.annules.append((trait, diff))
+
+    def retablir(self):
+        trait, diff = self.annules.pop()
+        self._echanger(diff)
+        self.traits.append(trait)
+        self.historique.append(diff)
+
+    def octets_historique(self):
+        diffs = self.historique + [diff for _, diff in self.annules]
+        return sum(diff[3].nbytes + diff[4].nbytes for diff in diffs)
+
+    def _echanger(self, diff):
+        # le diff garde l'autre état des pixels peints : annuler puis rétablir sont le même échange
+        y0, x0, (h, w), bits, valeurs = diff
+        masque = np.unpackbits(bits, count=h * w).reshape(h, w).view(bool)
+        zone = self.alpha[y0:y0 + h, x0:x0 + w]
+        courant = zone[masque]
+        zone[masque] = valeurs
+        valeurs[...] = courant
+
+    def _tracer(self, trait, taille_canevas):
+        valeur, largeur, points = trait
+        H, W = self.alpha.shape
+        sx, sy = W / taille_canevas[0], H / taille_canevas[1]
+        pts = np.array(points, dtype=float) * (sx, sy)
+        rayon = largeur * max(sx, sy) / 2
+        x0, y0 = np.maximum(np.floor(pts.min(axis=0) - rayon).astype(int), 0)
+        x1, y1 = np.minimum(np.ceil(pts.max(axis=0) + rayon).astype(int) + 1, (W, H))
+        if x0 >= x1 or y0 >= y1:
+            return # trait hors de l'image
+        # trait rasterisé à pleine résolution dans sa seule boîte englobante (bouts et jointures ronds, comme le canevas)
+        masque = Image.new("L", (int(x1 - x0), int(y1 - y0)))
+        dessin = ImageDraw.Draw(masque)
+        pts -= (x0, y0)
+        if len(pts) > 1:
+            dessin.line([tuple(p) for p in pts], fill=255, width=max(1, round(2 * rayon)), joint="curve")
+        for x, y in (pts[0], pts[-1]):
+            dessin.ellipse((x - rayon, y - rayon, x + rayon, y + rayon), fill=255)
+        masque = np.asarray(masque) > 0
+        zone = self.alpha[y0:y1, x0:x1]
+        self.historique.append((int(y0), int(x0), masque.shape, np.packbits(masque), zone[masque]))
+        self.traits.append(trait)
+        zone[masque] = valeur
+
+    def _peindre(self, masque, valeur):
+        H, W = self.alpha.shape
+        h, w = masque.shape
+        lignes_src = _indices_plus_proche(h, H)
+        colonnes_src = _indices_plus_proche(w, W)
+        colonnes = np.flatnonzero(masque.any(axis=0))
+        x0, x1 = np.searchsorted(colonnes_src, [colonnes[0], colonnes[-1] + 1]) # boîte englobante des traits
+        colonnes_src = colonnes_src[x0:x1]
+        for r in np.flatnonzero(masque.any(axis=1)):
+            y0, y1 = np.searchsorted(lignes_src, [r, r + 1]) # lignes pleine résolution issues de la ligne r du canevas
+            self.alpha[y0:y1, x0:x1][:, masque[r, colonnes_src]] = valeur
+
+
+def _indices_plus_proche(n_src, n_dst):
+    # indices source d'un resize NEAREST, pris à PIL lui-même sur une ligne d'entiers (mêmes arrondis, croissants)
+    ligne = Image.fromarray(np.arange(n_src, dtype=np.int32)[None, :], "I")
+    return np.asarray(ligne.resize((n_dst, 1), Image.Resampling.NEAREST))[0]
+
+
+def traits_canevas(json_data):
+    """
+    json_data du canevas (objets « path » du dessin libre) -> liste de traits (valeur alpha, largeur, points) en
+    coordonnées du canevas : rouge = restaurer (255), bleu = effacer (0). Les courbes sont prises par leurs points.
+    """
+    traits = []
+    for objet in (json_data or {}).get("objects", []):
+        if objet.get("type") != "path":
+            continue
+        points = tuple((float(c[i]), float(c[i + 1])) for c in objet["path"] for i in range(1, len(c) - 1, 2))
+        if points:
+            traits.append((_valeur_couleur(objet.get("stroke", "")), float(objet.get("strokeWidth", 1)), points))
+    return traits
+
+
+def _valeur_couleur(couleur):
+    # "rgba(r, g, b, a)" ou "#rrggbb" : même règle que masques_canevas (rouge >= bleu -> restaurer)
+    if couleur.startswith("#") and len(couleur) >= 7:
+        r, b = int(couleur[1:3], 16), int(couleur[5:7], 16)
+    else:
+        composantes = re.findall(r"[\d.]+", couleur)
+        r, b = (float(composantes[0]), float(composantes[2])) if len(composantes) >= 3 else (255, 0)
+    return 255 if r >= b else 0
+
+
+def masques_canevas(image_data):
+    """image_data RGBA du canevas -> (restaurer, effacer) : traits rouges = restaurer, traits bleus = effacer."""
+    peint = image_data[:, :, 3] > 0
+    rouge = image_data[:, :, 0] >= image_data[:, :, 2]
+    return peint & rouge, peint & ~rouge
+
+
+# =========================
+# Grandes images (stockage compact)
+# =========================
+
+class ImageCompacte:
+    """
+    Image gardée sans copie RGBA : un tableau RGB (H, W, 3), projeté depuis un fichier temporaire (np.memmap), et un
+    alpha uint8 (H, W) optionnel. L'originale, le résultat IA et le résultat retouché partagent le même RGB.
+    Aperçus, entrée du modèle et image RGBA à encoder sont construits par bandes de lignes.
+    """
+
+    def __init__(self, rgb, alpha=None):
+        self.rgb = rgb
+        self.alpha = alpha
+
+    @property
+    def size(self):
+        return self.rgb.shape[1], self.rgb.shape[0]
+
+    @property
+    def width(self):
+        return self.rgb.shape[1]
+
+    @property
+    def height(self):
+        return self.rgb.shape[0]
+
+    def avec_alpha(self, alpha):
+        return ImageCompacte(self.rgb, alpha)
+
+    def crop(self, box):
+        x0, y0, x1, y1 = box
+        return Image.fromarray(np.ascontiguousarray(self.rgb[y0:y1, x0:x1]), "RGB")
+
+    def bande(self, y0, y1):
+        """Lignes y0:y1 en image PIL (RGBA si l'image a un alpha)."""
+        if self.alpha is None:
+            return self.crop((0, y0, self.width, y1))
+        rgba = np.empty((y1 - y0, self.width, 4), dtype=np.uint8)
+        rgba[:, :, :3] = self.rgb[y0:y1]
+        rgba[:, :, 3] = self.alpha[y0:y1]
+        return Image.fromarray(rgba, "RGBA")
+
+    def reduite(self, cote_max, resample=Image.Resampling.BOX, bande=BANDE_LIGNES):
+        """Copie PIL réduite (plus grand côté = cote_max) : réduction entière bande par bande, puis resample final."""
+        facteur = max(1, max(self.size) // cote_max)
+        bande = -(-bande // facteur) * facteur # multiple du facteur : les bandes réduites se recollent exactement
+        W, H = self.size
+        reduite = Image.new("RGB" if self.alpha is None else "RGBA", (-(-W // facteur), -(-H // facteur)))
+        for y0 in range(0, H, bande):
+            reduite.paste(self.bande(y0, min(y0 + bande, H)).reduce(facteur), (0, y0 // facteur))
+        if max(reduite.size) <= cote_max:
+            return reduite
+        return reduite.resize(taille_reduite(self.size, cote_max), resample)
+
+    def composer(self, bande=BANDE_LIGNES):
+        """Image PIL RGBA pleine résolution sur un fichier temporaire projeté (pas de copie en mémoire vive)."""
+        W, H = self.size
+        rgba = tableau_temporaire((H, W, 4))
+        for y0 in range(0, H, bande):
+            y1 = min(y0 + bande, H)
+            rgba[y0:y1, :, :3] = self.rgb[y0:y1]
+            rgba[y0:y1, :, 3] = 255 if self.alpha is None else self.alpha[y0:y1]
+        return Image.frombuffer("RGBA", (W, H), rgba, "raw", "RGBA", 0, 1)
+
+
+def tableau_temporaire(forme):
+    # fichier anonyme (supprimé à la fermeture) : les pages vont au cache disque, pas dans la mémoire du process
+    return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode="w+", shape=forme)
+
+
+def taille_image(image_bytes):
+    """(largeur, hauteur) lue dans l'en-tête, sans décoder les pixels."""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return image.size
+
+
+def memoire_estimee(taille, compacte):
+    """Octets gardés en mémoire pour une image : 3 RGBA (originale, IA, retouchée) ou 2 alphas en mode compact."""
+    w, h = taille
+    return w * h * (2 if compacte else 12)
+
+
+def est_grande_image(taille, budget_mo=BUDGET_SESSION_MO):
+    return taille[0] * taille[1] > SEUIL_GRANDE_IMAGE or memoire_estimee(taille, False) > budget_mo * 2**20
+
+
+def memoire_image(image):
+    """Octets en mémoire vive d'une image PIL ou ImageCompacte (le RGB projeté sur disque ne compte pas)."""
+    if image is None:
+        return 0
+    if isinstance(image, ImageCompacte):
+        rgb = 0 if isinstance(image.rgb, np.memmap) else image.rgb.nbytes
+        return rgb + (0 if image.alpha is None else image.alpha.nbytes)
+    return image.width * image.height * len(image.getbands())
+
+
+def ouvrir_compacte(image_bytes, bande=BANDE_LIGNES):
+    """Bytes d'image -> ImageCompacte sans alpha (orientation EXIF appliquée), RGB copié bande par bande sur disque."""
+    with span("decodage"):
+        image = Image.open(io.BytesIO(image_bytes))
+        image = image.convert("RGB") if image.mode != "RGB" else image
+    with span("exif_transpose"):
+        ImageOps.exif_transpose(image, in_place=True) # sans copie si l'image n'est pas tournée
+    W, H = image.size
+    with span("copie_disque"):
+        rgb = tableau_temporaire((H, W, 3))
+        for y0 in range(0, H, bande):
+            y1 = min(y0 + bande, H)
+            rgb[y0:y1] = np.asarray(image.crop((0, y0, W, y1)))
+    return ImageCompacte(rgb)
+
+
+def detourer_compacte(image, session, cote_max=COTE_INFERENCE_DEFAUT, raffinement="guide", bande=BANDE_LIGNES):
+    """Comme detourer_reduit pour une ImageCompacte : le masque est agrandi directement dans un alpha uint8."""
+    with span("reduction"):
+        petite = image.avec_alpha(None).reduite(cote_max)
+    with span("inference"):
+        masque_petit = remove(petite, session=session, only_mask=True)
+    W, H = image.size
+    alpha = np.empty((H, W), dtype=np.uint8)
+    with span("agrandissement_masque", raffinement=raffinement):
+        if raffinement == "guide" and petite.size != image.size:
+            agrandir_masque_guide(masque_petit, petite, image, sortie=alpha)
+        else:
+            w, h = masque_petit.size
+            for y0 in range(0, H, bande):
+                y1 = min(y0 + bande, H)
+                alpha[y0:y1] = np.asarray(masque_petit.resize((W, y1 - y0), Image.Resampling.BILINEAR, box=(0, y0 * h / H, w, y1 * h / H)))
+    return image.avec_alpha(alpha)
+
+
+# =========================
+# Mémoire des sessions (toutes les sessions du process)
+# =========================
+
+class Deverse:
+    """Valeur sortie de la mémoire vers un fichier temporaire anonyme (pickle), rechargée à la demande."""
+
+    def __init__(self, valeur):
+        self.fichier = tempfile.TemporaryFile()
+        pickle.dump(valeur, self.fichier, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def recharger(self):
+        self.fichier.seek(0)
+        valeur = pickle.load(self.fichier)
+        self.fichier.close()
+        return valeur
+
+
+class JetonSession:
+    """
+    Objets libérables d'une session (images, fichiers encodés, aperçus...), gardés dans son état : jeton.original_image...
+    Le registre n'en a qu'une référence faible (il disparaît avec la session) et libère les clés d'une session inactive
+    depuis son propre thread, sous le verrou du jeton, avec la fonction liberer_cle(jeton, cle) de l'appli. Une clé
+    libérée garde une recette (fichier déversé, nouveau décodage...) : la session la refait au premier accès.
+    """
+
+    def __init__(self, liberer_cle, **valeurs):
+        object.__setattr__(self, "_liberer_cle", liberer_cle)
+        object.__setattr__(self, "_valeurs", dict(valeurs))
+        object.__setattr__(self, "_recettes", {}) # clé libérée -> recette(jeton) qui la refait
+        object.__setattr__(self, "_lock", threading.RLock()) # réentrant : une recette lit d'autres clés
+
+    def __getattr__(self, cle):
+        with self._lock:
+            if cle in self._recettes:
+                self._valeurs[cle] = self._recettes.pop(cle)(self)
+            try:
+                return self._valeurs[cle]
+            except KeyError:
+                raise AttributeError(cle) from None
+
+    def __setattr__(self, cle, valeur):
+        with self._lock:
+            self._recettes.pop(cle, None)
+            self._valeurs[cle] = valeur
+
+    def get(self, cle, defaut=None):
+        return getattr(self, cle, defaut)
+
+    def en_memoire(self, cle):
+        """Valeur de la clé si elle est en mémoire, sans la refaire (None sinon)."""
+        with self._lock:
+            return self._valeurs.get(cle)
+
+    def remplacer(self, cle, valeur, recette=None):
+        """Pour liberer_cle : valeur allégée (None, {}...) et, si on sait la refaire, recette(jeton) -> valeur."""
+        with self._lock:
+            self._valeurs[cle] = valeur
+            if recette is not None:
+                self._recettes[cle] = recette
+
+    def oublier_liberees(self):
+        """Les clés libérées ne seront pas refaites (nouvelle image : leurs recettes sont périmées)."""
+        with self._lock:
+            self._recettes.clear()
+
+    def liberer(self, cle):
+        """Appelé par le registre (thread d'une autre session) : libère la clé tout de suite."""
+        with self._lock:
+            self._liberer_cle(self, cle)
+
+
+class RegistreMemoire:
+    """
+    Octets gardés par chaque session, par clé, et éviction LRU sous un budget global (thread-safe, un par process).
+    Chaque session signale le début de son run (debut_run) et se déclare à la fin avec son JetonSession.
+    Les clés des sessions inactives sont libérées par leur jeton (JetonSession.liberer) sous le verrou du registre :
+    une session qui commence un run (debut_run) attend la fin de la libération, jamais de libération pendant un run.
+    """
+
+    def __init__(self, budget_octets=BUDGET_GLOBAL_MO * 2**20, inactivite_s=INACTIVITE_EVICTION_S):
+        self.budget_octets = budget_octets
+        self.inactivite_s = inactivite_s
+        self.evictions = 0
+        self._sessions = OrderedDict() # id -> (réf. faible du jeton, dernière activité, {clé: octets}), la plus récente en dernier
+        self._en_cours = set() # sessions dont un run n'est pas terminé : jamais libérées
+        self._lock = threading.Lock()
+
+    def debut_run(self, session_id):
+        """Début d'un run : la session est active (un long traitement par lot ne la rend pas inactive)."""
+        with self._lock:
+            self._en_cours.add(session_id)
+            if session_id in self._sessions:
+                ref, _, tailles = self._sessions.pop(session_id)
+                self._sessions[session_id] = (ref, time.monotonic(), tailles)
+
+    def declarer(self, session_id, jeton, tailles):
+        """Fin d'un run : octets gardés par la session, par clé."""
+        with self._lock:
+            self._en_cours.discard(session_id)
+            self._sessions.pop(session_id, None)
+            self._sessions[session_id] = (weakref.ref(jeton), time.monotonic(), dict(tailles))
+
+    def totaux(self):
+        """(octets toutes sessions, nombre de sessions, {clé: octets toutes sessions})"""
+        with self._lock:
+            self._purger()
+            par_cle = {}
+            for _, _, tailles in self._sessions.values():
+                for cle, octets in tailles.items():
+                    par_cle[cle] = par_cle.get(cle, 0) + octets
+            return sum(par_cle.values()), len(self._sessions), par_cle
+
+    def liberer(self, ordre, sauf=None):
+        """
+        Tant que le total dépasse le budget : libère les clés des sessions les moins récemment actives (sauf celle
+        donnée, celles dont un run est en cours, et seulement après inactivite_s sans run), dans l'ordre donné (du moins
+        cher au plus cher à refaire). Renvoie le nombre de clés libérées.
+        """
+        n = 0
+        with self._lock:
+            self._purger()
+            total = sum(sum(tailles.values()) for _, _, tailles in self._sessions.values())
+            limite = time.monotonic() - self.inactivite_s
+            for session_id, (ref, activite, tailles) in list(self._sessions.items()):
+                if total <= self.budget_octets or activite > limite:
+                    break # sessions suivantes plus récentes
+                jeton = ref()
+                if session_id == sauf or session_id in self._en_cours or jeton is None:
+                    continue
+                for cle in ordre:
+                    if total <= self.budget_octets:
+                        break
+                    if tailles.get(cle, 0) > 0:
+                        try:
+                            jeton.liberer(cle)
+                        except Exception:
+                            continue # clé gardée (disque plein...) : jamais d'erreur dans le run d'une autre session
+                        total -= tailles[cle]
+                        tailles[cle] = 0
+                        n += 1
+            self.evictions += n
+        return n
+
+    def _purger(self):
+        # sessions fermées : leur état (et son jeton) a été libéré par Streamlit
+        for session_id in [s for s, (ref, _, _) in self._sessions.items() if ref() is None]:
+            del self._sessions[session_id]
+            self._en_cours.discard(session_id)
+
+
+# =========================
+# Traitement par lot
+# =========================
+
+def entrees_lot(fichiers):
+    """
+    fichiers = [(nom, bytes), ...] d'images ou d'archives ZIP -> [(nom, lire), ...] pour chaque image.
+    Les images des ZIP ne sont lues (lire()) qu'au moment de leur traitement.
+    """
+    entrees = []
+    for nom, data in fichiers:
+        if nom.lower().endswith(".zip"):
+            archive = zipfile.ZipFile(io.BytesIO(data))
+            for info in archive.infolist():
+                if info.is_dir() or info.filename.startswith("__MACOSX/") or not info.filename.lower().endswith(EXTENSIONS_IMAGES):
+                    continue
+                entrees.append((info.filename, lambda archive=archive, info=info: archive.read(info)))
+        else:
+            entrees.append((nom, lambda data=data: data))
+    return entrees
+
+
+def nom_sortie(nom, extension, deja_pris):
+    base = nom.rsplit(".", 1)[0] + "_ia"
+    candidat, n = f"{base}.{extension}", 1
+    while candidat in deja_pris: # deux images du même nom (ZIP + upload, dossiers...)
+        n += 1
+        candidat = f"{base}_{n}.{extension}"
+    deja_pris.add(candidat)
+    return candidat
+
+
+def _detourer_et_encoder(nom, image_bytes, session, mode, cote_max, format_sortie, niveau, etapes):
+    with recording(app="detourage_lot", file=nom) as enregistreur:
+        with span("image"):
+            data = encoder_image(detourer_image(image_bytes, session, mode, cote_max), format_sortie, niveau)
+    log_spans(enregistreur.records)
+    etapes.extend(enregistreur.records)
+    return data
+
+
+def detourer_lot(entrees, session, travailleurs=TRAVAILLEURS_LOT_DEFAUT, mode=MODE_INFERENCE_DEFAUT,
+                 cote_max=COTE_INFERENCE_DEFAUT, format_sortie="png", niveau=NIVEAU_COMPRESSION_DEFAUT, etapes=None):
+    """
+    Détoure entrees (voir entrees_lot) avec un pool de threads partageant la même session onnxruntime
+    (l'inférence libère le GIL). Au plus 2 x travailleurs images en mémoire à la fois.
+    Produit (nom du fichier de sortie, bytes ou None, erreur ou None) au fil des images terminées.
+    etapes : liste complétée par les mesures par étape de chaque image (aussi écrites au journal).
+    """
+    etapes = [] if etapes is None else etapes
+    extension = FORMATS_SORTIE[format_sortie][2]
+    pris = set()
+    a_faire = iter(entrees)
+    with ThreadPoolExecutor(max_workers=travailleurs) as pool:
+        en_cours = {}
+
+        def soumettre():
+            for nom, lire in a_faire:
+                try:
+                    futur = pool.submit(_detourer_et_encoder, nom, lire(), session, mode, cote_max, format_sortie, niveau, etapes)
+                except Exception as e: # membre de ZIP illisible
+                    futur = pool.submit(_lever, e)
+                en_cours[futur] = nom
+                if len(en_cours) >= 2 * travailleurs:
+                    return
+
+        soumettre()
+        while en_cours:
+            finis, _ = wait(en_cours, return_when=FIRST_COMPLETED)
+            for futur in finis:
+                nom = en_cours.pop(futur)
+                try:
+                    yield nom_sortie(nom, extension, pris), futur.result(), None
+                except Exception as e:
+                    yield nom, None, e
+            soumettre()
+
+
+def _lever(e):
+    raise e
+
+
+# =========================
+# Filtre guidé (agrandissement du masque)
+# =========================
+
+def _moyenne_boite(x, r):
+    # moyenne sur une fenêtre (2r+1)x(2r+1) par sommes cumulées, fenêtre tronquée aux bords
+    def le_long(x, axe):
+        n = x.shape[axe]
+        c = np.cumsum(x, axis=axe, dtype=np.float64)
+        c = np.concatenate([np.zeros_like(c.take([0], axis=axe)), c], axis=axe)
+        hi = np.minimum(np.arange(n) + r + 1, n)
+        lo = np.maximum(np.arange(n) - r, 0)
+        forme = [1, 1]
+        forme[axe] = n
+        return (c.take(hi, axis=axe) - c.take(lo, axis=axe)) / (hi - lo).reshape(forme)
+    return le_long(le_long(x, 0), 1).astype(np.float32)
+
+
+def agrandir_masque_guide(masque_petit, petite, image, rayon=RAYON_GUIDE, eps=EPS_GUIDE, bande=BANDE_LIGNES, sortie=None):
+    """
+    Agrandissement du masque guidé par la photo pleine résolution (filtre guidé rapide, He & Sun) :
+    masque = p_bilinéaire + a * (I - moyenne(I)), avec a la pente locale masque/luminance calculée sur l'image réduite.
+    Là où la photo n'explique pas le masque (a ~ 0) on retombe sur le bilinéaire ; le résultat reste borné
+    par le min / max local du petit masque (pas de bruit dans les zones pleines).
+    Le masque plein est produit par bandes de lignes, sans aucun tableau float de la taille de l'image.
+    image : PIL ou ImageCompacte (seul crop est utilisé) ; sortie : tableau uint8 (H, W) à remplir et renvoyer
+    à la place d'une image PIL.
+    """
+    I = np.asarray(petite.convert("L"), dtype=np.float32) / 255
+    p = np.asarray(masque_petit, dtype=np.float32) / 255
+    moy_I = _moyenne_boite(I, rayon)
+    moy_p = _moyenne_boite(p, rayon)
+    var_I = _moyenne_boite(I * I, rayon) - moy_I * moy_I
+    cov_Ip = _moyenne_boite(I * p, rayon) - moy_I * moy_p
+    a = _moyenne_boite(cov_Ip / (var_I + eps), rayon)
+    p_min = np.asarray(masque_petit.filter(ImageFilter.MinFilter(3)), dtype=np.float32) / 255
+    p_max = np.asarray(masque_petit.filter(ImageFilter.MaxFilter(3)), dtype=np.float32) / 255
+    petits = [Image.fromarray(x, "F") for x in (p, a, moy_I, p_min, p_max)]
+
+    W, H = image.size
+    w, h = masque_petit.size
+    masque = np.empty((H, W), dtype=np.uint8) if sortie is None else sortie
+    for y0 in range(0, H, bande):
+        y1 = min(y0 + bande, H)
+        boite = (0, y0 * h / H, w, y1 * h / H) # même échantillonnage qu'un resize de l'image entière
+        p_b, a_b, moy_I_b, p_min_b, p_max_b = [np.asarray(x.resize((W, y1 - y0), Image.Resampling.BILINEAR, box=boite)) for x in petits]
+        I_b = np.asarray(image.crop((0, y0, W, y1)).convert("L"), dtype=np.float32) / 255
+        q = np.clip(p_b + a_b * (I_b - moy_I_b), p_min_b, p_max_b)
+        masque[y0:y1] = np.clip(q * 255 + 0.5, 0, 255).astype(np.uint8)
+    return Image.fromarray(masque, "L") if sortie is None else sortie
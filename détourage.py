@@ -1,10 +1,27 @@
+import os
+import sys
 import streamlit as st
-from rembg import remove
-from PIL import Image, ImageOps
-import io
-import numpy as np
+import tempfile
+import time
+import zipfile
+from contextlib import contextmanager
 import platform # Importé pour le débogage
-import streamlit_drawable_canvas # Importé pour le débogage
+from importlib.metadata import version # version du canevas sans l'importer (importé au premier affichage du canevas)
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# mesures par étape : module des applis CFM (test/cfm_spans.py), mêmes enregistrements et même journal (CFM_SPANS_LOG)
+DOSSIER_CFM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test")
+if DOSSIER_CFM not in sys.path:
+    sys.path.append(DOSSIER_CFM)
+
+from detourage_core import (
+    SessionsRembg, MoteurRetouche, traits_canevas, apercu, ouvrir_image, detourer_image, encoder_image, entrees_lot, detourer_lot, MODELES, MODELE_DEFAUT, THREADS_MAX,
+    ImageCompacte, ouvrir_compacte, taille_image, est_grande_image, memoire_estimee, memoire_image, tableau_temporaire, BUDGET_SESSION_MO,
+    RegistreMemoire, JetonSession, Deverse,
+    MODES_INFERENCE, MODE_INFERENCE_DEFAUT, COTE_INFERENCE_DEFAUT,
+    FORMATS_SORTIE, NOMS_FORMATS_SORTIE, NIVEAU_COMPRESSION_DEFAUT, TRAVAILLEURS_LOT_DEFAUT,
+)
+from cfm_spans import recording, span, log_spans, spans_frame, stage_totals
 
 # --- Configuration de la page ---
 st.set_page_config(
@@ -13,6 +30,23 @@ st.set_page_config(
     layout="wide"
 )
 
+# --- Sessions du modèle IA (une par process, partagées entre utilisateurs) ---
+@st.cache_resource
+def get_sessions_rembg():
+    sessions = SessionsRembg()
+    sessions.prechauffer(MODELE_DEFAUT) # chargé en arrière-plan dès le démarrage
+    return sessions
+
+sessions_rembg = get_sessions_rembg()
+
+# --- Registre mémoire (toutes les sessions du process) ---
+@st.cache_resource
+def get_registre_memoire():
+    return RegistreMemoire()
+
+registre = get_registre_memoire()
+registre.debut_run(get_script_run_ctx().session_id) # session active dès le début du run (jamais libérée pendant un lot)
+
 # --- PANNEAU DE DÉBOGAGE (NOUVEAU) ---
 with st.sidebar:
     st.header("🕵️‍♂️ Panneau de Débogage")
@@ -39,40 +73,306 @@ with st.sidebar:
         
     # Vérifier la version de Canvas
     try:
-        canvas_version = streamlit_drawable_canvas.__version__
+        canvas_version = version("streamlit-drawable-canvas")
         st.markdown(f"**Version Canvas :** `{canvas_version}`")
         st.success("Canvas est installé.")
     except Exception as e:
         st.error("ERREUR: Streamlit-Drawable-Canvas n'est PAS installé.")
 
+    # Mesures par étape (décodage, exif_transpose, inférence, encodage...) : affichées en bas du panneau
+    afficher_mesures = st.checkbox("⏱️ Mesurer chaque étape (temps, CPU)", value=False)
+
+    # Modèle et threads onnxruntime
+    st.header("⚙️ Modèle IA")
+    modele = st.selectbox("Modèle de détourage", list(MODELES), index=list(MODELES).index(MODELE_DEFAUT), format_func=MODELES.get)
+    intra_threads = st.number_input("Threads onnxruntime (intra-op, 0 = auto)", min_value=0, max_value=THREADS_MAX, value=0)
+    inter_threads = st.number_input("Threads onnxruntime (inter-op, 0 = auto)", min_value=0, max_value=THREADS_MAX, value=0)
+    mode_inference = st.selectbox("Résolution d'inférence", list(MODES_INFERENCE), index=list(MODES_INFERENCE).index(MODE_INFERENCE_DEFAUT), format_func=MODES_INFERENCE.get)
+    cote_inference = st.select_slider("Plus grand côté envoyé au modèle (px)", options=[512, 768, 1024, 1536, 2048], value=COTE_INFERENCE_DEFAUT, disabled=mode_inference == "pleine")
+
+    # Format des fichiers téléchargés
+    st.header("💾 Téléchargement")
+    format_sortie = st.selectbox("Format", list(FORMATS_SORTIE), format_func=NOMS_FORMATS_SORTIE.get)
+    niveau_compression = st.slider("Compression (0 = rapide, 9 = fichier le plus petit)", 0, 9, NIVEAU_COMPRESSION_DEFAUT)
+    st.caption("Sessions chargées : " + (", ".join(f"{m} ({a}/{b})" for m, a, b in sessions_rembg.chargees()) or "aucune"))
+
+# --- Mémoire de la session : objets libérables gardés par son JetonSession (le registre peut les libérer) ---
+# clés libérables par le registre, de la moins chère à la plus chère à refaire
+ORDRE_EVICTION = ["apercus", "encodages", "original_image", "retouche", "processed_image", "original_bytes", "lot_zip"]
+
+def tailles_session(memoire):
+    """Octets gardés par la session, par clé (sans refaire les clés libérées)."""
+    moteur = memoire.en_memoire("moteur_retouche")
+    retouche = memoire_image(memoire.en_memoire("final_image"))
+    if moteur is not None:
+        retouche += moteur[1].octets_historique()
+        if not isinstance(moteur[0], ImageCompacte):
+            retouche += moteur[1].alpha_ia.nbytes # copie de l'alpha IA (partagé en mode compact)
+    octets, lot_zip = memoire.en_memoire("original_bytes"), memoire.en_memoire("lot_zip")
+    return {
+        "apercus": sum(memoire_image(proxy) for source, proxy in (memoire.en_memoire("apercus") or {}).values() if proxy is not source),
+        "encodages": sum(len(data) for _, fichiers in (memoire.en_memoire("encodages") or {}).values() for data in fichiers.values()),
+        "original_image": memoire_image(memoire.en_memoire("original_image")),
+        "retouche": retouche,
+        "processed_image": memoire_image(memoire.en_memoire("processed_image")),
+        "original_bytes": len(octets) if octets is not None else 0,
+        "lot_zip": len(lot_zip) if lot_zip is not None else 0,
+    }
+
+def liberer_cle(memoire, cle):
+    """
+    Libère une clé d'une session inactive : appelée par le registre, depuis le thread d'une autre session, sous le
+    verrou du jeton (jamais st.session_state ici). Ce qui se recalcule est jeté, le reste part sur disque ; la session
+    le refait au premier accès (recette du jeton).
+    """
+    if cle in ("apercus", "encodages"):
+        memoire.remplacer(cle, {})
+    elif cle == "original_image":
+        memoire.remplacer("original_image", None, lambda m: ouvrir_originale(m.original_bytes)) # refait depuis original_bytes
+    elif cle == "retouche":
+        moteur = memoire.en_memoire("moteur_retouche")
+        recette = None
+        if moteur is not None and moteur[1].taille_canevas is not None:
+            traits, taille_canevas = list(moteur[1].traits), moteur[1].taille_canevas # rejoués au premier accès
+
+            def recette(m):
+                moteur = MoteurRetouche(m.processed_image, m.original_image)
+                m.final_image = moteur.synchroniser(traits, taille_canevas)
+                return (m.processed_image, moteur)
+
+        memoire.remplacer("moteur_retouche", None, recette)
+        memoire.remplacer("final_image", None, recette and (lambda m: m.moteur_retouche[1].image))
+    elif cle == "processed_image":
+        image = memoire.en_memoire("processed_image")
+        if isinstance(image, ImageCompacte):
+            alpha = tableau_temporaire(image.alpha.shape) # sur place : l'objet (et les caches qui le référencent) reste
+            alpha[...] = image.alpha
+            image.alpha = alpha
+        elif image is not None:
+            deverse = Deverse(image)
+            memoire.remplacer("processed_image", None, lambda m: deverse.recharger())
+    elif cle == "original_bytes":
+        octets = memoire.en_memoire("original_bytes")
+        if octets is not None:
+            deverse = Deverse(octets)
+            memoire.remplacer("original_bytes", None, lambda m: deverse.recharger())
+    elif cle == "lot_zip":
+        memoire.remplacer("lot_zip", None) # ne se refait pas sans les images : le lot est à relancer
+        memoire.remplacer("lot_libere", True)
+
 # --- Initialisation du Session State ---
-if 'original_image' not in st.session_state:
-    st.session_state.original_image = None
-if 'processed_image' not in st.session_state:
-    st.session_state.processed_image = None
+if 'jeton_memoire' not in st.session_state:
+    st.session_state.jeton_memoire = JetonSession(
+        liberer_cle,
+        original_image=None,
+        processed_image=None,
+        final_image=None,
+        moteur_retouche=None, # (image détourée, MoteurRetouche)
+        original_bytes=None,
+        encodages={}, # nom -> (image source, {(format, niveau): bytes})
+        apercus={}, # nom -> (image source, copie réduite affichée)
+        lot_zip=None,
+        lot_libere=False, # archive du lot libérée par le registre : le lot est à relancer
+    )
+memoire = st.session_state.jeton_memoire
+if 'etapes' not in st.session_state:
+    st.session_state.etapes = [] # dernières mesures par étape (panneau de débogage)
 # ... (le reste du session state) ...
 
 # (Le reste de votre script est identique à la version précédente)
 # --- Fonctions Utiles ---
+ETAPES_GARDEES = 200 # mesures gardées pour le panneau
+
+def garder_etapes(enregistrements):
+    if afficher_mesures:
+        st.session_state.etapes = (st.session_state.etapes + enregistrements)[-ETAPES_GARDEES:]
+
+@contextmanager
+def mesure(operation):
+    """Étapes d'une opération de la session : journal JSON (CFM_SPANS_LOG) et panneau si coché."""
+    with recording(app="detourage", file=st.session_state.get("file_name")) as enregistreur:
+        with span(operation):
+            yield
+    log_spans(enregistreur.records)
+    garder_etapes(enregistreur.records)
+
 def process_image(image_bytes):
     """Lance rembg sur l'image et la stocke dans le session state."""
-    with st.spinner("Magie en cours... L'IA analyse l'image..."):
+    with st.spinner("Magie en cours... L'IA analyse l'image..."), mesure("detourage"):
         try:
-            output_bytes = remove(image_bytes)
-            st.session_state.processed_image = Image.open(io.BytesIO(output_bytes)).convert("RGBA")
-            st.session_state.final_image = None # Réinitialise l'image finale
+            session = sessions_rembg.get(modele, intra_threads, inter_threads) # chargée une seule fois par process
+            # image déjà décodée : en mode réduit le modèle voit une copie réduite, seul le masque est agrandi
+            memoire.processed_image = detourer_image(image_bytes, session, mode_inference, cote_inference, memoire.original_image)
+            memoire.final_image = None # Réinitialise l'image finale
         except Exception as e:
             st.error(f"Erreur lors du traitement automatique : {e}")
-            st.session_state.processed_image = None
+            memoire.processed_image = None
+
+def image_to_bytes(nom, image):
+    """Bytes encodés de l'image, gardés avec elle : ré-encodés seulement si l'image ou le format change."""
+    source, fichiers = memoire.encodages.get(nom, (None, {}))
+    if source is not image:
+        fichiers = {}
+        memoire.encodages[nom] = (image, fichiers)
+    cle = (format_sortie, niveau_compression)
+    if cle not in fichiers:
+        fichiers[cle] = encoder_image(image, format_sortie, niveau_compression)
+    return fichiers[cle]
 
-def image_to_bytes(image):
-    """Convertit une image PIL en bytes pour le téléchargement."""
-    buf = io.BytesIO()
-    image.save(buf, format="PNG")
-    return buf.getvalue()
+def image_apercu(nom, image):
+    """Copie d'affichage (COTE_APERCU px) gardée avec l'image : le navigateur ne reçoit jamais la pleine résolution."""
+    source, proxy = memoire.apercus.get(nom, (None, None))
+    if source is not image:
+        proxy = apercu(image)
+        memoire.apercus[nom] = (image, proxy)
+    return proxy
+
+def image_modifiee(nom):
+    # image modifiée sur place (même objet) : fichiers encodés et aperçu à refaire
+    memoire.encodages.pop(nom, None)
+    memoire.apercus.pop(nom, None)
+
+def bouton_telechargement(nom, image, label, suffixe):
+    """Encodage à la demande (bouton « Préparer »), puis bouton de téléchargement sur les bytes gardés."""
+    source, fichiers = memoire.encodages.get(nom, (None, {}))
+    deja_encode = source is image and (format_sortie, niveau_compression) in fichiers
+    if not deja_encode and not st.button(f"⚙️ Préparer le fichier ({NOMS_FORMATS_SORTIE[format_sortie]})", key=f"preparer_{nom}", use_container_width=True):
+        return
+    with st.spinner("Encodage..."), mesure("telechargement"):
+        data = image_to_bytes(nom, image)
+    _, mime, extension = FORMATS_SORTIE[format_sortie]
+    st.download_button(
+        label=label,
+        data=data,
+        file_name=f"{st.session_state.file_name.split('.')[0]}_{suffixe}.{extension}",
+        mime=mime,
+        use_container_width=True
+    )
+
+def oublier_anciens_resultats():
+    # les fichiers encodés, aperçus et le moteur de retouche d'images remplacées ne doivent pas rester en mémoire
+    actuelles = {"original": memoire.original_image, "processed": memoire.processed_image, "final": memoire.get("final_image")}
+    for cache in (memoire.encodages, memoire.apercus):
+        for nom, (source, _) in list(cache.items()):
+            if source is not actuelles.get(nom):
+                del cache[nom]
+    moteur = memoire.get("moteur_retouche")
+    if moteur is not None and moteur[0] is not memoire.processed_image:
+        memoire.moteur_retouche = None
+
+def ouvrir_originale(image_bytes):
+    """Image décodée pour la session : RGBA, ImageCompacte pour les grandes images, None si hors budget."""
+    taille = taille_image(image_bytes)
+    if not est_grande_image(taille):
+        return ouvrir_image(image_bytes) # décodage, exif_transpose, RGBA (mesurés séparément)
+    if memoire_estimee(taille, True) <= BUDGET_SESSION_MO * 2**20:
+        # grande image : RGB sur fichier temporaire, alphas uint8, masque calculé sur une copie réduite
+        return ouvrir_compacte(image_bytes)
+    return None
+
+def gerer_memoire():
+    """Budget de la session, déclaration au registre, éviction des sessions inactives, panneau mémoire."""
+    ctx = get_script_run_ctx()
+    budget = BUDGET_SESSION_MO * 2**20
+    tailles = tailles_session(memoire)
+    if sum(tailles.values()) > budget:
+        # on lâche d'abord ce qui se recalcule (fichiers encodés), puis on prévient
+        memoire.encodages.clear()
+        tailles = tailles_session(memoire)
+    registre.declarer(ctx.session_id, memoire, tailles) # fin du run
+    registre.liberer(ORDRE_EVICTION, sauf=ctx.session_id)
+    total, n_sessions, par_cle = registre.totaux()
+    utilise = sum(tailles.values())
+    with st.sidebar:
+        st.header("🧮 Mémoire")
+        st.caption(f"Cette session : {utilise / 2**20:.0f} / {BUDGET_SESSION_MO} Mo")
+        if utilise > budget:
+            st.warning("Budget mémoire de la session dépassé : rechargez une image plus petite ou réinitialisez.")
+        st.caption(f"Toutes les sessions ({n_sessions}) : {total / 2**20:.0f} / {registre.budget_octets / 2**20:.0f} Mo - {registre.evictions} libération(s)")
+        with st.expander("Détail par clé (session / toutes)"):
+            for cle in ORDRE_EVICTION:
+                st.caption(f"`{cle}` : {tailles[cle] / 2**20:.1f} / {par_cle.get(cle, 0) / 2**20:.1f} Mo")
+
+def afficher_etapes():
+    """Panneau des mesures par étape (option du panneau de débogage)."""
+    if not afficher_mesures:
+        return
+    with st.sidebar:
+        st.header("⏱️ Étapes")
+        # tracemalloc est commun à toutes les sessions du serveur : une session ne le démarre pas
+        st.caption("CPU : temps du thread de la session (sans les threads d'onnxruntime). Pic mémoire : non mesuré dans le serveur.")
+        if not st.session_state.etapes:
+            st.caption("Aucune mesure : chargez, détourez ou téléchargez une image.")
+            return
+        st.dataframe(stage_totals(st.session_state.etapes))
+        with st.expander("Dernières mesures"):
+            st.dataframe(spans_frame(st.session_state.etapes[::-1]), hide_index=True)
+        if st.button("Effacer les mesures"):
+            st.session_state.etapes = []
+
+def traiter_lot(fichiers, travailleurs):
+    """Détoure toutes les images (et images des ZIP) vers une archive ZIP gardée dans le session state."""
+    entrees = entrees_lot([(f.name, f.getvalue()) for f in fichiers])
+    if not entrees:
+        st.warning("Aucune image trouvée (png, jpg, jpeg, webp).")
+        return
+    # une seule session pour le lot, threads onnxruntime répartis entre les images traitées en parallèle
+    session = sessions_rembg.get(modele, intra_threads or max(1, THREADS_MAX // travailleurs), inter_threads)
+    progression = st.progress(0.0, text=f"0/{len(entrees)} images")
+    erreurs = []
+    etapes = [] # mesures des images, complétées par les threads du lot
+    debut = time.perf_counter()
+    with tempfile.SpooledTemporaryFile(max_size=64 * 2**20) as archive:
+        with zipfile.ZipFile(archive, "w") as zf:
+            for n, (nom, data, erreur) in enumerate(detourer_lot(entrees, session, travailleurs, mode_inference, cote_inference, format_sortie, niveau_compression, etapes), start=1):
+                if erreur is not None:
+                    erreurs.append(f"{nom} : {erreur}")
+                else:
+                    zf.writestr(nom, data) # écrit dans l'archive dès que l'image est prête
+                duree = time.perf_counter() - debut
+                progression.progress(n / len(entrees), text=f"{n}/{len(entrees)} images - {nom} - {n / duree:.2f} images/s")
+        archive.seek(0)
+        memoire.lot_zip = archive.read()
+    duree = time.perf_counter() - debut
+    garder_etapes(etapes) # déjà écrites au journal par detourer_lot
+    st.session_state.lot_resume = f"{len(entrees) - len(erreurs)}/{len(entrees)} images en {duree:.1f} s ({len(entrees) / duree:.2f} images/s, {travailleurs} en parallèle)"
+    st.session_state.lot_erreurs = erreurs
+
+def afficher_lot():
+    st.header("Détourage par lot")
+    fichiers = st.file_uploader(
+        "Choisissez des images ou des archives ZIP...",
+        type=["png", "jpg", "jpeg", "webp", "zip"],
+        accept_multiple_files=True,
+        key="uploader_lot"
+    )
+    travailleurs = st.number_input("Images traitées en parallèle", min_value=1, max_value=max(THREADS_MAX, 1) * 2, value=TRAVAILLEURS_LOT_DEFAUT)
+    if fichiers and st.button("🚀 Détourer le lot", use_container_width=True):
+        memoire.lot_zip = None
+        memoire.lot_libere = False
+        traiter_lot(fichiers, travailleurs)
+    if memoire.lot_libere:
+        st.info("Archive du lot libérée pendant l'inactivité de la session (mémoire du serveur) : relancez le lot.")
+    if memoire.lot_zip:
+        st.success(st.session_state.lot_resume)
+        for erreur in st.session_state.lot_erreurs:
+            st.error(erreur)
+        st.download_button(
+            label="📥 Télécharger toutes les images (ZIP)",
+            data=memoire.lot_zip,
+            file_name="images_detourees.zip",
+            mime="application/zip",
+            use_container_width=True
+        )
 
 # --- Interface Principale ---
 st.title("✂️🎨 Éditeur d'arrière-plan IA (avec/sans retouche)")
+mode_app = st.radio("Mode", ["Image unique", "Lot (plusieurs images / ZIP)"], horizontal=True)
+if mode_app != "Image unique":
+    afficher_lot()
+    gerer_memoire()
+    afficher_etapes()
+    st.stop()
 st.markdown(
     "1. **Chargez** votre image.\n"
     "2. **Lancez** le détourage IA.\n"
@@ -96,24 +396,37 @@ with col1:
     
     if uploaded_file is not None:
         st.session_state.file_name = uploaded_file.name
-        if uploaded_file.getvalue() != st.session_state.get('original_bytes', None):
-            st.session_state.original_bytes = uploaded_file.getvalue()
-            original_pil = Image.open(io.BytesIO(st.session_state.original_bytes))
-            st.session_state.original_image = ImageOps.exif_transpose(original_pil).convert("RGBA")
-            st.session_state.processed_image = None
-            st.session_state.final_image = None
-            
-        st.image(st.session_state.original_image, caption="Image Originale", use_column_width=True)
-        
-        if st.button("🚀 Lancer le détourage IA", use_container_width=True):
-            process_image(st.session_state.original_bytes)
-            st.session_state.final_image = None 
+        if uploaded_file.getvalue() != memoire.get("original_bytes", None):
+            memoire.original_bytes = uploaded_file.getvalue()
+            memoire.oublier_liberees() # les clés libérées de l'image précédente ne sont plus à refaire
+            # les images précédentes sont libérées avant de décoder la nouvelle
+            memoire.original_image = None
+            memoire.processed_image = None
+            memoire.final_image = None
+            oublier_anciens_resultats()
+            with mesure("ouverture"):
+                memoire.original_image = ouvrir_originale(memoire.original_bytes)
+
+        if memoire.original_image is None:
+            st.error(f"Image trop grande pour le budget mémoire d'une session ({BUDGET_SESSION_MO} Mo).")
+        else:
+            if isinstance(memoire.original_image, ImageCompacte):
+                w, h = memoire.original_image.size
+                st.caption(f"Grande image ({w * h / 1e6:.0f} MP) : stockage compact, masque calculé sur une copie réduite.")
+            st.image(image_apercu("original", memoire.original_image), caption="Image Originale", use_column_width=True)
+
+            if st.button("🚀 Lancer le détourage IA", use_container_width=True):
+                process_image(memoire.original_bytes)
+                memoire.final_image = None 
+
+# --- Libère les résultats des images remplacées ---
+oublier_anciens_resultats()
 
 # --- Colonne 2 : Résultat (avec Onglets) ---
 with col2:
     st.header("Étape 2 : Résultat")
     
-    if st.session_state.processed_image is None:
+    if memoire.processed_image is None:
         st.info("Le résultat du détourage apparaîtra ici.")
     else:
         # --- CRÉATION DES ONGLETS ---
@@ -124,24 +437,21 @@ with col2:
             st.subheader("Résultat IA simple")
             st.info("Voici le résultat brut de l'IA. Rapide et simple.")
             
-            st.image(st.session_state.processed_image, caption="Arrière-plan supprimé (IA)", use_column_width=True)
+            st.image(image_apercu("processed", memoire.processed_image), caption="Arrière-plan supprimé (IA)", use_column_width=True)
             
-            st.download_button(
-                label="📥 Télécharger le résultat (PNG)",
-                data=image_to_bytes(st.session_state.processed_image),
-                file_name=f"{st.session_state.file_name.split('.')[0]}_ia.png",
-                mime="image/png",
-                use_container_width=True
-            )
+            bouton_telechargement("processed", memoire.processed_image, "📥 Télécharger le résultat", "ia")
 
         # --- Onglet 2 : Version Retouche (v5) ---
         with tab2:
             st.subheader("Outil de Retouche Manuelle")
-            st.info("🎨 **Peignez en ROUGE** sur l'image pour marquer les zones à restaurer (ex: texte manquant).")
+            st.info("🎨 **Peignez en ROUGE** sur l'image pour marquer les zones à restaurer (ex: texte manquant), **en BLEU** pour effacer (fond resté). "
+                    "Les flèches ↶ ↷ du canevas annulent / rétablissent un trait : « Appliquer » ne recalcule que les traits ajoutés ou retirés.")
+            pinceau = st.radio("Pinceau", ["Restaurer (rouge)", "Effacer (bleu)"], horizontal=True)
+            couleur_trait = "rgba(255, 0, 0, 0.7)" if pinceau.startswith("Restaurer") else "rgba(0, 0, 255, 0.7)"
             
             # Calcul de la taille du canvas
-            width_orig = st.session_state.processed_image.width
-            height_orig = st.session_state.processed_image.height
+            width_orig = memoire.processed_image.width
+            height_orig = memoire.processed_image.height
             max_width = 700
             if width_orig > max_width:
                 ratio = max_width / width_orig
@@ -151,11 +461,12 @@ with col2:
                 width_canvas = width_orig
                 height_canvas = height_orig
 
+            from streamlit_drawable_canvas import st_canvas # importé seulement quand le canevas s'affiche
             canvas_result = st_canvas(
                 fill_color="rgba(255, 0, 0, 0.3)",
                 stroke_width=20,
-                stroke_color="rgba(255, 0, 0, 0.7)", # Crayon ROUGE
-                background_image=st.session_state.processed_image, # L'image de l'IA va ici
+                stroke_color=couleur_trait, # Crayon ROUGE (restaurer) ou BLEU (effacer)
+                background_image=image_apercu("processed", memoire.processed_image), # L'image de l'IA (aperçu) va ici
                 update_streamlit=False,
                 height=height_canvas,
                 width=width_canvas,
@@ -165,31 +476,31 @@ with col2:
 
             # Bouton d'application
             if st.button("Appliquer la retouche", use_container_width=True):
-                if canvas_result.image_data is not None:
-                    with st.spinner("Application de la retouche..."):
-                        mask_drawing_np_resized = canvas_result.image_data[:, :, 3] > 0
-                        mask_restore_np_resized = (mask_drawing_np_resized * 255).astype('uint8')
-                        mask_restore_pil = Image.fromarray(mask_restore_np_resized, 'L')
-                        original_size = st.session_state.processed_image.size
-                        mask_restore_pil_original_size = mask_restore_pil.resize(original_size, Image.Resampling.NEAREST)
-                        mask_restore_np = np.array(mask_restore_pil_original_size)
-                        alpha_rembg_np = np.array(st.session_state.processed_image.split()[3])
-                        final_alpha_np = np.maximum(alpha_rembg_np, mask_restore_np)
-                        final_image = st.session_state.original_image.copy()
-                        final_image.putalpha(Image.fromarray(final_alpha_np, 'L'))
-                        st.session_state.final_image = final_image
+                traits = traits_canevas(canvas_result.json_data)
+                moteur = memoire.get("moteur_retouche")
+                if moteur is not None and moteur[0] is not memoire.processed_image:
+                    moteur = None
+                if traits or moteur is not None:
+                    with st.spinner("Application de la retouche..."), mesure("retouche"):
+                        # moteur (image résultat + historique des traits) créé une fois par image détourée, puis modifié sur place
+                        if moteur is None:
+                            moteur = (memoire.processed_image, MoteurRetouche(memoire.processed_image, memoire.original_image))
+                            memoire.moteur_retouche = moteur
+                        memoire.final_image = moteur[1].synchroniser(traits, (width_canvas, height_canvas))
+                        image_modifiee("final") # même objet image, contenu changé
                 else:
                     st.warning("Vous n'avez rien dessiné.")
             
-            if st.session_state.final_image is not None:
+            if memoire.final_image is not None:
                 st.divider()
                 st.subheader("Aperçu Final Retouché")
-                st.image(st.session_state.final_image, caption="Résultat retouché", use_column_width=True)
-
-                st.download_button(
-                    label="📥 Télécharger le résultat final (PNG)",
-                    data=image_to_bytes(st.session_state.final_image),
-                    file_name=f"{st.session_state.file_name.split('.')[0]}_retouched.png",
-                    mime="image/png",
-                    use_container_width=True
-                )
+                moteur = memoire.get("moteur_retouche")
+                if moteur is not None:
+                    st.caption(f"{len(moteur[1].traits)} trait(s) appliqué(s), {len(moteur[1].annules)} à rétablir - historique : {moteur[1].octets_historique() / 1024:.0f} Ko")
+                st.image(image_apercu("final", memoire.final_image), caption="Résultat retouché", use_column_width=True)
+
+                bouton_telechargement("final", memoire.final_image, "📥 Télécharger le résultat final", "retouched")
+
+# --- Mémoire de la session (et des autres) ---
+gerer_memoire()
+afficher_etapes()
@@ -6,109 +6,15 @@ Edited on Wed Aug 13 09:23:44 2025
 Edited to to process multiple raspi files at once
 """
 
-import numpy as np
-import pandas as pd
+import os
 import streamlit as st
-from io import BytesIO
-import zipfile
 
-
-# =========================
-# Existing functions (unchanged)
-# =========================
-
-def calc_mean_pressures(csv_file):
-    df_raw = pd.read_csv(csv_file, sep=",", header=0, index_col=0, engine='python') # read csv
-    calib_corr_df = df_raw.loc["calibration correction mbar"]
-    sensor_heights_df = df_raw.loc["sensor height"] # store height data
-    df_data_raspi = df_raw.drop(labels=["sensor number","sensor range","sensor height","calibration correction mbar"], axis=0) # drop non-pressure rows
-
-    # calculate mean values of pressure values and convert to df
-    p_mean = df_data_raspi.mean().to_frame() # mean values of measured an corrected (auto calib) values
-    p_std = df_data_raspi.std().to_frame() # mean values of measured an corrected (auto calib) values
-    p_mean_not_corr = (df_data_raspi.mean()+calib_corr_df).to_frame() # mean values of measured values (not corrected)
-
-    # merge dfs
-    df_out = pd.merge(sensor_heights_df, p_mean, left_index=True, right_index=True) # add heights
-    df_out = pd.merge(df_out, p_std, left_index=True, right_index=True) # add std
-    df_out = pd.merge(df_out, p_mean_not_corr, left_index=True, right_index=True) # add calib corr
-    df_out.columns = ["h/m", "p_mean/mbar", "p_std/mbar", "p_mean_not_corr/mbar"]
-    # sort according to name
-    df_out["index"] = df_out.index
-    df_out = df_out.drop(["gm_ZR", "gm_ZL"])
-    df_out["sort1"] = df_out['index'].str.extract(r'([a-zA-Z]*)')
-    df_out["sort2"] = df_out['index'].str.extract('(\d+)', expand=False).astype(int)
-    df_out = df_out.sort_values(['sort1', 'sort2'], ascending=[True, True])
-    df_out = df_out.drop(labels=["index","sort1","sort2"], axis=1)
-    
-    return df_out, df_data_raspi
-
-
-def gm_signal_to_Vdot(time_array, signal_array):
-    pulses = signal_array - np.roll(signal_array, 1) # extract signal changes (pulses)
-    pulses_ind = np.where(pulses[1:] > 30)[0] + 1 # extract indexes of positive (ramp-up) signal changes
-    pulse_times = time_array[pulses_ind] # get timestamps from pulses
-    pulse_dts = pulse_times[1:] - pulse_times[:-1] # get time intervals between pulses
-    pulse_dt_glob = sum(pulse_dts) # get time intervall between first and last pulse
-    V_dots = (0.1 / pulse_dts * 3600) # V_dot measurements (m^3/h) from pulses
-    V_dot_mean = V_dots.mean() # mean V_dot (m^3/h) from pulses
-    V_dot_std = V_dots.std() # std from V_dots (m^3/h)
-    n_V_dot = V_dots.size # number of V_dot measurements
-    V_dot_glob = len(pulse_dts) * 0.1 / pulse_dt_glob * 3600 # mean V_dot (m^3/h) from first and last pulse
-    return V_dots, V_dot_mean, V_dot_std, n_V_dot, V_dot_glob
-    
-
-
-def calc_Vdots_out(df_in):
-    # adjust timestamps (index of df_in) to start with 0
-    time_array_str = list(df_in.index)
-    time_array = np.zeros(len(time_array_str))
-    for i,timestr in enumerate(time_array_str):
-        time_array[i] = sum([a*b for a,b in zip([3600,60,1], map(float,timestr.split(" ")[1].split(':')))])
-    df_in["t_tot"] = time_array
-    time_array = time_array-time_array[0]
-    df_in.index = time_array  
-    df_out = df_in
-    time_array = np.array(time_array)
-    
-    # gm ZR
-    gm_zr_signal = np.array(list(df_out["gm_ZR"])) # signal
-    V_dots_CR, V_dot_CR_mean, V_dot_CR_std, n_V_dot_CR, V_dot_CR_glob = gm_signal_to_Vdot(time_array, gm_zr_signal)
-    
-    # gm ZL
-    gm_zl_signal = np.array(list(df_out["gm_ZL"])) # signal
-    V_dots_GR, V_dot_GR_mean, V_dot_GR_std, n_V_dot_GR, V_dot_GR_glob = gm_signal_to_Vdot(time_array, gm_zl_signal) 
-    # stats dataframe
-    df_Vdot_stats = pd.DataFrame(index =['Vdot_mean / m^3/h', 'Vdot_std / m^3/h', 'n_V_dot / -', 'V_dot_glob / m^3/h'])
-    df_Vdot_stats["CR"] = [V_dot_CR_mean, V_dot_CR_std, n_V_dot_CR, V_dot_CR_glob]
-    df_Vdot_stats["GR"] = [V_dot_GR_mean, V_dot_GR_std, n_V_dot_GR, V_dot_GR_glob]
-    # all Vdots dataframe
-    df_V_dots = pd.DataFrame()
-    df_V_dots["CR"] = V_dots_CR
-    df_V_dots["GR"] = pd.Series(V_dots_GR)
-    
-    return df_out, df_Vdot_stats, df_V_dots
-
-
-def extract_gasAnalyser_section(df_GM_raw, t_start_tot, t_end_tot):
-    time_array_str = list(df_GM_raw["t"])
-    time_array = np.zeros(len(time_array_str))
-    for i,timestr in enumerate(time_array_str):
-        time_array[i] = sum([a*b for a,b in zip([3600,60,1], map(float,timestr.split(':')))])
-    # time_array = time_array-time_array[0]
-    df_GM_raw["t_tot"] = time_array
-    df_GM = df_GM_raw[df_GM_raw["t_tot"] > t_start_tot]
-    df_GM = df_GM[df_GM["t_tot"] < t_end_tot]
-    
-    return df_GM
-
-
-def calc_gasAnalyser_stats(df_GM):
-    CO2_mean = df_GM["CO2"].mean()
-    CO2_std = df_GM["CO2"].std()
-    CO2_min = df_GM["CO2"].min()
-    CO2_max = df_GM["CO2"].max()
-    return [CO2_mean, CO2_std, CO2_min, CO2_max]
+from cfm_core import parse_time_seconds
+from cfm_batch import run_batch, PROFILE_APP, DEFAULT_WORKERS
+from cfm_export import RAW_EXPORT_MODES, ZipStream
+from cfm_cache import gasAnalyser_log_cached
+from cfm_spans import SpanRecorder, log_spans, spans_frame, stage_totals
+from cfm_resources import get_result_cache # one cache per server process, shared by all sessions and pages
 
 
 # =========================
@@ -116,6 +22,7 @@ def calc_gasAnalyser_stats(df_GM):
 # =========================
 
 st.header("CFM data processing")
+cache = get_result_cache()
 
 # --- Uploader MULTI-CSV (multiple files) ---
 csv_files_raspi = st.file_uploader(
@@ -129,142 +36,102 @@ txt_file_gasMeas_CR = st.file_uploader("Import raw data from gas analyser (CR)",
 txt_file_gasMeas_GR = st.file_uploader("Import raw data from gas analyser (GR)", key="upload_gasAnal_GR")
 timestamps_manual = st.checkbox("Define end - and start-time manually (for gas analyser data extraction)", value=False)
 
-# Read logs only once (otherwise, in a loop, file pointers arrive at the end of the file)
-df_GM_CR_raw_global = None
-df_GM_GR_raw_global = None
+# Read and index logs only once (timestamps parsed once, windows found by binary search for every CSV; cached across reruns)
+gm_log_CR = None
+gm_log_GR = None
 
 if txt_file_gasMeas_CR is not None:
-    df_GM_CR_raw_global = pd.read_csv(txt_file_gasMeas_CR, sep="\t", header=0, index_col=None, engine='python') # read txt
-    df_GM_CR_raw_global = df_GM_CR_raw_global[["Time", "Ch1:Conce:Vol%"]]
-    df_GM_CR_raw_global.columns = ["t", "CO2"]
-    df_GM_CR_raw_global["CO2"] = df_GM_CR_raw_global["CO2"]/100
-    df_GM_CR_raw_global["CO2"] = df_GM_CR_raw_global["CO2"].round(9)
+    gm_log_CR = gasAnalyser_log_cached(cache, txt_file_gasMeas_CR.getvalue(), "CR") # read txt
 
 if txt_file_gasMeas_GR is not None:
-    df_GM_GR_raw_global = pd.read_csv(txt_file_gasMeas_GR, sep="\t", header=0, index_col=None, engine='python') # read txt
-    df_GM_GR_raw_global = df_GM_GR_raw_global[["Time", "Ch2:Conce:ppm"]]
-    df_GM_GR_raw_global.columns = ["t", "CO2"]
-    df_GM_GR_raw_global["CO2"] = df_GM_GR_raw_global["CO2"]/(10**6)
-    df_GM_GR_raw_global["CO2"] = df_GM_GR_raw_global["CO2"].round(9)
+    gm_log_GR = gasAnalyser_log_cached(cache, txt_file_gasMeas_GR.getvalue(), "GR") # read txt
 
 # If manual timestamps are requested, enter them here (default values as in your code: lines 20 and -20 of the GR)
 t_start_tot_manual = None
 t_end_tot_manual = None
-if timestamps_manual and df_GM_GR_raw_global is not None and len(df_GM_GR_raw_global) >= 40:
-    t_start_str = st.text_input("start-time", value=df_GM_GR_raw_global.iloc[20]["t"])
-    t_end_str = st.text_input("end-time", value=df_GM_GR_raw_global.iloc[-20]["t"])
-    t_start_tot_manual = sum([a*b for a,b in zip([3600,60,1], map(float,t_start_str.split(':')))])
-    t_end_tot_manual = sum([a*b for a,b in zip([3600,60,1], map(float,t_end_str.split(':')))])
-
-# Containers to group Excel files by type
-raspi_only_files = []
-extended_files = []
-
-# --- Multi-CSV processing ---
+if timestamps_manual and gm_log_GR is not None and len(gm_log_GR.df) >= 40:
+    t_start_str = st.text_input("start-time", value=gm_log_GR.df.iloc[20]["t"])
+    t_end_str = st.text_input("end-time", value=gm_log_GR.df.iloc[-20]["t"])
+    t_start_tot_manual, t_end_tot_manual = parse_time_seconds([t_start_str, t_end_str]) # end after midnight -> +24 h
+
+n_workers = st.sidebar.number_input("Parallel workers (processes)", min_value=1, max_value=os.cpu_count() or 1, value=DEFAULT_WORKERS)
+raw_export = st.sidebar.selectbox("Raw RaPi data", list(RAW_EXPORT_MODES), format_func=RAW_EXPORT_MODES.get)
+st.sidebar.caption(f"Result cache: {len(cache)} entries, {cache.nbytes / 2**20:.0f} / {cache.max_bytes / 2**20:.0f} MB")
+show_spans = st.sidebar.checkbox("Show stage timings", value=False)
+trace_memory = show_spans and st.sidebar.checkbox("Measure peak memory per stage (slower)", value=False)
+app_spans = SpanRecorder(app="app") # stages of this run outside the per-file pipeline (zip, recap)
+spans = []
+
+# Archives to group Excel files by type (each workbook is written in as soon as it is produced)
+raspi_only_files = ZipStream()
+extended_files = ZipStream()
+
+# --- Multi-CSV processing (one process per file, see cfm_batch.process_raspi_file) ---
 if csv_files_raspi:
-    for csv_file_raspi in csv_files_raspi:
-
-        # ========== 1) "RaPi only" calculation (identical to the original) ==========
-        df_p, df_data_raspi = calc_mean_pressures(csv_file_raspi)
-        df_data_raspi, df_Vdot_stats, df_Vdots = calc_Vdots_out(df_data_raspi)
-
-        # Excel RaPi creation only (identical sheets)
-        output_raspi = BytesIO()
-        writer = pd.ExcelWriter(output_raspi, engine = 'xlsxwriter')
-        df_p.to_excel(writer, sheet_name="p_mean", float_format="%.5f", startrow=0, index=True)
-        df_Vdot_stats.to_excel(writer, sheet_name="Vdot_stats", float_format="%.5f", startrow=0, index=True)
-        df_Vdots.to_excel(writer, sheet_name="Vdot_raw", float_format="%.5f", startrow=0, index=True)
-        df_data_raspi.to_excel(writer, sheet_name="RasPi", float_format="%.5f", startrow=0, index=True)
-        writer.close()
-        raspi_only_files.append((f'cfm_analysis_{csv_file_raspi.name.split(".")[0]}.xlsx', output_raspi.getvalue()))
-
-        # ========== 2) "Extended" calculation (identical to the original) ==========
-        # Cas CR + GR
-        if (df_GM_CR_raw_global is not None) and (df_GM_GR_raw_global is not None):
-            if timestamps_manual and (t_start_tot_manual is not None) and (t_end_tot_manual is not None):
-                t_start_tot = t_start_tot_manual
-                t_end_tot = t_end_tot_manual
+    files = [(f.name, f.getvalue()) for f in csv_files_raspi]
+    t_window = None
+    if timestamps_manual and (t_start_tot_manual is not None) and (t_end_tot_manual is not None):
+        t_window = (t_start_tot_manual, t_end_tot_manual)
+
+    results = [None] * len(files)
+    progress = st.progress(0.0, text=f"0/{len(files)} files processed")
+    with app_spans.span("batch", files=len(files)):
+        for n_done, (i, result, error) in enumerate(run_batch(files, gm_log_CR, gm_log_GR, {**PROFILE_APP, "raw_export": raw_export}, t_window, n_workers, cache, trace_memory, {"app": "app"}), start=1):
+            if error is not None:
+                st.error(f"{files[i][0]} could not be processed: {error}") # other files are kept
             else:
-                t_start_tot = df_data_raspi.iloc[0]["t_tot"]
-                t_end_tot = df_data_raspi.iloc[-1]["t_tot"]
-
-            df_GM_CR = extract_gasAnalyser_section(df_GM_CR_raw_global.copy(), t_start_tot, t_end_tot)
-            df_GM_GR = extract_gasAnalyser_section(df_GM_GR_raw_global.copy(), t_start_tot, t_end_tot)
-
-            GM_CR_stats = calc_gasAnalyser_stats(df_GM_CR)
-            GM_GR_stats = calc_gasAnalyser_stats(df_GM_GR)
-            df_GM_stats = pd.DataFrame(index =['CO2_mean / mol/mol', 'CO2_std / mol/mol', 'CO2_min / mol/mol', 'CO2_max / mol/mol'])
-            df_GM_stats["CR"] = GM_CR_stats
-            df_GM_stats["GR"] = GM_GR_stats
-
-            output_ext = BytesIO()
-            writer = pd.ExcelWriter(output_ext, engine = 'xlsxwriter')
-            df_p.to_excel(writer, sheet_name="p_mean", float_format="%.5f", startrow=0, index=True)
-            df_Vdot_stats.to_excel(writer, sheet_name="Vdot_stats", float_format="%.5f", startrow=0, index=True)
-            df_Vdots.to_excel(writer, sheet_name="Vdot_raw", float_format="%.5f", startrow=0, index=True)
-            df_GM_stats.to_excel(writer, sheet_name="CO2_stats", float_format="%.9f", startrow=0, index=True)
-            df_GM_CR.to_excel(writer, sheet_name="CO2_CR", float_format="%.9f", startrow=0, index=True)
-            df_GM_GR.to_excel(writer, sheet_name="CO2_GR", float_format="%.9f", startrow=0, index=True)
-            df_data_raspi.to_excel(writer, sheet_name="RasPi", float_format="%.5f", startrow=0, index=True)
-            writer.close()
-            extended_files.append((f'cfm_analysis_extended_{csv_file_raspi.name.split(".")[0]}.xlsx', output_ext.getvalue()))
-
-        #GR case only (identical to the original)
-        elif (df_GM_CR_raw_global is None) and (df_GM_GR_raw_global is not None):
-            if timestamps_manual and (t_start_tot_manual is not None) and (t_end_tot_manual is not None):
-                t_start_tot = t_start_tot_manual
-                t_end_tot = t_end_tot_manual
-            else:
-                t_start_tot = df_data_raspi.iloc[0]["t_tot"]
-                t_end_tot = df_data_raspi.iloc[-1]["t_tot"]
-
-            df_GM_GR = extract_gasAnalyser_section(df_GM_GR_raw_global.copy(), t_start_tot, t_end_tot)
-
-            GM_GR_stats = calc_gasAnalyser_stats(df_GM_GR)
-            df_GM_stats = pd.DataFrame(index =['CO2_mean / mol/mol', 'CO2_std / mol/mol', 'CO2_min / mol/mol', 'CO2_max / mol/mol'])
-            df_GM_stats["GR"] = GM_GR_stats
-
-            output_ext = BytesIO()
-            writer = pd.ExcelWriter(output_ext, engine = 'xlsxwriter')
-            df_p.to_excel(writer, sheet_name="p_mean", float_format="%.5f", startrow=0, index=True)
-            df_Vdot_stats.to_excel(writer, sheet_name="Vdot_stats", float_format="%.5f", startrow=0, index=True)
-            df_Vdots.to_excel(writer, sheet_name="Vdot_raw", float_format="%.5f", startrow=0, index=True)
-            df_GM_stats.to_excel(writer, sheet_name="CO2_stats", float_format="%.9f", startrow=0, index=True)
-            df_GM_GR.to_excel(writer, sheet_name="CO2_GR", float_format="%.9f", startrow=0, index=True)
-            df_data_raspi.to_excel(writer, sheet_name="RasPi", float_format="%.5f", startrow=0, index=True)
-            writer.close()
-            extended_files.append((f'cfm_analysis_extended_{csv_file_raspi.name.split(".")[0]}.xlsx', output_ext.getvalue()))
-
-        # If CR alone without GR -> no extended (unchanged behavior with respect to your code)
-        # Minimal display (optional)
-        st.dataframe(df_p)
-        st.dataframe(df_Vdot_stats)
+                raspi_only_files.add(*result["raspi_only"], index=i) # zip entries in upload order
+                if result["raw_file"] is not None: # csv/parquet instead of the RasPi sheet
+                    raspi_only_files.add(*result["raw_file"], index=i)
+                # If CR alone without GR -> no extended (unchanged behavior with respect to your code)
+                if result["extended"] is not None:
+                    extended_files.add(*result["extended"], index=i)
+                    if result["raw_file"] is not None:
+                        extended_files.add(*result["raw_file"], index=i)
+                results[i] = (result["df_p"], result["df_Vdot_stats"]) # workbooks are not kept here
+                spans += result["spans"]
+            raspi_only_files.done(i)
+            extended_files.done(i)
+            progress.progress(n_done / len(files), text=f"{n_done}/{len(files)} files processed")
+
+    # Minimal display (optional), upload order
+    for result in results:
+        if result is not None:
+            st.dataframe(result[0])
+            st.dataframe(result[1])
 
 # ------------------------
 # ZIP Download
 # ------------------------
 if raspi_only_files:
-    zip_buffer_raspi = BytesIO()
-    with zipfile.ZipFile(zip_buffer_raspi, "w") as zf:
-        for fname, fdata in raspi_only_files:
-            zf.writestr(fname, fdata)
+    with app_spans.span("zip", file="results_raspi_only.zip"):
+        zip_data = raspi_only_files.getvalue()
     st.download_button(
         label="Download all the results (RasPi seul)",
-        data=zip_buffer_raspi.getvalue(),
+        data=zip_data,
         file_name="results_raspi_only.zip",
         mime="application/zip"
     )
 
 if extended_files:
-    zip_buffer_ext = BytesIO()
-    with zipfile.ZipFile(zip_buffer_ext, "w") as zf:
-        for fname, fdata in extended_files:
-            zf.writestr(fname, fdata)
+    with app_spans.span("zip", file="results_extended.zip"):
+        zip_data = extended_files.getvalue()
     st.download_button(
         label="Download all the results (étendu)",
-        data=zip_buffer_ext.getvalue(),
+        data=zip_data,
         file_name="results_extended.zip",
         mime="application/zip"
     )
 
+# ------------------------
+# Stage timings (opt-in)
+# ------------------------
 
+log_spans(app_spans.records) # per-file spans were logged by run_batch
+spans += app_spans.records
+if show_spans and spans:
+    with st.sidebar:
+        st.subheader("Stage timings")
+        st.dataframe(stage_totals(spans))
+        with st.expander("Per file and stage"):
+            st.dataframe(spans_frame(spans), hide_index=True)
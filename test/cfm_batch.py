@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Per-file CFM pipeline (RaPi csv -> Excel workbooks) and a process-pool batch runner
+"""
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from cfm_cache import content_hash
+from cfm_core import load_raspi_csv, calc_pressure_stats, calc_Vdots_out, calc_raspi_stream, extract_gasAnalyser_section, calc_gasAnalyser_stats
+from cfm_export import prepare_sheet, write_workbook, export_raw_data
+from cfm_spans import recording, span, log_spans, worker_process
+
+DEFAULT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+GM_STATS_INDEX = ['CO2_mean / mol/mol', 'CO2_std / mol/mol', 'CO2_min / mol/mol', 'CO2_max / mol/mol']
+
+# what each app produces for one RaPi file
+PROFILE_APP = {
+    "raspi_only": True, # "RaPi only" workbook
+    "extended_without_GR": False, # CR log alone -> no extended workbook
+    "float_format": True, # "%.5f" / "%.9f" in the sheets
+    "recap": False,
+    "raw_export": "full", # see cfm_export.RAW_EXPORT_MODES
+    "stream": False, # read the csv chunk by chunk (exports larger than memory, raw_export "summary" only)
+}
+PROFILE_APP2 = {
+    "raspi_only": False,
+    "extended_without_GR": True,
+    "float_format": False,
+    "recap": True,
+    "raw_export": "full",
+    "stream": False,
+}
+
+
+# =========================
+# One RaPi file
+# =========================
+
+def build_recap_row(file_name, df_p, df_Vdot_stats, df_GM_stats):
+    return {
+        "File name": file_name,
+        "CO2 Mean": _cell(df_GM_stats, 0, 0), # B2
+        "CO2 Max": _cell(df_GM_stats, 3, 0), # B5
+        "dp1": _cell(df_p, 31, 1), # C33
+        "Vdot GR Mean": _cell(df_Vdot_stats, 0, 1), # C2
+    }
+
+
+def _cell(df, row, col):
+    # missing sheet cell (fewer sensors / meters) -> NaN, as in ResultStore.recap_rows
+    return df.iloc[row, col] if row < df.shape[0] and col < df.shape[1] else np.nan
+
+
+def process_raspi_stage(name, data, profile):
+    """
+    Everything that depends on the RaPi csv alone: parse, pressures, Vdot, "RaPi only" workbook.
+    data: raw bytes of the upload or a path on disk.
+    The sheets are prepared once here and reused by the extended workbook.
+    """
+    base_name = name.split(".")[0]
+    fmt = _float_formats(profile)
+    source = BytesIO(data) if isinstance(data, bytes) else data
+    if profile.get("stream"):
+        if profile["raw_export"] != "summary":
+            raise ValueError("streaming mode keeps no raw data: use raw_export 'summary'")
+        with span("stream"):
+            df_p, df_Vdot_stats, df_Vdots, t_range = calc_raspi_stream(source)
+        sheets_raw, raw_file = [], None
+    else:
+        with span("read_csv"):
+            df_meta, df_data_raspi = load_raspi_csv(source) # metadata rows + numeric body (C engine)
+        with span("pressure_stats"):
+            df_p = calc_pressure_stats(df_meta, df_data_raspi)
+        with span("timestamps_vdot"):
+            df_data_raspi, df_Vdot_stats, df_Vdots = calc_Vdots_out(df_data_raspi)
+        with span("raw_export", mode=profile["raw_export"]):
+            sheets_raw, raw_file = export_raw_data(df_data_raspi, base_name, profile["raw_export"], fmt["%.5f"])
+        t_range = (df_data_raspi.iloc[0]["t_tot"], df_data_raspi.iloc[-1]["t_tot"])
+    with span("prepare_sheets"):
+        sheets = [
+            ("p_mean", prepare_sheet(df_p, fmt["%.5f"])),
+            ("Vdot_stats", prepare_sheet(df_Vdot_stats, fmt["%.5f"])),
+            ("Vdot_raw", prepare_sheet(df_Vdots, fmt["%.5f"])),
+        ]
+    part = {
+        "df_p": df_p,
+        "df_Vdot_stats": df_Vdot_stats,
+        "t_range": t_range,
+        "sheets": sheets,
+        "sheets_raw": sheets_raw,
+        "raw_file": raw_file, # csv/parquet sidecar (raw_export mode)
+        "raspi_only": None,
+    }
+    if profile["raspi_only"]:
+        with span("excel_raspi_only"):
+            xlsx = write_workbook(part["sheets"] + sheets_raw)
+        part["raspi_only"] = (f'cfm_analysis_{base_name}.xlsx', xlsx)
+    return part
+
+
+def process_extended_stage(name, part, gm_log_CR, gm_log_GR, profile, t_window=None):
+    """
+    Gas analyser windows, extended workbook and recap row for one RaPi file (part = process_raspi_stage output).
+    t_window: (t_start_tot, t_end_tot) for the gas analyser windows, default = RaPi start/end.
+    """
+    ext = {"extended": None, "recap": None, "df_GM_stats": None}
+    if gm_log_GR is None and not (profile["extended_without_GR"] and gm_log_CR is not None):
+        return ext
+
+    base_name = name.split(".")[0]
+    t_start_tot, t_end_tot = t_window if t_window is not None else part["t_range"]
+    fmt = _float_formats(profile)
+
+    GM_stats_dict = {}
+    sheets_GM = []
+    with span("gas_windows"):
+        for channel, gm_log in (("CR", gm_log_CR), ("GR", gm_log_GR)):
+            if gm_log is not None:
+                GM_stats_dict[channel] = calc_gasAnalyser_stats(gm_log, t_start_tot, t_end_tot)
+                df_GM = extract_gasAnalyser_section(gm_log, t_start_tot, t_end_tot)
+                sheets_GM.append((f"CO2_{channel}", prepare_sheet(df_GM, fmt["%.9f"])))
+        df_GM_stats = pd.DataFrame(GM_stats_dict, index=GM_STATS_INDEX)
+
+    with span("excel_extended"):
+        xlsx = write_workbook(part["sheets"] + [("CO2_stats", prepare_sheet(df_GM_stats, fmt["%.9f"]))] + sheets_GM + part["sheets_raw"])
+    ext["extended"] = (f'cfm_analysis_extended_{base_name}.xlsx', xlsx)
+    ext["df_GM_stats"] = df_GM_stats
+    if profile["recap"]:
+        ext["recap"] = build_recap_row(f'cfm_analysis_extended_{base_name}', part["df_p"], part["df_Vdot_stats"], df_GM_stats)
+    return ext
+
+
+def process_raspi_file(name, data, gm_log_CR, gm_log_GR, profile, t_window=None, keep_sheets=False):
+    """Full pipeline for one RaPi export (name, raw bytes) -> dict with the workbooks and summary frames."""
+    part = process_raspi_stage(name, data, profile)
+    result = {"name": name, **part, **process_extended_stage(name, part, gm_log_CR, gm_log_GR, profile, t_window)}
+    if not keep_sheets:
+        del result["sheets"], result["sheets_raw"] # large, only needed to redo the extended stage
+    return result
+
+
+def recap_workbook(recap_rows):
+    """Recap rows (one per extended file) -> xlsx bytes of the global recap."""
+    recap_output = BytesIO()
+    pd.DataFrame(recap_rows).to_excel(recap_output, index=False, sheet_name="Récapitulatif")
+    return recap_output.getvalue()
+
+
+def _float_formats(profile):
+    # app2 writes full precision
+    return {f: (f if profile["float_format"] else None) for f in ("%.5f", "%.9f")}
+
+
+# =========================
+# Batch runner
+# =========================
+
+RASPI_PART_KEYS = ["df_p", "df_Vdot_stats", "t_range", "sheets", "sheets_raw", "raw_file", "raspi_only"]
+EXTENDED_PART_KEYS = ["extended", "recap", "df_GM_stats"]
+
+_worker_logs = {}
+
+
+def _init_worker(gm_log_CR, gm_log_GR, trace_memory=False):
+    # analyser logs are sent once per worker, not once per file
+    _worker_logs["CR"] = gm_log_CR
+    _worker_logs["GR"] = gm_log_GR
+    worker_process(trace_memory) # process CPU time and peak allocation of each span (cfm_spans), never in the server
+
+
+def _worker_gm_logs(gm_logs):
+    # spawned workers read the logs sent by _init_worker; the inline path passes its own (the module is shared by the sessions)
+    return gm_logs if gm_logs is not None else (_worker_logs["CR"], _worker_logs["GR"])
+
+
+def _process_in_worker(name, data, profile, t_window, keep_sheets, gm_logs=None):
+    with recording(file=name, pid=os.getpid()) as rec:
+        with span("file"):
+            result = process_raspi_file(name, data, *_worker_gm_logs(gm_logs), profile, t_window, keep_sheets)
+    result["spans"] = rec.records
+    return result
+
+
+def _extended_in_worker(name, part, profile, t_window, gm_logs=None):
+    with recording(file=name, pid=os.getpid()) as rec:
+        with span("file"):
+            result = {"name": name, **part, **process_extended_stage(name, part, *_worker_gm_logs(gm_logs), profile, t_window)}
+    result["spans"] = rec.records
+    return result
+
+
+def _cache_keys(name, data, gm_log_CR, gm_log_GR, profile, t_window):
+    profile_key = tuple(sorted(profile.items()))
+    key_raspi = ("raspi", content_hash(data), name, profile_key)
+    logs_key = tuple(None if gm_log is None else (gm_log.key or id(gm_log)) for gm_log in (gm_log_CR, gm_log_GR))
+    key_ext = ("extended", key_raspi, logs_key, None if t_window is None else tuple(float(t) for t in t_window))
+    return key_raspi, key_ext
+
+
+def run_batch(files, gm_log_CR, gm_log_GR, profile, t_window=None, max_workers=DEFAULT_WORKERS, cache=None,
+              trace_memory=False, spans_context=None):
+    """
+    Run process_raspi_file on files = [(name, bytes or path), ...] with a pool of max_workers processes.
+    Yields (i, result, error) as files finish; a failed file gives (i, None, exception) and the others go on.
+    With a cfm_cache.ResultCache (files given as bytes), files already seen with the same content (and logs / window) are not
+    recomputed, and a changed window only redoes the extended stage.
+    result["spans"] holds the stage spans of the file (empty when it came from the cache), already written to the
+    JSON log with spans_context (e.g. {"app": "app2"}) added; trace_memory adds their peak allocation, measured in
+    spawned workers only (a single worker process when max_workers is 1).
+    """
+    tasks = [] # (i, worker function, args)
+    keys = {}
+    for i, (name, data) in enumerate(files):
+        if cache is None:
+            tasks.append((i, _process_in_worker, (name, data, profile, t_window, False)))
+            continue
+        keys[i] = key_raspi, key_ext = _cache_keys(name, data, gm_log_CR, gm_log_GR, profile, t_window)
+        part, ext = cache.get(key_raspi), cache.get(key_ext)
+        if part is not None and ext is not None:
+            yield i, {"name": name, **part, **ext, "spans": []}, None
+        elif part is not None:
+            tasks.append((i, _extended_in_worker, (name, part, profile, t_window)))
+        else:
+            tasks.append((i, _process_in_worker, (name, data, profile, t_window, True)))
+
+    for i, result, error in _run_tasks(tasks, gm_log_CR, gm_log_GR, max_workers, trace_memory):
+        if error is None:
+            result["spans"] = [{**(spans_context or {}), **record} for record in result["spans"]]
+            log_spans(result["spans"])
+        if cache is not None and error is None:
+            key_raspi, key_ext = keys[i]
+            cache.put(key_raspi, {k: result[k] for k in RASPI_PART_KEYS})
+            cache.put(key_ext, {k: result[k] for k in EXTENDED_PART_KEYS})
+        yield i, result, error
+
+
+def _run_tasks(tasks, gm_log_CR, gm_log_GR, max_workers, trace_memory=False):
+    if not tasks or (max_workers <= 1 or len(tasks) <= 1) and not trace_memory:
+        # in-process: logs passed to each task, no peak allocation (the module and tracemalloc are shared by the sessions)
+        for i, fn, args in tasks:
+            try:
+                yield i, fn(*args, gm_logs=(gm_log_CR, gm_log_GR)), None
+            except Exception as e:
+                yield i, None, e
+        return
+
+    ctx = multiprocessing.get_context("spawn") # no fork of the (threaded) streamlit server
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks)), mp_context=ctx,
+                             initializer=_init_worker, initargs=(gm_log_CR, gm_log_GR, trace_memory)) as pool:
+        futures = {pool.submit(fn, *args): i for i, fn, args in tasks}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
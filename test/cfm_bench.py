@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the CFM pipeline on synthetic data, stage by stage
+
+    python cfm_bench.py --sizes 10k,100k,1M,10M --raw-export summary --out bench.jsonl
+    python cfm_bench.py --sizes 10k,100k,1M --compare bench.jsonl
+
+Synthetic RaPi exports (metadata rows, p/dp sensors, gm_ZR/gm_ZL pulse signals, 10 Hz) and
+gas analyser logs (1 Hz, Time / Ch1:Conce:Vol% / Ch2:Conce:ppm) are generated once per size in --data-dir.
+One JSON record per size is appended to --out: seconds (best of --repeat) and peak traced memory per stage.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource # not on Windows
+except ImportError:
+    resource = None
+
+from cfm_core import load_raspi_csv, calc_pressure_stats, calc_Vdots_out, read_gasAnalyser_log, GasAnalyserLog
+from cfm_batch import GM_STATS_INDEX
+from cfm_export import RAW_EXPORT_MODES, prepare_sheet, write_workbook, export_raw_data, ZipStream
+
+STAGES = ["parse", "pressure_stats", "vdot", "gas_log", "windowing", "excel", "zip"]
+RAPI_RATE_HZ = 10
+GEN_CHUNK_ROWS = 100000
+
+
+# =========================
+# Synthetic data
+# =========================
+
+def _pulse_signal(t, rng, vdot_m3h, width=0.5):
+    # gas meter contact: one pulse of `width` s every 0.1 m^3 (jittered flow), 0 / ~100 otherwise
+    n_pulses = int(t[-1] * vdot_m3h / 360) + 2
+    pulse_t = np.cumsum(360 / vdot_m3h * rng.uniform(0.9, 1.1, n_pulses)) - rng.uniform(0, 360 / vdot_m3h)
+    idx = np.searchsorted(pulse_t, t, side="right") - 1
+    high = (idx >= 0) & (t - pulse_t[np.maximum(idx, 0)] < width)
+    return np.where(high, rng.integers(95, 105, t.size), rng.integers(0, 3, t.size))
+
+
+def make_raspi_csv(path, n_rows, n_sensors=40, start="2025-02-18 10:00:00", seed=0):
+    """Write a RaPi-like export: header, 4 metadata rows, n_rows of 10 Hz data."""
+    rng = np.random.default_rng(seed)
+    names = [f"p{i}" for i in range(1, n_sensors // 2 + 1)] + [f"dp{i}" for i in range(1, n_sensors - n_sensors // 2 + 1)]
+    columns = names + ["gm_ZR", "gm_ZL"]
+    t = np.arange(n_rows) / RAPI_RATE_HZ
+    gm = {"gm_ZR": _pulse_signal(t, rng, 30.0), "gm_ZL": _pulse_signal(t, rng, 18.0)}
+    p_base = rng.uniform(-2, 5, len(names))
+    p_noise = rng.uniform(0.01, 0.2, len(names))
+    t0 = np.datetime64(start, "ms")
+
+    with open(path, "w", newline="") as f:
+        f.write("time," + ",".join(columns) + "\n")
+        f.write("sensor number," + ",".join(str(i) for i in range(1, len(columns) + 1)) + "\n")
+        f.write("sensor range," + ",".join(str(rng.choice([10, 25, 100])) for _ in columns) + "\n")
+        f.write("sensor height," + ",".join(f"{h:.3f}" for h in rng.uniform(0, 5, len(columns))) + "\n")
+        f.write("calibration correction mbar," + ",".join(f"{c:.4f}" for c in rng.normal(0, 0.05, len(columns))) + "\n")
+        for lo in range(0, n_rows, GEN_CHUNK_ROWS):
+            hi = min(lo + GEN_CHUNK_ROWS, n_rows)
+            stamps = np.datetime_as_string(t0 + np.arange(lo, hi) * (1000 // RAPI_RATE_HZ), unit="ms")
+            chunk = pd.DataFrame(p_base + p_noise * rng.standard_normal((hi - lo, len(names))), columns=names)
+            for c in gm:
+                chunk[c] = gm[c][lo:hi]
+            chunk.index = np.char.replace(stamps, "T", " ")
+            chunk.to_csv(f, header=False, float_format="%.5f", lineterminator="\n")
+    return path
+
+
+def make_gas_log(path, n_rows, start="2025-02-18 09:55:00", seed=1):
+    """Write a 1 Hz gas analyser log (tab separated, Date / Time / Ch1:Conce:Vol% / Ch2:Conce:ppm)."""
+    rng = np.random.default_rng(seed)
+    t = pd.Timestamp(start) + pd.to_timedelta(np.arange(n_rows), unit="s")
+    drift = np.cumsum(rng.normal(0, 0.002, n_rows))
+    pd.DataFrame({
+        "Date": t.strftime("%d.%m.%Y"),
+        "Time": t.strftime("%H:%M:%S"),
+        "Ch1:Conce:Vol%": (3 + drift + rng.normal(0, 0.02, n_rows)).round(3),
+        "Ch2:Conce:ppm": (450 + 100 * drift + rng.normal(0, 3, n_rows)).round(1),
+    }).to_csv(path, sep="\t", index=False)
+    return path
+
+
+def bench_data(data_dir, n_rows, n_sensors):
+    """Synthetic RaPi csv + gas log covering it (5 min margins), generated once and reused."""
+    os.makedirs(data_dir, exist_ok=True)
+    csv_path = os.path.join(data_dir, f"raspi_{n_rows}x{n_sensors}.csv")
+    gm_path = os.path.join(data_dir, f"gas_{n_rows}.txt")
+    if not os.path.exists(csv_path):
+        make_raspi_csv(csv_path + ".part", n_rows, n_sensors)
+        os.replace(csv_path + ".part", csv_path)
+    if not os.path.exists(gm_path):
+        make_gas_log(gm_path + ".part", n_rows // RAPI_RATE_HZ + 600)
+        os.replace(gm_path + ".part", gm_path)
+    return csv_path, gm_path
+
+
+# =========================
+# Timed pipeline
+# =========================
+
+class StageTimer:
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.seconds = {}
+        self.peak_bytes = {}
+
+    def run(self, stage, fn, *args):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        out = fn(*args)
+        self.seconds[stage] = time.perf_counter() - t0
+        if self.trace_memory:
+            self.peak_bytes[stage] = tracemalloc.get_traced_memory()[1] - base
+        return out
+
+
+def run_pipeline(csv_path, gm_path, raw_export="full", trace_memory=False):
+    """One file through the same steps as app.py (RaPi only + extended workbooks, both zipped)."""
+    timer = StageTimer(trace_memory)
+    df_meta, df_data_raspi = timer.run("parse", load_raspi_csv, csv_path)
+    df_p = timer.run("pressure_stats", calc_pressure_stats, df_meta, df_data_raspi)
+    df_data_raspi, df_Vdot_stats, df_Vdots = timer.run("vdot", calc_Vdots_out, df_data_raspi)
+
+    def gas_logs():
+        return [GasAnalyserLog(read_gasAnalyser_log(gm_path, channel)) for channel in ("CR", "GR")]
+
+    def windowing(gm_logs):
+        t_start_tot, t_end_tot = df_data_raspi["t_tot"].iloc[0], df_data_raspi["t_tot"].iloc[-1]
+        stats = {ch: gm_log.stats(t_start_tot, t_end_tot) for ch, gm_log in zip(("CR", "GR"), gm_logs)}
+        sections = [gm_log.section(t_start_tot, t_end_tot) for gm_log in gm_logs]
+        return pd.DataFrame(stats, index=GM_STATS_INDEX), sections
+
+    def excel():
+        sheets = [("p_mean", prepare_sheet(df_p, "%.5f")), ("Vdot_stats", prepare_sheet(df_Vdot_stats, "%.5f")),
+                  ("Vdot_raw", prepare_sheet(df_Vdots, "%.5f"))]
+        sheets_raw, raw_file = export_raw_data(df_data_raspi, "bench", raw_export, "%.5f")
+        sheets_GM = [("CO2_stats", prepare_sheet(df_GM_stats, "%.9f"))]
+        sheets_GM += [(f"CO2_{ch}", prepare_sheet(df, "%.9f")) for ch, df in zip(("CR", "GR"), sections)]
+        return write_workbook(sheets + sheets_raw), write_workbook(sheets + sheets_GM + sheets_raw), raw_file
+
+    def zip_outputs(xlsx_raspi, xlsx_ext, raw_file):
+        zs = ZipStream()
+        zs.add("cfm_analysis_bench.xlsx", xlsx_raspi)
+        zs.add("cfm_analysis_extended_bench.xlsx", xlsx_ext)
+        if raw_file is not None:
+            zs.add(*raw_file)
+        return zs.getvalue()
+
+    gm_logs = timer.run("gas_log", gas_logs)
+    df_GM_stats, sections = timer.run("windowing", windowing, gm_logs)
+    xlsx_raspi, xlsx_ext, raw_file = timer.run("excel", excel)
+    timer.run("zip", zip_outputs, xlsx_raspi, xlsx_ext, raw_file)
+    return timer
+
+
+def _max_rss_bytes():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024 # kB on Linux
+
+
+def _git_revision():
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def bench_size(n_rows, n_sensors, data_dir, repeat=3, raw_export="full", trace_memory=True):
+    """Best-of-repeat seconds per stage (+ peak traced memory from one extra traced run) for one size."""
+    csv_path, gm_path = bench_data(data_dir, n_rows, n_sensors)
+    seconds = {}
+    for _ in range(repeat):
+        timer = run_pipeline(csv_path, gm_path, raw_export)
+        for stage, s in timer.seconds.items():
+            seconds[stage] = min(s, seconds.get(stage, s))
+    peak = {}
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            peak = run_pipeline(csv_path, gm_path, raw_export, trace_memory=True).peak_bytes
+        finally:
+            tracemalloc.stop()
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "rows": n_rows,
+        "sensors": n_sensors,
+        "raw_export": raw_export,
+        "file_mb": round(os.path.getsize(csv_path) / 2**20, 2),
+        "repeat": repeat,
+        "seconds": {stage: round(seconds[stage], 6) for stage in STAGES},
+        "total_seconds": round(sum(seconds.values()), 6),
+        "peak_mb": {stage: round(peak[stage] / 2**20, 2) for stage in STAGES} if peak else None,
+        "max_rss_mb": None if _max_rss_bytes() is None else round(_max_rss_bytes() / 2**20, 1),
+    }
+
+
+# =========================
+# Reporting
+# =========================
+
+def parse_size(text):
+    text = text.strip().lower()
+    factor = {"k": 10**3, "m": 10**6}.get(text[-1], 1)
+    return int(float(text[:-1] if factor > 1 else text) * factor)
+
+
+def load_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(record, previous, tolerance):
+    """Print stage times against the last matching record of a previous run; returns the slower stages."""
+    base = [r for r in previous if (r["rows"], r["sensors"], r["raw_export"]) == (record["rows"], record["sensors"], record["raw_export"])]
+    if not base:
+        print(f"  no previous record for {record['rows']} rows")
+        return []
+    base = base[-1]
+    slower = []
+    for stage in STAGES:
+        old, new = base["seconds"][stage], record["seconds"][stage]
+        ratio = new / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > 1 + tolerance and new - old > 0.01: # ignore noise on tiny stages
+            flag = "  <- slower"
+            slower.append(stage)
+        print(f"  {stage:<15}{old:>10.3f} s -> {new:>8.3f} s  x{ratio:.2f}{flag}")
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stage-by-stage benchmark of the CFM pipeline on synthetic data.")
+    parser.add_argument("--sizes", default="10k,100k", help="RaPi rows per file, comma separated (e.g. 10k,100k,1M,10M)")
+    parser.add_argument("--sensors", type=int, default=40, help="pressure columns (default: 40)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per size, best is kept (default: 3)")
+    parser.add_argument("--raw-export", choices=list(RAW_EXPORT_MODES), default="full")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run (peak memory per stage)")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "cfm_bench_data"), help="where synthetic files are kept")
+    parser.add_argument("--out", help="append the JSON records to this file (one line per size)")
+    parser.add_argument("--compare", help="previous --out file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown flagged as regression (default: 0.2 = +20%%)")
+    args = parser.parse_args(argv)
+
+    previous = load_records(args.compare) if args.compare else None
+    regressions = []
+    for n_rows in [parse_size(s) for s in args.sizes.split(",")]:
+        record = bench_size(n_rows, args.sensors, args.data_dir, args.repeat, args.raw_export, not args.no_memory)
+        stages = ", ".join(f"{stage} {record['seconds'][stage]:.3f}" for stage in STAGES)
+        print(f"{n_rows} rows ({record['file_mb']} MB): {record['total_seconds']:.2f} s [{stages}]")
+        if record["peak_mb"]:
+            print("  peak MB: " + ", ".join(f"{stage} {mb}" for stage, mb in record["peak_mb"].items()))
+        if previous is not None:
+            regressions += [(n_rows, stage) for stage in compare(record, previous, args.tolerance)]
+        if args.out:
+            with open(args.out, "a") as f:
+                f.write(json.dumps(record) + "\n")
+    if regressions:
+        print("slower than the previous run: " + ", ".join(f"{stage} ({n} rows)" for n, stage in regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Byte-budget LRU cache for CFM results, keyed by content hashes of the uploaded files
+(streamlit reruns the whole script on every widget change: only what depends on a changed input is redone)
+"""
+
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from cfm_core import GasAnalyserLog, read_gasAnalyser_log
+
+DEFAULT_CACHE_BYTES = 1024 * 2**20 # 1 GB
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def estimate_nbytes(obj):
+    """Approximate memory held by a cached value (frames, arrays, bytes and containers of them)."""
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, dict):
+        return sum(estimate_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_nbytes(v) for v in obj)
+    if hasattr(obj, "__dict__"):
+        return estimate_nbytes(vars(obj))
+    return sys.getsizeof(obj)
+
+
+class ResultCache:
+    """Thread-safe LRU cache bounded by the estimated size of its values (not their count)."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (value, nbytes), most recent last
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        size = estimate_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return value # larger than the whole budget: not cached
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.nbytes -= old_size
+        return value
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute())
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def gasAnalyser_log_cached(cache, data, channel):
+    """GasAnalyserLog of an uploaded analyser .txt (bytes), parsed once per content."""
+    key = ("gm_log", content_hash(data), channel)
+
+    def compute():
+        return GasAnalyserLog(read_gasAnalyser_log(BytesIO(data), channel), key=key)
+
+    return cache.get_or_compute(key, compute)
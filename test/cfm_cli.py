@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Headless CFM batch processing (same pipeline as app.py / app2.py, no browser needed)
+
+    python cfm_cli.py exports/ --gm-cr CR.txt --gm-gr GR.txt --out results/
+    python cfm_cli.py "exports/*.csv" --profile app2 --zip --workers 8
+    python cfm_cli.py multi_day_run.csv --gm-gr GR.txt --stream
+    python cfm_cli.py exports/ --gm-gr GR.txt --profile app2 --store cfm_history.sqlite
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+from cfm_core import GasAnalyserLog, read_gasAnalyser_log, parse_time_seconds
+from cfm_batch import run_batch, recap_workbook, PROFILE_APP, PROFILE_APP2, DEFAULT_WORKERS
+from cfm_export import RAW_EXPORT_MODES, ZipStream
+from cfm_store import ResultStore, record_result, file_hash
+
+PROFILES = {"app": PROFILE_APP, "app2": PROFILE_APP2}
+
+# archive names used by the apps, per output kind
+ZIP_NAMES = {
+    "app": {"raspi_only": "results_raspi_only.zip", "extended": "results_extended.zip"},
+    "app2": {"extended": "extended_files.zip"},
+}
+
+
+def find_raspi_files(inputs):
+    """Directories (all .csv inside), glob patterns or file paths -> sorted list of csv paths."""
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.update(glob.glob(os.path.join(item, "*.csv")))
+        elif glob.has_magic(item):
+            paths.update(glob.glob(item))
+        else:
+            paths.add(item)
+    return sorted(paths)
+
+
+def load_gm_log(path, channel):
+    if path is None:
+        return None
+    # keyed by content like cfm_cache.gasAnalyser_log_cached: a log edited in place is a new log for the store
+    return GasAnalyserLog(read_gasAnalyser_log(path, channel), key=("gm_log", file_hash(path), channel))
+
+
+class OutputWriter:
+    """Writes each output file as soon as its RaPi file is done: into out_dir, or into one ZIP per kind."""
+
+    def __init__(self, out_dir, zip_names=None):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.zips = {kind: ZipStream(os.path.join(out_dir, name)) for kind, name in (zip_names or {}).items()}
+        self.written = set()
+        self.n_files = 0
+        self.n_bytes = 0
+
+    def add(self, kind, fname, fdata, index=None):
+        target = kind if kind in self.zips else None
+        if (target, fname) in self.written: # raw sidecar shared by both workbooks of a file
+            return
+        self.written.add((target, fname))
+        if target is not None:
+            self.zips[kind].add(fname, fdata, index) # ZIP entries in input order
+        else:
+            with open(os.path.join(self.out_dir, fname), "wb") as f:
+                f.write(fdata)
+        self.n_files += 1
+        self.n_bytes += len(fdata)
+
+    def done(self, index):
+        for zs in self.zips.values():
+            zs.done(index)
+
+    def close(self):
+        for zs in self.zips.values():
+            zs.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CFM data processing without Streamlit.")
+    parser.add_argument("inputs", nargs="+", help="RaPi .csv exports: files, directories or glob patterns")
+    parser.add_argument("--gm-cr", help="gas analyser log (CR)")
+    parser.add_argument("--gm-gr", help="gas analyser log (GR)")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="app", help="outputs as app.py or app2.py (default: app)")
+    parser.add_argument("--raw-export", choices=list(RAW_EXPORT_MODES), help="raw RaPi data in the outputs (default: full, summary with --stream)")
+    parser.add_argument("--stream", action="store_true", help="read the RaPi files chunk by chunk (exports larger than memory, summary sheets only)")
+    parser.add_argument("--start", help="start time HH:MM:SS for the gas analyser windows (default: RaPi start)")
+    parser.add_argument("--end", help="end time HH:MM:SS for the gas analyser windows (default: RaPi end)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"worker processes (default: {DEFAULT_WORKERS})")
+    parser.add_argument("--out", default="cfm_results", help="output directory (default: cfm_results)")
+    parser.add_argument("--zip", action="store_true", help="write the workbooks into ZIP archives as the apps do")
+    parser.add_argument("--store", help="also record the run summaries in this history store (SQLite); the recap is read from it")
+    args = parser.parse_args(argv)
+
+    if args.stream and args.raw_export not in (None, "summary"):
+        parser.error("--stream writes the summary sheets only (--raw-export summary)")
+    if (args.start is None) != (args.end is None):
+        parser.error("--start and --end go together")
+    t_window = None
+    if args.start is not None:
+        t_window = tuple(parse_time_seconds([args.start, args.end])) # end after midnight -> +24 h
+
+    paths = find_raspi_files(args.inputs)
+    if not paths:
+        parser.error("no RaPi .csv file found")
+    raw_export = args.raw_export or ("summary" if args.stream else "full")
+    profile = {**PROFILES[args.profile], "raw_export": raw_export, "stream": args.stream}
+
+    t0 = time.perf_counter()
+    gm_log_CR = load_gm_log(args.gm_cr, "CR")
+    gm_log_GR = load_gm_log(args.gm_gr, "GR")
+
+    files = [(os.path.basename(p), p) for p in paths] # workers read the files themselves
+    size_in = sum(os.path.getsize(p) for p in paths)
+    writer = OutputWriter(args.out, ZIP_NAMES[args.profile] if args.zip else None)
+    store = ResultStore(args.store) if args.store else None
+    recap_rows = [None] * len(files)
+    run_ids = [None] * len(files)
+    n_failed = 0
+    try:
+        for n_done, (i, result, error) in enumerate(run_batch(files, gm_log_CR, gm_log_GR, profile, t_window, args.workers), start=1):
+            if error is not None:
+                n_failed += 1
+                writer.done(i)
+                print(f"[{n_done}/{len(files)}] {paths[i]}: FAILED ({error})", file=sys.stderr)
+                continue
+            for kind in ("raspi_only", "extended"):
+                if result[kind] is not None:
+                    writer.add(kind, *result[kind], index=i)
+                    if result["raw_file"] is not None:
+                        writer.add(kind, *result["raw_file"], index=i)
+            writer.done(i)
+            recap_rows[i] = result["recap"]
+            if store is not None:
+                run_ids[i] = record_result(store, *files[i], result, gm_log_CR, gm_log_GR, t_window)
+            print(f"[{n_done}/{len(files)}] {paths[i]}")
+    finally:
+        writer.close()
+
+    if store is not None:
+        recap_rows = store.recap_rows([run_id for run_id, row in zip(run_ids, recap_rows) if row is not None])
+    recap_rows = [row for row in recap_rows if row is not None]
+    if recap_rows:
+        with open(os.path.join(args.out, "recapitulatif_global.xlsx"), "wb") as f:
+            f.write(recap_workbook(recap_rows))
+
+    elapsed = time.perf_counter() - t0
+    n_ok = len(files) - n_failed
+    print(f"{n_ok}/{len(files)} files in {elapsed:.2f} s ({args.workers} workers): "
+          f"{n_ok / elapsed:.2f} files/s, {size_in / 2**20 / elapsed:.1f} MB/s in, "
+          f"{writer.n_files} outputs ({writer.n_bytes / 2**20:.1f} MB) -> {args.out}")
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,656 @@
+# -*- coding: utf-8 -*-
+"""
+Shared processing core for the CFM apps (app.py / app2.py)
+"""
+
+import copy
+import csv
+import functools
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CSV_ENGINE = "c" # "pyarrow" is faster on multi-core hosts when installed
+
+
+# =========================
+# Time parsing
+# =========================
+
+def parse_time_seconds(time_strings, unwrap_midnight=True):
+    """
+    Vectorized "HH:MM:SS[.fff]" -> seconds, with or without a leading date ("date HH:MM:SS.fff").
+    With unwrap_midnight, a backwards jump of more than 12 h is read as a day change (+86400 s).
+    """
+    b = np.asarray(time_strings, dtype="S") # fixed-width bytes, one row per timestamp
+    if b.size == 0:
+        return np.zeros(0)
+    u = np.pad(b.view(np.uint8).reshape(b.size, -1), ((0, 0), (2, 16))) # margins for the gathers below
+    rows = np.arange(b.size)[:, None]
+    is_colon = u == ord(":")
+    if not is_colon.any(axis=1).all():
+        raise ValueError("time strings must contain HH:MM:SS")
+    c = is_colon.argmax(axis=1)[:, None] # first colon (after the hours)
+
+    def digits(offsets):
+        d = u[rows, c + offsets].astype(np.int64) - ord("0")
+        return d, (d >= 0) & (d <= 9)
+
+    d_h, ok_h = digits(np.array([-2, -1]))
+    d_ms, ok_ms = digits(np.array([1, 2, 4, 5]))
+    if not (ok_h[:, 1].all() and ok_ms.all()):
+        raise ValueError("time strings must contain HH:MM:SS")
+    hours = np.where(ok_h[:, 0], d_h[:, 0] * 10, 0) + d_h[:, 1] # "H:MM:SS" allowed
+    minutes = d_ms[:, 0] * 10 + d_ms[:, 1]
+    sec = d_ms[:, 2] * 10 + d_ms[:, 3]
+
+    # fractional part: up to 9 digits after "SS." until the first non-digit
+    d_f, ok_f = digits(np.arange(7, 16))
+    has_dot = u[rows, c + 6] == ord(".")
+    ok_f = np.cumprod(ok_f & has_dot, axis=1).astype(bool)
+    frac = np.zeros(b.size, dtype=np.int64)
+    for k in range(ok_f.shape[1]):
+        frac = np.where(ok_f[:, k], frac * 10 + d_f[:, k], frac)
+    scale = 10.0 ** ok_f.sum(axis=1)
+    # (SS*10^k + fff) / 10^k is correctly rounded, i.e. identical to float("SS.fff")
+    seconds = (hours * 3600 + minutes * 60).astype(np.float64) + (sec * scale + frac) / scale
+
+    if unwrap_midnight and seconds.size > 1:
+        day_change = np.diff(seconds) < -43200
+        seconds[1:] += 86400 * np.cumsum(day_change)
+    return seconds
+
+
+def day_shift(t_first, t_last, t_start_tot, t_end_tot):
+    """
+    Whole days (s) to add to a window so that it lands on a series' timeline. Each series is unwrapped from its own
+    first sample: a log started at 23:00 has 00:30 at 88200 s, a RaPi file started at 00:30 has it at 1800 s.
+    The shift with the largest overlap wins (the smallest one on ties, so a window outside the series is not moved).
+    """
+    if t_first is None or t_last is None:
+        return 0.0
+    k_min = int(np.ceil((t_first - t_end_tot) / 86400))
+    k_max = int(np.floor((t_last - t_start_tot) / 86400))
+    best, best_overlap = 0, -np.inf
+    for k in sorted(range(k_min, k_max + 1), key=abs):
+        overlap = min(t_end_tot + 86400 * k, t_last) - max(t_start_tot + 86400 * k, t_first)
+        if overlap > best_overlap:
+            best, best_overlap = k, overlap
+    return 86400.0 * best
+
+
+class StreamTimes:
+    """parse_time_seconds over consecutive chunks of one recording: the midnight unwrap carries over chunk boundaries."""
+
+    def __init__(self):
+        self.last_raw = None # last time of day before unwrapping
+        self.days = 0
+
+    def parse(self, time_strings):
+        raw = parse_time_seconds(time_strings, unwrap_midnight=False)
+        if raw.size == 0:
+            return raw
+        prev = raw[:1] if self.last_raw is None else np.array([self.last_raw])
+        day_change = np.diff(np.concatenate([prev, raw])) < -43200
+        days = self.days + np.cumsum(day_change)
+        self.last_raw, self.days = raw[-1], int(days[-1])
+        return raw + 86400 * days
+
+
+# =========================
+# RaPi csv loader
+# =========================
+
+RASPI_META_ROWS = ["sensor number", "sensor range", "sensor height", "calibration correction mbar"]
+
+
+def _open_binary(csv_file):
+    # path or already opened file (streamlit UploadedFile, BytesIO, ...)
+    if isinstance(csv_file, (str, bytes)) or hasattr(csv_file, "__fspath__"):
+        return open(csv_file, "rb"), True
+    csv_file.seek(0)
+    return csv_file, False
+
+
+def is_raspi_data_row(first_field):
+    # data rows start with a timestamp ("date HH:MM:SS.fff"), metadata rows with a name
+    return ":" in first_field
+
+
+def read_raspi_header(fh):
+    """
+    Read the column header and the metadata block at the top of a RaPi export: every row before the first
+    timestamped one (RASPI_META_ROWS in any order, plus any other numeric rows), as the old python-engine parse had them.
+    As in that parse, an empty column name (trailing comma) becomes "Unnamed: i" and empty values are NaN.
+    Returns (index_name, columns, df_meta, rows to skip, fields of the first data row).
+    """
+    header = next(csv.reader([fh.readline().decode("utf-8-sig")]))
+    index_name = header[0] if header[0] else None
+    columns = [c if c else f"Unnamed: {i}" for i, c in enumerate(header)][1:]
+    meta = {}
+    n_fields = len(header)
+    while True:
+        pos = fh.tell()
+        line = fh.readline()
+        if not line:
+            break
+        row = next(csv.reader([line.decode("utf-8")]), [])
+        if not row or is_raspi_data_row(row[0]):
+            n_fields = len(row) or n_fields
+            fh.seek(pos)
+            break
+        values = row[1:]
+        if any(v.strip() for v in values[len(columns):]):
+            raise ValueError(f"RaPi metadata row {row[0]!r} has more values than columns")
+        values = values[:len(columns)] + [""] * (len(columns) - len(values))
+        meta[row[0]] = [float(v) if v.strip() else np.nan for v in values]
+    missing = [r for r in RASPI_META_ROWS if r not in meta]
+    if missing:
+        raise ValueError(f"RaPi export without metadata rows: {missing}")
+
+    df_meta = pd.DataFrame.from_dict(meta, orient="index", columns=columns)
+    df_meta.index.name = index_name
+    return index_name, columns, df_meta, len(meta) + 1, n_fields
+
+
+def _body_usecols(columns, n_fields):
+    # rows ending with a comma the header does not have: the empty last field is dropped (usecols is slower, only then)
+    return list(range(1 + len(columns))) if n_fields > 1 + len(columns) else None
+
+
+def load_raspi_csv(csv_file, dtype=np.float64, engine=None):
+    """
+    Load a RaPi export: metadata rows parsed apart, numeric body read with the C/pyarrow engine.
+    Returns (df_meta, df_data_raspi), df_data_raspi indexed by the raw timestamp strings.
+    """
+    engine = engine or DEFAULT_CSV_ENGINE
+    fh, close = _open_binary(csv_file)
+    try:
+        index_name, columns, df_meta, n_skip, n_fields = read_raspi_header(fh)
+        fh.seek(0)
+        df_data_raspi = pd.read_csv(
+            fh, sep=",", header=None, skiprows=n_skip,
+            names=["__t__"] + columns, index_col=0, usecols=_body_usecols(columns, n_fields),
+            dtype={"__t__": str, **{c: dtype for c in columns}},
+            engine=engine,
+        )
+    finally:
+        if close:
+            fh.close()
+    df_data_raspi.index.name = index_name
+    return df_meta, df_data_raspi
+
+
+def iter_raspi_csv(csv_file, chunk_rows=None, dtype=np.float64, engine=None):
+    """
+    Load a RaPi export chunk by chunk (files larger than memory): returns (df_meta, iterator of data frame chunks).
+    The file is closed once the iterator is exhausted.
+    """
+    engine = engine or DEFAULT_CSV_ENGINE
+    chunk_rows = chunk_rows or RASPI_CHUNK_ROWS
+    fh, close = _open_binary(csv_file)
+    try:
+        index_name, columns, df_meta, n_skip, n_fields = read_raspi_header(fh)
+        fh.seek(0)
+        reader = pd.read_csv(
+            fh, sep=",", header=None, skiprows=n_skip,
+            names=["__t__"] + columns, index_col=0, usecols=_body_usecols(columns, n_fields),
+            dtype={"__t__": str, **{c: dtype for c in columns}},
+            engine=engine, chunksize=chunk_rows,
+        )
+    except Exception:
+        if close:
+            fh.close()
+        raise
+
+    def chunks():
+        try:
+            for chunk in reader:
+                chunk.index.name = index_name
+                yield chunk
+        finally:
+            reader.close()
+            if close:
+                fh.close()
+    return df_meta, chunks()
+
+
+# =========================
+# RaPi processing
+# =========================
+
+def calc_mean_pressures(csv_file):
+    df_meta, df_data_raspi = load_raspi_csv(csv_file) # metadata rows + numeric body (C engine)
+    return calc_pressure_stats(df_meta, df_data_raspi), df_data_raspi
+
+
+def calc_pressure_stats(df_meta, df_data_raspi):
+    """
+    Mean / std / uncorrected mean per sensor, naturally sorted by name (p_mean sheet).
+    df_data_raspi: the data frame, or an iterable of frame chunks with the same columns (streaming loader).
+    """
+    columns, stats = column_stats(df_data_raspi) # one blocked pass for all sensors
+    return pressure_stats_frame(df_meta, columns, stats)
+
+
+def pressure_stats_frame(df_meta, columns, stats):
+    """p_mean sheet from the column names and their ColumnStats."""
+    order = list(sensor_order(tuple(columns)))
+    names = [columns[i] for i in order]
+    mean = stats.mean_or_nan()[order]
+    df_out = pd.DataFrame({
+        "h/m": df_meta.loc["sensor height", names].to_numpy(),
+        "p_mean/mbar": mean,
+        "p_std/mbar": stats.std()[order],
+        "p_mean_not_corr/mbar": mean + df_meta.loc["calibration correction mbar", names].to_numpy(), # measured values (not corrected)
+    }, index=pd.Index(names))
+    return df_out
+
+
+@functools.lru_cache(maxsize=64)
+def sensor_order(columns):
+    """Positions of the pressure sensors (gas meters left out) sorted by letters then number: p2 before p10. Once per layout."""
+    gas_meters = set(GAS_METERS.values())
+    def key(i):
+        return re.match(r"[a-zA-Z]*", columns[i]).group(), int(re.search(r"\d+", columns[i]).group())
+    return tuple(sorted((i for i, c in enumerate(columns) if c not in gas_meters), key=key))
+
+
+STATS_BLOCK_ROWS = 1 << 16 # rows per block of the stats kernel (temporaries stay small)
+
+
+class ColumnStats:
+    """
+    Running count / mean / std / min / max of every column, NaN skipped, fed block by block: block moments are
+    merged with the Welford / Chan update (stable even on large offsets, exact across any chunking).
+    """
+
+    def __init__(self, n_columns):
+        self.count = np.zeros(n_columns, dtype=np.int64)
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns) # sum of squared deviations from the mean
+        self.min = np.full(n_columns, np.nan)
+        self.max = np.full(n_columns, np.nan)
+
+    def update(self, values, block_rows=STATS_BLOCK_ROWS):
+        """values: 2D float32/float64 array (rows, columns)."""
+        values = np.asarray(values)
+        for lo in range(0, len(values), block_rows):
+            self._merge_block(values[lo:lo + block_rows])
+        return self
+
+    def update_columns(self, arrays, block_rows=STATS_BLOCK_ROWS):
+        """arrays: one 1D array per column (a frame's columns, no 2D copy of the whole frame)."""
+        n_rows = len(arrays[0]) if arrays else 0
+        block = np.empty((len(arrays), min(block_rows, n_rows)), dtype=np.result_type(*arrays)) if n_rows else None
+        for lo in range(0, n_rows, block_rows):
+            hi = min(lo + block_rows, n_rows)
+            for j, a in enumerate(arrays): # gather the block column by column, it stays in cache
+                block[j, :hi - lo] = a[lo:hi]
+            self._merge_block(block[:, :hi - lo].T)
+        return self
+
+    def _merge_block(self, x):
+        valid = ~np.isnan(x)
+        all_valid = valid.all()
+        n_b = len(x) if all_valid else valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if all_valid:
+                mean_b = x.sum(axis=0, dtype=np.float64) / n_b
+                d = x - mean_b
+            else:
+                mean_b = np.where(valid, x, 0.0).sum(axis=0) / n_b
+                d = np.where(valid, x - mean_b, 0.0)
+            m2_b = (d * d).sum(axis=0)
+            n = self.count + n_b
+            delta = mean_b - self.mean
+            w = n_b / n # weight of the block in the merged mean
+        has_b = n_b > 0
+        self.mean = np.where(has_b, self.mean + delta * w, self.mean)
+        self.m2 = np.where(has_b, self.m2 + m2_b + delta * delta * self.count * w, self.m2)
+        self.count = n
+        self.min = np.fmin(self.min, np.fmin.reduce(x, axis=0))
+        self.max = np.fmax(self.max, np.fmax.reduce(x, axis=0))
+
+    def mean_or_nan(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def std(self, ddof=1):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > ddof, np.sqrt(self.m2 / (self.count - ddof)), np.nan)
+
+
+def column_stats(data):
+    """Frame or iterable of frame chunks -> (column names, ColumnStats)."""
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    columns, stats = None, None
+    for chunk in data:
+        if stats is None:
+            columns = list(chunk.columns)
+            stats = ColumnStats(len(columns))
+        stats.update_columns([chunk[c].to_numpy() for c in columns])
+    return columns, stats
+
+
+# gas meters: Vdot column -> RaPi signal column, one pulse per GM_PULSE_VOLUME
+GAS_METERS = {"CR": "gm_ZR", "GR": "gm_ZL"}
+GM_PULSE_VOLUME = 0.1 # m^3 per pulse
+PULSE_RISE = 30 # minimum sample-to-sample rise of a pulse edge
+PULSE_CHUNK_ROWS = 1 << 20 # rows per block in detect_pulses (bounded temporaries on long recordings)
+
+MeterPulses = namedtuple("MeterPulses", ["pulse_times", "V_dots", "V_dot_mean", "V_dot_std", "n_V_dot", "V_dot_glob", "rolling"])
+
+
+def detect_pulses(signals, rise=PULSE_RISE, rearm=None, debounce_s=0.0, time_array=None, chunk_rows=PULSE_CHUNK_ROWS):
+    """
+    Rising pulse edges of gas meter signals, all meters in one pass: signals (n,) or (n, n_meters) -> one array of
+    sample indexes per meter. An edge is a sample-to-sample rise > rise (the first sample has no predecessor).
+    rearm (hysteresis): an edge only counts if the signal fell by more than rearm in one step since the previous edge.
+    debounce_s (needs time_array): an edge less than debounce_s after the last counted edge is contact bounce
+    (applied after rearm). The first edge of each meter always counts.
+    """
+    if debounce_s > 0 and time_array is None:
+        raise ValueError("debounce_s needs time_array")
+    signals = np.asarray(signals)
+    if signals.ndim == 1:
+        signals = signals[:, None]
+    n, n_meters = signals.shape
+    rising, falling = [np.zeros(0, np.int64)], [np.zeros(0, np.int64)]
+    for lo in range(1, n, chunk_rows):
+        hi = min(lo + chunk_rows, n)
+        step = signals[lo:hi] - signals[lo - 1:hi - 1]
+        r, c = np.nonzero(step > rise)
+        rising.append(c.astype(np.int64) * n + r + lo) # key: meter-major, then row
+        if rearm is not None:
+            r, c = np.nonzero(step < -rearm)
+            falling.append(c.astype(np.int64) * n + r + lo)
+    keys = np.sort(np.concatenate(rising))
+    meter, rows = np.divmod(keys, n)
+
+    keep = np.ones(keys.size, dtype=bool)
+    if rearm is not None:
+        # a fall between two consecutive edges re-arms the detector (same result as a sequential Schmitt trigger)
+        falls = np.sort(np.concatenate(falling))
+        keep[1:] &= np.searchsorted(falls, keys[1:]) > np.searchsorted(falls, keys[:-1])
+    keep[1:] |= meter[1:] != meter[:-1]
+    keep[:1] = True
+    meter, rows = meter[keep], rows[keep]
+    pulses = np.split(rows, np.searchsorted(meter, np.arange(1, n_meters)))
+    if debounce_s > 0:
+        time_array = np.asarray(time_array)
+        pulses = [rows[_debounce(time_array[rows], debounce_s)] for rows in pulses]
+    return pulses
+
+
+def _debounce(times, debounce_s):
+    """Positions of the edges kept by a debounce: forward pass, each edge at least debounce_s after the last kept one."""
+    kept = []
+    i = 0
+    while i < times.size: # one binary search per kept pulse
+        kept.append(i)
+        i = max(i + 1, int(np.searchsorted(times, times[i] + debounce_s, side="left")))
+    return np.array(kept, dtype=np.int64)
+
+
+def rolling_Vdot(pulse_times, window_s):
+    """Vdot (m^3/h) at each pulse from the pulses of the trailing window_s seconds -> (times, Vdot); NaN if alone."""
+    first = np.searchsorted(pulse_times, pulse_times - window_s, side="left")
+    n_dts = np.arange(pulse_times.size) - first
+    span = pulse_times - pulse_times[first]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        V_dot = np.where(n_dts > 0, n_dts * GM_PULSE_VOLUME / span * 3600, np.nan)
+    return pulse_times, V_dot
+
+
+def pulses_to_Vdot(pulse_times, rolling_window_s=None):
+    pulse_dts = np.diff(pulse_times) # time intervals between pulses
+    V_dots = GM_PULSE_VOLUME / pulse_dts * 3600 # V_dot measurements (m^3/h) from pulses
+    n_V_dot = V_dots.size
+    if n_V_dot:
+        V_dot_mean, V_dot_std = V_dots.mean(), V_dots.std()
+        V_dot_glob = n_V_dot * GM_PULSE_VOLUME / (pulse_times[-1] - pulse_times[0]) * 3600 # from first and last pulse
+    else:
+        V_dot_mean = V_dot_std = V_dot_glob = np.nan # fewer than 2 pulses
+    rolling = rolling_Vdot(pulse_times, rolling_window_s) if rolling_window_s else None
+    return MeterPulses(pulse_times, V_dots, V_dot_mean, V_dot_std, n_V_dot, V_dot_glob, rolling)
+
+
+def meter_Vdots(time_array, signals, meters=None, rolling_window_s=None, **pulse_options):
+    """Pulses and Vdot of every meter (columns of signals) in one pass -> {meter: MeterPulses}."""
+    time_array = np.asarray(time_array)
+    meters = list(GAS_METERS) if meters is None else meters
+    pulses = detect_pulses(signals, time_array=time_array, **pulse_options)
+    return {name: pulses_to_Vdot(time_array[rows], rolling_window_s) for name, rows in zip(meters, pulses)}
+
+
+def gm_signal_to_Vdot(time_array, signal_array, **pulse_options):
+    r = meter_Vdots(time_array, signal_array, ["gm"], **pulse_options)["gm"]
+    return r.V_dots, r.V_dot_mean, r.V_dot_std, r.n_V_dot, r.V_dot_glob
+
+
+def calc_Vdots_out(df_in):
+    # adjust timestamps (index of df_in) to start with 0
+    time_array = parse_time_seconds(df_in.index) # "date HH:MM:SS.fff" -> s (midnight-safe)
+    df_in["t_tot"] = time_array
+    time_array = time_array-time_array[0]
+    df_in.index = time_array
+    df_out = df_in
+
+    # all gas meters in one pass, straight from the column buffers
+    results = meter_Vdots(time_array, df_out[list(GAS_METERS.values())].to_numpy())
+    df_Vdot_stats, df_V_dots = Vdot_frames(results)
+    return df_out, df_Vdot_stats, df_V_dots
+
+
+def Vdot_frames(results):
+    """{meter: MeterPulses} -> (Vdot_stats, Vdot_raw) sheets."""
+    # stats dataframe
+    df_Vdot_stats = pd.DataFrame(index =['Vdot_mean / m^3/h', 'Vdot_std / m^3/h', 'n_V_dot / -', 'V_dot_glob / m^3/h'])
+    for name, r in results.items():
+        df_Vdot_stats[name] = [r.V_dot_mean, r.V_dot_std, r.n_V_dot, r.V_dot_glob]
+    # all Vdots dataframe (meters with fewer pulses padded with NaN)
+    df_V_dots = pd.concat({name: pd.Series(r.V_dots) for name, r in results.items()}, axis=1)
+    return df_Vdot_stats, df_V_dots
+
+
+# =========================
+# Streaming (out-of-core) RaPi processing
+# =========================
+
+RASPI_CHUNK_ROWS = 1 << 18 # rows per chunk in streaming mode (a multiple of STATS_BLOCK_ROWS: no rows wait for the next chunk)
+
+
+class RaPiStream:
+    """
+    Pressure stats and gas meter pulses of a RaPi export fed chunk by chunk, in bounded memory.
+    State carried across chunks: the running column moments, the midnight unwrap (StreamTimes), the start time t0, and the last row of the gas meter signals (an edge may straddle two chunks).
+    Only the pulse times grow with the file. Same results as calc_mean_pressures + calc_Vdots_out, bit for bit and
+    for any chunk size: rows are merged into the moments in the same STATS_BLOCK_ROWS blocks as the in-memory pass
+    (the rows of an unfinished block wait in _pending).
+    """
+
+    def __init__(self, columns, rise=PULSE_RISE):
+        self.columns = list(columns)
+        self.gm_columns = list(GAS_METERS.values())
+        self.rise = rise
+        self._stats = ColumnStats(len(self.columns))
+        self._pending = [] # column arrays of the rows not merged yet (less than one block)
+        self._n_pending = 0
+        self.n_rows = 0
+        self.t0 = None # first t_tot
+        self.t_tot_last = None
+        self.times = StreamTimes()
+        self.last_time = None # last row of the previous chunk: time and gas meter signals
+        self.last_gm = None
+        self.pulse_times = [[] for _ in self.gm_columns]
+
+    def update(self, chunk):
+        if len(chunk) == 0:
+            return self
+        self._update_stats([chunk[c].to_numpy() for c in self.columns])
+        t_tot = self.times.parse(chunk.index)
+        if self.t0 is None:
+            self.t0 = t_tot[0]
+        self.t_tot_last = t_tot[-1]
+        time_array = t_tot - self.t0
+
+        signals = chunk[self.gm_columns].to_numpy()
+        if self.last_gm is not None: # previous sample first: edges are sample-to-sample rises
+            signals = np.vstack([self.last_gm, signals])
+            time_array = np.concatenate([[self.last_time], time_array])
+        for times, rows in zip(self.pulse_times, detect_pulses(signals, self.rise)):
+            times.append(time_array[rows])
+        self.last_gm, self.last_time = signals[-1:].copy(), time_array[-1]
+        self.n_rows += len(chunk)
+        return self
+
+    def _update_stats(self, arrays):
+        self._pending.append(arrays)
+        self._n_pending += len(arrays[0])
+        if self._n_pending < STATS_BLOCK_ROWS:
+            return
+        pending = [np.concatenate(column) for column in zip(*self._pending)]
+        n_full = self._n_pending // STATS_BLOCK_ROWS * STATS_BLOCK_ROWS
+        self._stats.update_columns([a[:n_full] for a in pending])
+        rest = [a[n_full:] for a in pending]
+        self._pending, self._n_pending = ([rest], len(rest[0])) if len(rest[0]) else ([], 0)
+
+    @property
+    def stats(self):
+        """ColumnStats of all rows so far (the unfinished block merged into a copy, the stream goes on)."""
+        if not self._n_pending:
+            return self._stats
+        return copy.deepcopy(self._stats).update_columns([np.concatenate(column) for column in zip(*self._pending)])
+
+    def t_range(self):
+        return self.t0, self.t_tot_last
+
+    def meter_Vdots(self, rolling_window_s=None):
+        return {name: pulses_to_Vdot(np.concatenate(times), rolling_window_s) for name, times in zip(GAS_METERS, self.pulse_times)}
+
+
+def calc_raspi_stream(csv_file, chunk_rows=None):
+    """
+    Streaming counterpart of calc_mean_pressures + calc_Vdots_out for exports larger than memory
+    -> (df_p, df_Vdot_stats, df_V_dots, (t_start_tot, t_end_tot)). The raw data is never held in full.
+    """
+    df_meta, chunks = iter_raspi_csv(csv_file, chunk_rows)
+    stream = RaPiStream(df_meta.columns)
+    for chunk in chunks:
+        stream.update(chunk)
+    if stream.n_rows == 0:
+        raise ValueError("RaPi export without data rows")
+    df_p = pressure_stats_frame(df_meta, stream.columns, stream.stats)
+    df_Vdot_stats, df_V_dots = Vdot_frames(stream.meter_Vdots())
+    return df_p, df_Vdot_stats, df_V_dots, stream.t_range()
+
+
+# =========================
+# Gas analyser logs
+# =========================
+
+GAS_ANALYSER_CHANNELS = {
+    "CR": ("Ch1:Conce:Vol%", 100), # Vol% -> mol/mol
+    "GR": ("Ch2:Conce:ppm", 10**6), # ppm -> mol/mol
+}
+
+
+def read_gasAnalyser_log(txt_file, channel):
+    """Read a gas analyser .txt log (tab separated) -> df with columns t, CO2 (mol/mol)."""
+    column, factor = GAS_ANALYSER_CHANNELS[channel]
+    if hasattr(txt_file, "seek"):
+        txt_file.seek(0)
+    df_GM_raw = pd.read_csv(txt_file, sep="\t", header=0, index_col=None, usecols=["Time", column], dtype={"Time": str})
+    df_GM_raw = df_GM_raw[["Time", column]]
+    df_GM_raw.columns = ["t", "CO2"]
+    df_GM_raw["CO2"] = (df_GM_raw["CO2"]/factor).round(9)
+    return df_GM_raw
+
+
+class GasAnalyserLog:
+    """
+    Gas analyser log parsed once and sorted by time.
+    Windows are found by binary search and returned as slices; CO2 stats come from
+    prefix sums (mean/std) and min/max segment trees, so each window costs O(log n).
+    """
+
+    def __init__(self, df_GM_raw, key=None):
+        self.key = key # identifies the log content in result cache keys
+        t_tot = parse_time_seconds(df_GM_raw["t"])
+        if np.any(np.diff(t_tot) < 0):
+            order = np.argsort(t_tot, kind="stable")
+            df_GM_raw, t_tot = df_GM_raw.iloc[order], t_tot[order]
+        self.df = df_GM_raw.assign(t_tot=t_tot).reset_index(drop=True)
+        self.t_tot = t_tot
+
+        co2 = self.df["CO2"].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(co2)
+        self._offset = co2[valid].mean() if valid.any() else 0.0 # shift to limit cancellation in var
+        x = np.where(valid, co2 - self._offset, 0.0)
+        self._n = np.concatenate(([0], np.cumsum(valid)))
+        self._s1 = np.concatenate(([0.0], np.cumsum(x)))
+        self._s2 = np.concatenate(([0.0], np.cumsum(x * x)))
+
+        size = 1 << max(int(len(co2) - 1).bit_length(), 0)
+        self._size = size
+        self._tree_min = np.full(2 * size, np.nan)
+        self._tree_max = np.full(2 * size, np.nan)
+        self._tree_min[size:size + len(co2)] = co2
+        self._tree_max[size:size + len(co2)] = co2
+        i = size # build the trees bottom-up, one level per step
+        while i > 1:
+            self._tree_min[i // 2:i] = np.fmin(self._tree_min[i:2 * i:2], self._tree_min[i + 1:2 * i:2])
+            self._tree_max[i // 2:i] = np.fmax(self._tree_max[i:2 * i:2], self._tree_max[i + 1:2 * i:2])
+            i //= 2
+
+    def window(self, t_start_tot, t_end_tot):
+        """Row range [lo, hi) with t_start_tot < t_tot < t_end_tot, the window moved onto the log's day (day_shift)."""
+        if len(self.t_tot):
+            shift = day_shift(self.t_tot[0], self.t_tot[-1], t_start_tot, t_end_tot)
+            t_start_tot, t_end_tot = t_start_tot + shift, t_end_tot + shift
+        lo = np.searchsorted(self.t_tot, t_start_tot, side="right")
+        hi = np.searchsorted(self.t_tot, t_end_tot, side="left")
+        return lo, max(lo, hi)
+
+    def section(self, t_start_tot, t_end_tot):
+        lo, hi = self.window(t_start_tot, t_end_tot)
+        return self.df.iloc[lo:hi] # slice, no copy of the log
+
+    def stats(self, t_start_tot, t_end_tot):
+        """[CO2_mean, CO2_std, CO2_min, CO2_max] of the window (NaN if not enough samples)."""
+        lo, hi = self.window(t_start_tot, t_end_tot)
+        n = self._n[hi] - self._n[lo]
+        if n == 0:
+            return [np.nan, np.nan, np.nan, np.nan]
+        s1 = self._s1[hi] - self._s1[lo]
+        s2 = self._s2[hi] - self._s2[lo]
+        CO2_mean = self._offset + s1 / n
+        CO2_std = np.sqrt(max(s2 - s1 * s1 / n, 0.0) / (n - 1)) if n > 1 else np.nan
+        CO2_min, CO2_max = self._tree_query(lo, hi)
+        return [CO2_mean, CO2_std, CO2_min, CO2_max]
+
+    def _tree_query(self, lo, hi):
+        res_min, res_max = np.nan, np.nan
+        lo += self._size
+        hi += self._size
+        while lo < hi:
+            if lo & 1:
+                res_min, res_max = np.fmin(res_min, self._tree_min[lo]), np.fmax(res_max, self._tree_max[lo])
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                res_min, res_max = np.fmin(res_min, self._tree_min[hi]), np.fmax(res_max, self._tree_max[hi])
+            lo //= 2
+            hi //= 2
+        return float(res_min), float(res_max)
+
+
+def extract_gasAnalyser_section(gm_log, t_start_tot, t_end_tot):
+    return gm_log.section(t_start_tot, t_end_tot)
+
+
+def calc_gasAnalyser_stats(gm_log, t_start_tot, t_end_tot):
+    return gm_log.stats(t_start_tot, t_end_tot)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Excel export for the CFM workbooks: sheets are prepared once per file (rounded, NaN-masked)
+and streamed row by row with xlsxwriter's constant_memory mode into as many workbooks as needed.
+The raw RaPi data can be written in full, left out, or exported as a csv/parquet sidecar file.
+ZIP archives are assembled entry by entry as the workbooks are produced.
+"""
+
+import importlib.util
+import re
+import tempfile
+import zipfile
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+# optional, parquet sidecar; only looked up here, pandas imports it on the first parquet export
+HAS_PARQUET = importlib.util.find_spec("pyarrow") is not None
+
+EXCEL_MAX_ROWS = 1048576 # rows per sheet, header included
+ZIP_SPOOL_BYTES = 32 * 2**20 # archives bigger than this go to a temp file
+
+RAW_EXPORT_MODES = {
+    "full": "RasPi sheet in the workbooks",
+    "summary": "summary sheets only (no raw data)",
+    "csv": "raw data as .csv next to the workbooks",
+}
+if HAS_PARQUET:
+    RAW_EXPORT_MODES["parquet"] = "raw data as .parquet next to the workbooks"
+
+
+# =========================
+# Sheets
+# =========================
+
+def _round_like(values, float_format):
+    # pandas to_excel writes float(float_format % v); "%.Nf" is done vectorized with np.round
+    if float_format is None:
+        return values
+    match = re.fullmatch(r"%\.(\d+)f", float_format)
+    if match:
+        return np.round(values, int(match.group(1)))
+    return np.vectorize(lambda v: float(float_format % v) if np.isfinite(v) else v, otypes=[float])(values)
+
+
+def _column_values(values, float_format):
+    if values.dtype.kind == "f":
+        return _round_like(values.astype(np.float64, copy=False), float_format)
+    if values.dtype.kind in "iub":
+        return values
+    return values.astype(object)
+
+
+def prepare_sheet(df, float_format=None):
+    """
+    DataFrame -> sheet ready to be written (same cells as df.to_excel(float_format=...)).
+    Formatting is done once here, writing it to several workbooks costs no further conversion.
+    """
+    columns = [_column_values(df[c].to_numpy(), float_format) for c in df.columns]
+    if columns and all(col.dtype.kind == "f" for col in columns):
+        values = np.column_stack(columns) # numeric sheet (RasPi, Vdot_raw, ...): one float block
+    elif columns:
+        values = np.empty((len(df), len(columns)), dtype=object)
+        for j, col in enumerate(columns):
+            values[:, j] = col
+    else:
+        values = np.empty((len(df), 0))
+    index = _column_values(df.index.to_numpy(), float_format)
+    if values.dtype.kind == "f":
+        has_na = ~np.isfinite(values).all(axis=1)
+    else:
+        has_na = pd.isna(values).any(axis=1) | np.array([any(isinstance(v, float) and np.isinf(v) for v in row) for row in values], dtype=bool)
+    return {
+        "header": [df.index.name or ""] + [str(c) for c in df.columns],
+        "index": index,
+        "values": values,
+        "has_na": has_na, # rows written cell by cell (NaN -> empty, inf -> "inf")
+    }
+
+
+def _cell(v):
+    if v is None or (isinstance(v, float) and np.isnan(v)):
+        return None
+    if isinstance(v, float) and np.isinf(v):
+        return "inf" if v > 0 else "-inf"
+    return v
+
+
+def _write_sheet(workbook, sheet_name, sheet, start, stop, fmt_header, fmt_index):
+    ws = workbook.add_worksheet(sheet_name)
+    header = sheet["header"]
+    if header[0]:
+        ws.write(0, 0, header[0], fmt_header)
+    for j, h in enumerate(header[1:], start=1):
+        ws.write(0, j, h, fmt_header)
+    index = sheet["index"][start:stop].tolist()
+    values, has_na = sheet["values"], sheet["has_na"]
+    for r, i in enumerate(range(start, stop), start=1):
+        ws.write(r, 0, _cell(index[r - 1]), fmt_index)
+        row = values[i].tolist()
+        if has_na[i]:
+            row = [_cell(v) for v in row]
+        ws.write_row(r, 1, row)
+
+
+def write_workbook(sheets, target=None):
+    """
+    sheets: [(sheet name, prepared sheet), ...] -> xlsx bytes (or written to target, a path or binary file).
+    Sheets over the Excel row limit continue on "<name> (2)", "<name> (3)", ...
+    """
+    output = BytesIO() if target is None else target
+    workbook = xlsxwriter.Workbook(output, {"constant_memory": True})
+    fmt_header = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    fmt_index = workbook.add_format({"bold": True, "border": 1, "valign": "top"})
+    for sheet_name, sheet in sheets:
+        n_rows = len(sheet["index"])
+        chunk = EXCEL_MAX_ROWS - 1
+        for k, start in enumerate(range(0, max(n_rows, 1), chunk)):
+            name = sheet_name if k == 0 else f"{sheet_name} ({k + 1})"
+            _write_sheet(workbook, name, sheet, start, min(start + chunk, n_rows), fmt_header, fmt_index)
+    workbook.close()
+    return output.getvalue() if target is None else None
+
+
+# =========================
+# Raw RaPi data
+# =========================
+
+def export_raw_data(df_data_raspi, base_name, mode="full", float_format="%.5f"):
+    """
+    Raw RaPi data according to mode (see RAW_EXPORT_MODES).
+    Returns (sheets for the workbooks, sidecar (file name, bytes) or None).
+    """
+    if mode == "full":
+        return [("RasPi", prepare_sheet(df_data_raspi, float_format))], None
+    if mode == "summary":
+        return [], None
+    if mode == "csv":
+        data = df_data_raspi.to_csv(float_format=float_format).encode("utf-8")
+        return [], (f"cfm_raw_{base_name}.csv", data)
+    if mode == "parquet":
+        if not HAS_PARQUET:
+            raise ImportError("parquet export needs pyarrow (pip install pyarrow)")
+        buf = BytesIO()
+        df_data_raspi.to_parquet(buf)
+        return [], (f"cfm_raw_{base_name}.parquet", buf.getvalue())
+    raise ValueError(f"unknown raw export mode: {mode!r}")
+
+
+# =========================
+# ZIP archives
+# =========================
+
+class ZipStream:
+    """
+    ZIP archive written entry by entry: each workbook goes in as soon as it exists and its buffer can be freed.
+    target: path or binary file to write to; default is a spooled temp file (RAM up to spool_bytes, then disk).
+    Entries added with the upload index of their file keep the upload order whatever the completion order:
+    they wait until done() was called for every earlier index (only entries that arrive early are held in memory).
+    """
+
+    def __init__(self, target=None, spool_bytes=ZIP_SPOOL_BYTES):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_bytes) if target is None else target
+        self._zf = zipfile.ZipFile(self.file, "w")
+        self.names = []
+        self._pending = {} # index -> [(fname, fdata), ...] not written yet
+        self._done = set()
+        self._next = 0 # first index not written yet
+
+    def add(self, fname, fdata, index=None):
+        if index is None:
+            self._write(fname, fdata)
+        else:
+            self._pending.setdefault(index, []).append((fname, fdata))
+            if index == self._next: # nothing earlier missing
+                self._flush(index)
+
+    def done(self, index):
+        """All entries of this index were added (none for a failed file): write what was waiting for it."""
+        self._done.add(index)
+        while self._next in self._done:
+            self._done.discard(self._next)
+            self._flush(self._next)
+            self._next += 1
+
+    def _flush(self, index):
+        for fname, fdata in self._pending.pop(index, []):
+            self._write(fname, fdata)
+
+    def _write(self, fname, fdata):
+        self._zf.writestr(fname, fdata)
+        self.names.append(fname)
+
+    def __len__(self):
+        return len(self.names) + sum(len(entries) for entries in self._pending.values())
+
+    def close(self):
+        for index in sorted(self._pending): # indexes never marked done
+            self._flush(index)
+        self._zf.close()
+
+    def getvalue(self):
+        """Close the archive and return its bytes (the spool is released)."""
+        self.close()
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.close()
+        return data
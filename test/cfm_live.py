@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Live mode: tail growing RaPi exports and gas analyser logs in a watched directory and keep their statistics up to date
+from the new bytes only (nothing is re-read from the start of a file).
+"""
+
+import glob
+import os
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from cfm_core import (ColumnStats, RaPiStream, StreamTimes, load_raspi_csv, read_raspi_header, read_gasAnalyser_log,
+                      pressure_stats_frame, Vdot_frames, is_raspi_data_row, day_shift)
+from cfm_batch import GM_STATS_INDEX
+
+TAIL_MAX_BYTES = 64 * 2**20 # bytes read per poll and file (a big backlog is caught up over several polls)
+
+
+class FileTail:
+    """
+    New complete lines of a growing file since the last call. A partly written last line stays in the file
+    until its newline arrives. A file that shrinks or is replaced starts over (restarts counts it).
+    """
+
+    def __init__(self, path, max_bytes=TAIL_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.offset = 0
+        self.restarts = 0
+        self._inode = None
+
+    def read_lines(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return b""
+        if (self._inode is not None and st.st_ino != self._inode) or st.st_size < self.offset:
+            self.offset = 0 # truncated / rotated
+            self.restarts += 1
+        self._inode = st.st_ino
+        if st.st_size == self.offset:
+            return b""
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(min(st.st_size - self.offset, self.max_bytes))
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        return data[:end]
+
+
+class LiveRaPi:
+    """Running p_mean / Vdot stats of a RaPi export being written (RaPiStream fed with the new rows of each poll)."""
+
+    def __init__(self, path):
+        self.tail = FileTail(path)
+        self._reset()
+
+    def _reset(self):
+        self.header = b"" # column header + metadata rows, put in front of every new block of rows
+        self.df_meta = None
+        self.stream = None
+        self._restarts = self.tail.restarts
+
+    def poll(self):
+        """Read and process the new rows -> number of new rows."""
+        data = self.tail.read_lines()
+        if self.tail.restarts != self._restarts:
+            self._reset()
+        if self.df_meta is None:
+            self.header += data
+            lines = self.header.splitlines(keepends=True)
+            # the metadata block ends at the first timestamped row
+            n_header = next((i for i, line in enumerate(lines) if i and is_raspi_data_row(line.split(b",", 1)[0].decode("utf-8"))), None)
+            if n_header is None:
+                return 0 # header not complete yet
+            self.header, data = b"".join(lines[:n_header]), b"".join(lines[n_header:])
+            self.df_meta = read_raspi_header(BytesIO(self.header))[2]
+            self.stream = RaPiStream(self.df_meta.columns)
+        if not data:
+            return 0
+        _, chunk = load_raspi_csv(BytesIO(self.header + data))
+        self.stream.update(chunk)
+        return len(chunk)
+
+    def snapshot(self):
+        """(df_p, df_Vdot_stats, (t_start_tot, t_end_tot), n_rows), or None before the first data row."""
+        if self.stream is None or self.stream.n_rows == 0:
+            return None
+        df_p = pressure_stats_frame(self.df_meta, self.stream.columns, self.stream.stats)
+        df_Vdot_stats, _ = Vdot_frames(self.stream.meter_Vdots())
+        return df_p, df_Vdot_stats, self.stream.t_range(), self.stream.n_rows
+
+
+class LiveGasLog:
+    """
+    Gas analyser log being written: new lines parsed with read_gasAnalyser_log, CO2 stats of a growing window.
+    The window (t_start_tot, t_end_tot) of a live run only moves forward, so the rows entering it are merged
+    into running moments; a window that changes otherwise is recomputed from the rows kept in memory.
+    """
+
+    def __init__(self, path, channel):
+        self.channel = channel
+        self.tail = FileTail(path)
+        self._reset()
+
+    def _reset(self):
+        self.header = None
+        self.times = StreamTimes()
+        self.t_tot = np.zeros(0)
+        self.co2 = np.zeros(0)
+        self._window = None
+        self._hi = 0 # rows [.., _hi) already merged into _stats
+        self._stats = None
+        self._restarts = self.tail.restarts
+
+    def poll(self):
+        data = self.tail.read_lines()
+        if self.tail.restarts != self._restarts:
+            self._reset()
+        if self.header is None:
+            if not data:
+                return 0
+            first_end = data.index(b"\n") + 1
+            self.header, data = data[:first_end], data[first_end:]
+        if not data:
+            return 0
+        df = read_gasAnalyser_log(BytesIO(self.header + data), self.channel)
+        self.t_tot = np.concatenate([self.t_tot, self.times.parse(df["t"])])
+        self.co2 = np.concatenate([self.co2, df["CO2"].to_numpy(dtype=np.float64)])
+        return len(df)
+
+    def stats(self, t_start_tot, t_end_tot):
+        """[CO2_mean, CO2_std, CO2_min, CO2_max] for t_start_tot < t_tot < t_end_tot, as GasAnalyserLog.stats."""
+        if len(self.t_tot): # same day as the log (a live run may start after midnight, the log before)
+            shift = day_shift(self.t_tot[0], self.t_tot[-1], t_start_tot, t_end_tot)
+            t_start_tot, t_end_tot = t_start_tot + shift, t_end_tot + shift
+        lo = np.searchsorted(self.t_tot, t_start_tot, side="right")
+        hi = max(lo, np.searchsorted(self.t_tot, t_end_tot, side="left"))
+        if self._window is None or self._window[0] != t_start_tot or hi < self._hi:
+            self._stats, self._hi = ColumnStats(1), lo
+        self._window = (t_start_tot, t_end_tot)
+        self._hi = max(self._hi, lo) # rows before the window may still be arriving
+        self._stats.update(self.co2[self._hi:hi, None])
+        self._hi = hi
+        s = self._stats
+        if s.count[0] == 0:
+            return [np.nan, np.nan, np.nan, np.nan]
+        return [float(s.mean[0]), float(s.std()[0]), float(s.min[0]), float(s.max[0])]
+
+
+class LiveFolder:
+    """Tails of the RaPi exports (*.csv) and analyser logs (*.txt) of a directory, created as files appear."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.raspi = {} # path -> LiveRaPi
+        self.logs = {} # (path, channel) -> LiveGasLog
+        self.lock = threading.Lock()
+        self.last_poll = None
+
+    def files(self, pattern):
+        paths = glob.glob(os.path.join(self.directory, pattern))
+        return sorted(paths, key=os.path.getmtime, reverse=True) # most recently written first
+
+    def poll(self, raspi_path, log_paths):
+        """
+        Read the new bytes of one RaPi export and its analyser logs ({channel: path or None}).
+        Returns {"raspi": snapshot, "CO2_stats": df or None, "new_rows": n, "seconds": poll time}.
+        """
+        with self.lock:
+            t0 = time.perf_counter()
+            if raspi_path and raspi_path not in self.raspi:
+                self.raspi[raspi_path] = LiveRaPi(raspi_path)
+            live = self.raspi.get(raspi_path)
+            new_rows = live.poll() if live else 0
+            snapshot = live.snapshot() if live else None
+            GM_stats_dict = {}
+            for channel, path in log_paths.items():
+                if path is None:
+                    continue
+                if (path, channel) not in self.logs:
+                    self.logs[path, channel] = LiveGasLog(path, channel)
+                log = self.logs[path, channel]
+                new_rows += log.poll()
+                if snapshot is not None:
+                    GM_stats_dict[channel] = log.stats(*snapshot[2])
+            self.last_poll = time.time()
+            return {
+                "raspi": snapshot,
+                "CO2_stats": pd.DataFrame(GM_stats_dict, index=GM_STATS_INDEX) if GM_stats_dict else None,
+                "new_rows": new_rows,
+                "seconds": time.perf_counter() - t0,
+            }
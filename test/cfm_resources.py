@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+Streamlit resources of the CFM apps, one per server process. Defined here rather than in each app so that the pages
+of the multipage server (menu.py) share them: a file processed in one page is a cache hit in the other.
+The classes are imported on first use, a page only pays for what it uses.
+"""
+
+import streamlit as st
+
+
+@st.cache_resource
+def get_result_cache():
+    # shared by all sessions and pages (keys are content hashes of the uploads and include the app profile)
+    from cfm_cache import ResultCache, DEFAULT_CACHE_BYTES
+    return ResultCache(DEFAULT_CACHE_BYTES)
+
+
+@st.cache_resource
+def get_result_store():
+    from cfm_store import ResultStore
+    return ResultStore()
+
+
+@st.cache_resource
+def get_live_folder(directory):
+    # one set of file tails per directory, shared by all sessions: each poll only reads the new bytes
+    from cfm_live import LiveFolder
+    return LiveFolder(directory)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation: named spans record wall time, CPU time and peak allocation of each pipeline stage,
+per file, in the CFM apps and in the background removal app (détourage.py). Spans go to the apps' sidebar panel
+and, when CFM_SPANS_LOG is set, to a JSON-lines log (one object per span) that can be aggregated across runs.
+
+    with recording(app="app2", file=name) as rec:
+        with span("parse"):
+            ...
+    log_spans(rec.records)
+
+Spans in a server thread take the CPU time of their thread: other sessions are not counted, nor the native threads of
+the libraries (onnxruntime). In processes marked by worker_process() (spawned batch workers, one file at a time),
+spans take the CPU time of the whole process and, with trace_memory, the peak allocation (opt-in as tracemalloc slows
+allocations down). tracemalloc is process-wide: the server's sessions never start, reset or stop it.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+SPANS_LOG = os.environ.get("CFM_SPANS_LOG") # path of the JSON-lines log, "-" for stderr, unset = no log
+
+logger = logging.getLogger("cfm.spans")
+_local = threading.local()
+_cpu_time = time.thread_time # process CPU time in worker processes (worker_process)
+_traced = False # this process measures span peaks (worker_process)
+
+
+def worker_process(trace_memory=False):
+    """Mark this process as a batch worker, running its spans one at a time: CPU time of the whole process and, with
+    trace_memory, peak allocation (spans reset the tracemalloc peak, never to be done in the server)."""
+    global _cpu_time, _traced
+    _cpu_time = time.process_time
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _traced = True
+
+
+class SpanRecorder:
+    """Spans of one unit of work (a file, a batch); context fields are copied into every record."""
+
+    def __init__(self, **context):
+        self.context = context
+        self.records = []
+        self._stack = [] # peaks (absolute tracemalloc bytes) of the open spans
+
+    @contextmanager
+    def span(self, stage, **fields):
+        tracing = _traced
+        if tracing:
+            mem0 = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self._stack.append(0)
+        t0, cpu0 = time.perf_counter(), _cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - t0, _cpu_time() - cpu0
+            peak_inner = self._stack.pop()
+            record = {**self.context, **fields, "stage": stage, "wall_s": round(wall, 6), "cpu_s": round(cpu, 6)}
+            if tracing:
+                peak = max(peak_inner, tracemalloc.get_traced_memory()[1])
+                record["peak_mb"] = round((peak - mem0) / 2**20, 3)
+                if self._stack: # the enclosing span saw this peak too (reset_peak hid it)
+                    self._stack[-1] = max(self._stack[-1], peak)
+            record["ts"] = round(time.time(), 3)
+            self.records.append(record)
+
+
+@contextmanager
+def recording(**context):
+    """Make a new SpanRecorder the current one of this thread (span() records into it)."""
+    previous = getattr(_local, "recorder", None)
+    _local.recorder = recorder = SpanRecorder(**context)
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+@contextmanager
+def span(stage, **fields):
+    """Span in the current recorder of the thread; nothing is measured outside recording()."""
+    recorder = getattr(_local, "recorder", None)
+    if recorder is None:
+        yield
+        return
+    with recorder.span(stage, **fields):
+        yield
+
+
+def log_spans(records):
+    if SPANS_LOG and records:
+        _configure_logger()
+        for record in records:
+            logger.info(json.dumps(record, default=str))
+
+
+def _configure_logger():
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler() if SPANS_LOG == "-" else logging.FileHandler(SPANS_LOG, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def spans_frame(records):
+    """Records -> one row per span (file, stage, ms, MB) for display."""
+    import pandas as pd # only for the panel: the background removal page does not load pandas otherwise
+    df = pd.DataFrame(records)
+    if df.empty:
+        return df
+    df["wall / ms"] = df.pop("wall_s") * 1000
+    df["cpu / ms"] = df.pop("cpu_s") * 1000
+    if "peak_mb" in df:
+        df["peak / MB"] = df.pop("peak_mb")
+    return df.drop(columns=[c for c in ("ts", "app") if c in df])
+
+
+def stage_totals(records):
+    """Records -> one row per stage: number of spans, total wall / CPU time, largest peak."""
+    df = spans_frame(records)
+    if df.empty:
+        return df
+    agg = {"n": ("stage", "size"), "wall / ms": ("wall / ms", "sum"), "cpu / ms": ("cpu / ms", "sum")}
+    if "peak / MB" in df:
+        agg["peak / MB"] = ("peak / MB", "max")
+    return df.groupby("stage", sort=False).agg(**agg)
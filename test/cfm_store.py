@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Local history of processed runs (SQLite, no server): per-sensor pressure stats, Vdot stats and CO2 stats of every
+RaPi file, with its content hash and time window. The global recap and the history view are queries over it
+instead of re-reading Excel files or raw exports.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from cfm_cache import content_hash
+
+DEFAULT_STORE_PATH = os.environ.get("CFM_STORE", "cfm_history.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    logs_key TEXT NOT NULL, -- gas analyser logs the run was processed with
+    t_start_tot REAL,
+    t_end_tot REAL,
+    processed_at REAL NOT NULL, -- unix time
+    UNIQUE (file_hash, file_name, logs_key, t_start_tot, t_end_tot)
+);
+CREATE INDEX IF NOT EXISTS runs_file_name ON runs (file_name);
+CREATE INDEX IF NOT EXISTS runs_processed_at ON runs (processed_at);
+CREATE TABLE IF NOT EXISTS sensor_stats (
+    run_id INTEGER NOT NULL REFERENCES runs ON DELETE CASCADE,
+    sensor TEXT NOT NULL,
+    position INTEGER NOT NULL, -- row in the p_mean sheet
+    h_m REAL,
+    p_mean REAL,
+    p_std REAL,
+    p_mean_not_corr REAL,
+    PRIMARY KEY (run_id, sensor)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS sensor_stats_sensor ON sensor_stats (sensor, run_id);
+CREATE TABLE IF NOT EXISTS meter_stats (
+    run_id INTEGER NOT NULL REFERENCES runs ON DELETE CASCADE,
+    meter TEXT NOT NULL,
+    position INTEGER NOT NULL, -- column in the Vdot_stats sheet
+    Vdot_mean REAL,
+    Vdot_std REAL,
+    n_Vdot REAL,
+    Vdot_glob REAL,
+    PRIMARY KEY (run_id, meter)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS co2_stats (
+    run_id INTEGER NOT NULL REFERENCES runs ON DELETE CASCADE,
+    channel TEXT NOT NULL,
+    position INTEGER NOT NULL, -- column in the CO2_stats sheet
+    co2_mean REAL,
+    co2_std REAL,
+    co2_min REAL,
+    co2_max REAL,
+    PRIMARY KEY (run_id, channel)
+) WITHOUT ROWID;
+"""
+
+# recap columns (cfm_batch.build_recap_row): same fixed sheet positions, read from the store
+RECAP_QUERY = """
+SELECT r.run_id, r.file_name, c.co2_mean, c.co2_max, s.p_mean AS dp1, m.Vdot_mean
+FROM runs r
+LEFT JOIN co2_stats c ON c.run_id = r.run_id AND c.position = 0
+LEFT JOIN sensor_stats s ON s.run_id = r.run_id AND s.position = 31
+LEFT JOIN meter_stats m ON m.run_id = r.run_id AND m.position = 1
+WHERE r.run_id IN ({ids})
+"""
+
+
+def file_hash(data, block_bytes=1 << 20):
+    """content_hash of raw bytes, or of a file on disk read block by block."""
+    if isinstance(data, (bytes, bytearray)):
+        return content_hash(data)
+    h = hashlib.blake2b(digest_size=16)
+    with open(data, "rb") as f:
+        for block in iter(lambda: f.read(block_bytes), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def logs_key(gm_log_CR, gm_log_GR):
+    return repr(tuple(None if gm_log is None else (gm_log.key or id(gm_log)) for gm_log in (gm_log_CR, gm_log_GR)))
+
+
+def record_result(store, name, data, result, gm_log_CR, gm_log_GR, t_window=None):
+    """Store the summary of one run_batch result (data: bytes or path of the RaPi file) -> run_id."""
+    return store.add_run(
+        name, file_hash(data), logs_key(gm_log_CR, gm_log_GR), t_window if t_window is not None else result["t_range"],
+        result["df_p"], result["df_Vdot_stats"], result.get("df_GM_stats"),
+    )
+
+
+def _float(v):
+    return None if v is None or pd.isna(v) else float(v)
+
+
+class ResultStore:
+    """SQLite store of run summaries. One short connection per call (safe from streamlit's threads)."""
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        with closing(self._connect()) as con, con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(SCHEMA)
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute("PRAGMA foreign_keys=ON")
+        return con
+
+    def add_run(self, file_name, file_hash, logs_key, t_window, df_p, df_Vdot_stats, df_GM_stats=None):
+        """
+        Record one processed RaPi file -> run_id. The same file, logs and window already stored with the same stats
+        (a cache hit on a rerun) keeps its run_id, processed_at and stats; different stats replace the stored ones.
+        """
+        t_start_tot, t_end_tot = (_float(t) for t in t_window)
+        key = (file_hash, file_name, logs_key, t_start_tot, t_end_tot)
+        stats = { # table -> rows without run_id, in position order
+            "sensor_stats": [(str(sensor), pos, *(_float(v) for v in row)) for pos, (sensor, row) in enumerate(zip(df_p.index, df_p.to_numpy()))],
+            "meter_stats": [(str(meter), pos, *(_float(v) for v in df_Vdot_stats[meter])) for pos, meter in enumerate(df_Vdot_stats.columns)],
+            "co2_stats": [] if df_GM_stats is None else
+                [(str(channel), pos, *(_float(v) for v in df_GM_stats[channel])) for pos, channel in enumerate(df_GM_stats.columns)],
+        }
+        with closing(self._connect()) as con, con:
+            found = con.execute(
+                "SELECT run_id FROM runs WHERE file_hash = ? AND file_name = ? AND logs_key = ? AND t_start_tot IS ? AND t_end_tot IS ?", key,
+            ).fetchone()
+            if found is None:
+                run_id = con.execute(
+                    "INSERT INTO runs (file_name, file_hash, logs_key, t_start_tot, t_end_tot, processed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (file_name, file_hash, logs_key, t_start_tot, t_end_tot, time.time()),
+                ).lastrowid
+            else:
+                run_id = found[0]
+                stored = {table: [tuple(row[1:]) for row in con.execute(f"SELECT * FROM {table} WHERE run_id = ? ORDER BY position", (run_id,))]
+                          for table in stats}
+                if stored == stats:
+                    return run_id
+                con.execute("UPDATE runs SET processed_at = ? WHERE run_id = ?", (time.time(), run_id))
+                for table in stats:
+                    con.execute(f"DELETE FROM {table} WHERE run_id = ?", (run_id,))
+            for table, rows in stats.items():
+                con.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?)", [(run_id, *row) for row in rows])
+        return run_id
+
+    def query(self, sql, params=()):
+        with closing(self._connect()) as con:
+            return pd.read_sql_query(sql, con, params=params)
+
+    def recap_rows(self, run_ids):
+        """Recap rows (as cfm_batch.build_recap_row) of these runs, in the given order."""
+        run_ids = [int(r) for r in run_ids]
+        if not run_ids:
+            return []
+        df = self.query(RECAP_QUERY.format(ids=",".join("?" * len(run_ids))), run_ids).set_index("run_id").loc[run_ids]
+        return [{
+            "File name": f'cfm_analysis_extended_{row.file_name.split(".")[0]}',
+            "CO2 Mean": _nan(row.co2_mean),
+            "CO2 Max": _nan(row.co2_max),
+            "dp1": _nan(row.dp1),
+            "Vdot GR Mean": _nan(row.Vdot_mean),
+        } for row in df.itertuples()]
+
+    def runs(self, name_like=None, since=None, until=None, limit=1000):
+        """Runs, newest first, filtered by file name (SQL LIKE) and processing time (unix seconds)."""
+        where, params = [], []
+        if name_like:
+            where.append("file_name LIKE ?")
+            params.append(name_like)
+        if since is not None:
+            where.append("processed_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("processed_at < ?")
+            params.append(until)
+        sql = ("SELECT run_id, file_name, file_hash, t_start_tot, t_end_tot, processed_at FROM runs"
+               + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY processed_at DESC LIMIT ?")
+        df = self.query(sql, params + [limit])
+        df["processed_at"] = pd.to_datetime(df["processed_at"], unit="s").dt.floor("s")
+        return df
+
+    def sensor_history(self, run_ids, sensors=None):
+        """p_mean of the given runs: one row per run, one column per sensor (p_mean sheet order)."""
+        run_ids = [int(r) for r in run_ids]
+        if not run_ids:
+            return pd.DataFrame()
+        sql = f"SELECT run_id, sensor, position, p_mean FROM sensor_stats WHERE run_id IN ({','.join('?' * len(run_ids))})"
+        params = list(run_ids)
+        if sensors:
+            sql += f" AND sensor IN ({','.join('?' * len(sensors))})"
+            params += list(sensors)
+        df = self.query(sql, params)
+        order = df.sort_values("position")["sensor"].drop_duplicates()
+        return df.pivot(index="run_id", columns="sensor", values="p_mean").reindex(columns=order)
+
+    def sensors(self):
+        return self.query("SELECT sensor FROM sensor_stats GROUP BY sensor ORDER BY MIN(position)")["sensor"].tolist()
+
+
+def _nan(v):
+    # NULL (missing sheet cell) -> NaN, numbers as numpy floats like the values read from the frames
+    return np.nan if v is None or pd.isna(v) else np.float64(v)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Live CFM dashboard: watches a directory (e.g. the share mounted from the RaPi) and shows the running
+pressure / Vdot / CO2 statistics of a recording while it is being written.
+
+    streamlit run live.py
+"""
+
+import os
+import time
+import streamlit as st
+
+from cfm_resources import get_live_folder
+
+
+# =========================
+# Streamlit App
+# =========================
+
+st.header("CFM live recording")
+
+directory = st.text_input("Watched directory", value=os.environ.get("CFM_WATCH_DIR", ""))
+if not directory or not os.path.isdir(directory):
+    st.info("Enter the directory the RaPi exports and gas analyser logs are written to.")
+    st.stop()
+
+folder = get_live_folder(os.path.abspath(directory))
+csv_paths = folder.files("*.csv")
+txt_paths = folder.files("*.txt")
+if not csv_paths:
+    st.info(f"No RaPi export (.csv) in {directory} yet.")
+
+col_raspi, col_cr, col_gr = st.columns(3)
+raspi_path = col_raspi.selectbox("RaPi export", csv_paths, format_func=os.path.basename) # newest first
+log_paths = {}
+for col, channel in ((col_cr, "CR"), (col_gr, "GR")):
+    options = [None] + txt_paths
+    default = next((i for i, p in enumerate(options) if p and channel in os.path.basename(p)), 0)
+    log_paths[channel] = col.selectbox(f"Gas analyser {channel}", options, index=default,
+                                       format_func=lambda p: "none" if p is None else os.path.basename(p))
+
+live = st.sidebar.toggle("Live", value=True)
+refresh_s = st.sidebar.number_input("Refresh every (s)", min_value=1.0, max_value=600.0, value=5.0)
+
+# =========================
+# Statistics
+# =========================
+
+poll = folder.poll(raspi_path, log_paths)
+snapshot = poll["raspi"]
+if snapshot is None:
+    st.write("Waiting for the first data rows...")
+else:
+    df_p, df_Vdot_stats, (t_start_tot, t_end_tot), n_rows = snapshot
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Rows", f"{n_rows:,}")
+    col2.metric("Duration", f"{(t_end_tot - t_start_tot) / 60:.1f} min")
+    col3.metric("Last sample", time.strftime("%H:%M:%S", time.gmtime(t_end_tot % 86400)))
+    col4.metric("Vdot GR mean / m^3/h", f"{df_Vdot_stats.iloc[0, 1]:.3f}")
+    st.subheader("Vdot_stats")
+    st.dataframe(df_Vdot_stats)
+    if poll["CO2_stats"] is not None:
+        st.subheader("CO2_stats")
+        st.dataframe(poll["CO2_stats"].style.format("{:.6g}"))
+    st.subheader("p_mean")
+    st.dataframe(df_p)
+
+st.sidebar.caption(f"Last poll: {poll['new_rows']} new rows read in {poll['seconds'] * 1000:.0f} ms")
+
+if live:
+    time.sleep(refresh_s)
+    st.rerun()
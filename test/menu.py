@@ -1,27 +1,28 @@
 import streamlit as st
 
+# Home page of the multipage server: streamlit run menu.py
+# The apps are the pages of the sidebar (pages/), served by this same process with shared caches.
+# Nothing heavy is imported here: pandas is loaded by the first CFM page opened, rembg by the first background removal.
+
+PAGES = [
+    ("pages/1_CFM_processing.py", "CFM processing",
+     "Processes one or more Raspi files and returns the processed files (RaPi only and extended workbooks, in Zips)"),
+    ("pages/2_CFM_processing_and_recap.py", "CFM processing + recap",
+     "Processes multiple Raspi files and returns a Zip with the processed files and a recap Excel file containing mean and max CO2, mean Vdot and mean dp1"),
+    ("pages/3_CFM_live.py", "CFM live",
+     "Follows a recording while the RaPi and the gas analysers are writing it"),
+    ("pages/4_Détourage.py", "Détourage",
+     "Removes the background of pictures (AI), with manual retouching and batch mode"),
+]
+
 st.set_page_config(page_title="CFM data Menu")
 st.title("CFM data Menu")
-st.write("Select an app to launch :")
-
-# Crée deux colonnes pour organiser les apps
-col1, col2, col3 = st.columns(3)
-with col1:
-    st.subheader("App 1 (Original)")
-    st.write("This app processes unique Raspi files and returns the processed files")
-    if st.button("Open App 1"):
-        js = "window.open('https://cfmdataprocessingst-dupsgjztrwwvcedwrivyeb.streamlit.app/')"
-        st.components.v1.html(f"<script>{js}</script>")
-with col2:
-    st.subheader("App 2")
-    st.write("This app processes multiple Raspi files and returns a Zip with the processed files")
-    if st.button("Open App 2"):
-        js = "window.open('https://app-app-cfm-hnm3xzambasqhe8wmustbo.streamlit.app/')"
-        st.components.v1.html(f"<script>{js}</script>")
+st.write("Select an app in the sidebar :")
 
-with col3:
-    st.subheader("App 3")
-    st.write("This app processes multiple Raspi files and returns a Zip with the processed files and a recap Excel file containing mean and max CO2, mean Vdot and mean dp1")
-    if st.button("Open App 3"):
-        js = "window.open('https://app2-app-cfm-jujxzt5sesafcn38bzubtr.streamlit.app/')"
-        st.components.v1.html(f"<script>{js}</script>")
+# Crée une colonne par app
+for col, (page, label, description) in zip(st.columns(len(PAGES)), PAGES):
+    with col:
+        st.subheader(label)
+        st.write(description)
+        if hasattr(st, "page_link"): # streamlit >= 1.31
+            st.page_link(page, label=f"Open {label}")
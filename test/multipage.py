@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Multipage server: `streamlit run menu.py` serves the menu and, in pages/, one page per app. Each page runs the
+standalone app script in the server process, so pandas / rembg are imported once for all apps and the
+st.cache_resource caches (result cache, history store, rembg sessions) are shared instead of one per deployment.
+The apps still run on their own (`streamlit run app.py`).
+"""
+
+import os
+import sys
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+
+_compiled = {} # path -> (mtime, code): a rerun does not recompile the app script
+
+
+def run_app(path):
+    """Run an app script as the current page (same globals as `streamlit run path`)."""
+    directory = os.path.dirname(path)
+    if directory not in sys.path:
+        sys.path.insert(0, directory) # modules next to the script (detourage_core next to détourage.py)
+    mtime = os.path.getmtime(path)
+    if path not in _compiled or _compiled[path][0] != mtime:
+        with open(path, encoding="utf-8") as f:
+            _compiled[path] = (mtime, compile(f.read(), path, "exec"))
+    exec(_compiled[path][1], {"__name__": "__main__", "__file__": path})
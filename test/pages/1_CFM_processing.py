@@ -0,0 +1,5 @@
+# One or more RaPi files -> "RaPi only" and extended workbooks in ZIPs (standalone: streamlit run app.py)
+import os
+from multipage import run_app, TEST_DIR
+
+run_app(os.path.join(TEST_DIR, "app.py"))
@@ -0,0 +1,5 @@
+# RaPi files -> extended workbooks, global recap and history of processed runs (standalone: streamlit run app2.py)
+import os
+from multipage import run_app, TEST_DIR
+
+run_app(os.path.join(TEST_DIR, "app2.py"))
@@ -0,0 +1,5 @@
+# Running statistics of a recording being written (standalone: streamlit run live.py)
+import os
+from multipage import run_app, TEST_DIR
+
+run_app(os.path.join(TEST_DIR, "live.py"))
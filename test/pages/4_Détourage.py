@@ -0,0 +1,5 @@
+# Background removal tool (standalone: streamlit run détourage.py from the repository root)
+import os
+from multipage import run_app, ROOT_DIR
+
+run_app(os.path.join(ROOT_DIR, "détourage.py"))
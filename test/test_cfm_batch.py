@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Tests of the CFM batch runner. Run from test/: python -m pytest -q"""
+
+from io import BytesIO
+
+import pandas as pd
+
+from cfm_batch import run_batch, PROFILE_APP, PROFILE_APP2
+from cfm_core import GasAnalyserLog, read_gasAnalyser_log
+from test_cfm_core import raspi_csv, gas_log_txt
+
+
+def gm_log(channel, seed):
+    return GasAnalyserLog(read_gasAnalyser_log(BytesIO(gas_log_txt(9 * 3600, 7200, seed)), channel))
+
+
+def co2_stats(results):
+    return {i: result["df_GM_stats"] for i, result, error in results}
+
+
+def test_inline_sessions_keep_their_own_logs():
+    # two sessions iterate their batches in turn in the same server process (one worker: inline path)
+    files = [("a.csv", raspi_csv(200, seed=1)), ("b.csv", raspi_csv(200, seed=2))]
+    profile = {**PROFILE_APP, "raw_export": "summary"}
+    logs_A, logs_B = (gm_log("CR", 1), gm_log("GR", 2)), (gm_log("CR", 3), gm_log("GR", 4))
+    ref_A = co2_stats(run_batch(files, *logs_A, profile, max_workers=1))
+    ref_B = co2_stats(run_batch(files, *logs_B, profile, max_workers=1))
+    batch_A, batch_B = run_batch(files, *logs_A, profile, max_workers=1), run_batch(files, *logs_B, profile, max_workers=1)
+    results_A, results_B = [], []
+    for _ in files:
+        results_A.append(next(batch_A))
+        results_B.append(next(batch_B))
+    for results, ref in ((results_A, ref_A), (results_B, ref_B)):
+        assert all(error is None for _, _, error in results)
+        for i, df in co2_stats(results).items():
+            pd.testing.assert_frame_equal(df, ref[i], check_exact=True)
+    assert not ref_A[0].equals(ref_B[0])
+
+
+def test_recap_row_with_fewer_sensors_than_dp1():
+    # the recap reads dp1 at row 32 of p_mean: a shorter file gets NaN, not a failed file
+    files = [("a.csv", raspi_csv(200))]
+    [(i, result, error)] = run_batch(files, None, gm_log("GR", 1), {**PROFILE_APP2, "raw_export": "summary"}, max_workers=1)
+    assert error is None and result["extended"] is not None
+    assert pd.isna(result["recap"]["dp1"]) and result["recap"]["CO2 Mean"] == result["df_GM_stats"].iloc[0, 0]
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the CFM processing core against the original app code (python-engine parse, per-sample loops).
+Run from test/: python -m pytest -q
+"""
+
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cfm_core import (RASPI_META_ROWS, load_raspi_csv, calc_mean_pressures, calc_Vdots_out, parse_time_seconds,
+                      read_gasAnalyser_log, GasAnalyserLog, extract_gasAnalyser_section, calc_gasAnalyser_stats,
+                      detect_pulses, gm_signal_to_Vdot, calc_raspi_stream, STATS_BLOCK_ROWS)
+
+SENSORS = ["p1", "p2", "p10", "dp1", "dp2", "gm_ZR", "gm_ZL"]
+
+
+def clock(t):
+    # seconds (may pass midnight) -> "HH:MM:SS.fff" time of day
+    t = t % 86400
+    return f"{int(t // 3600):02d}:{int(t % 3600 // 60):02d}:{t % 60:06.3f}"
+
+
+def raspi_csv(n_rows=50, meta_rows=None, trailing_header=False, trailing_rows=False, seed=0, start_s=9 * 3600 + 55 * 60, dt=0.1):
+    """Synthetic RaPi export (bytes): header, metadata block, n_rows timestamped rows from start_s every dt seconds."""
+    rng = np.random.default_rng(seed)
+    n = len(SENSORS)
+    meta_rows = meta_rows or {
+        "sensor number": np.arange(n),
+        "sensor range": np.full(n, 10),
+        "sensor height": rng.uniform(0, 5, n).round(3),
+        "calibration correction mbar": rng.normal(0, 0.05, n).round(5),
+    }
+    end_header = "," if trailing_header else ""
+    end_row = "," if trailing_rows else ""
+    lines = ["Time," + ",".join(SENSORS) + end_header]
+    lines += [f"{name}," + ",".join(str(v) for v in values) + end_row for name, values in meta_rows.items()]
+    values = rng.normal(1013, 2, (n_rows, n)).round(5)
+    values[:, -2:] = (np.arange(n_rows)[:, None] // 7 % 2) * 200 # gas meter pulses
+    for i, row in enumerate(values):
+        lines.append(f"18.02.2025 {clock(start_s + i * dt)}," + ",".join(f"{v:.5f}" for v in row) + end_row)
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def parse_python(data, meta_names=RASPI_META_ROWS):
+    """Original parse of the apps: whole file with engine='python', metadata rows pulled out by label."""
+    df_raw = pd.read_csv(BytesIO(data), sep=",", header=0, index_col=0, engine="python")
+    return df_raw.loc[list(meta_names)], df_raw.drop(labels=list(meta_names), axis=0)
+
+
+def calc_mean_pressures_python(data):
+    """calc_mean_pressures of the original apps."""
+    df_raw = pd.read_csv(BytesIO(data), sep=",", header=0, index_col=0, engine="python")
+    calib_corr_df = df_raw.loc["calibration correction mbar"]
+    sensor_heights_df = df_raw.loc["sensor height"]
+    df_data_raspi = df_raw.drop(labels=RASPI_META_ROWS, axis=0)
+    p_mean = df_data_raspi.mean().to_frame()
+    p_std = df_data_raspi.std().to_frame()
+    p_mean_not_corr = (df_data_raspi.mean() + calib_corr_df).to_frame()
+    df_out = pd.merge(sensor_heights_df, p_mean, left_index=True, right_index=True)
+    df_out = pd.merge(df_out, p_std, left_index=True, right_index=True)
+    df_out = pd.merge(df_out, p_mean_not_corr, left_index=True, right_index=True)
+    df_out.columns = ["h/m", "p_mean/mbar", "p_std/mbar", "p_mean_not_corr/mbar"]
+    df_out["index"] = df_out.index
+    df_out = df_out.drop(["gm_ZR", "gm_ZL"])
+    df_out["sort1"] = df_out["index"].str.extract(r"([a-zA-Z]*)")
+    df_out["sort2"] = df_out["index"].str.extract(r"(\d+)", expand=False).astype(int)
+    df_out = df_out.sort_values(["sort1", "sort2"], ascending=[True, True])
+    return df_out.drop(labels=["index", "sort1", "sort2"], axis=1), df_data_raspi
+
+
+def assert_same_frames(df_meta, df_data, ref_meta, ref_data):
+    # the python engine infers int64 for integer-only columns, the loader reads float64
+    pd.testing.assert_frame_equal(df_meta, ref_meta.astype(np.float64), check_names=False)
+    pd.testing.assert_frame_equal(df_data, ref_data.astype(np.float64), check_index_type=False)
+
+
+# =========================
+# RaPi loader: metadata header and trailing columns
+# =========================
+
+def test_load_raspi_csv_matches_python_engine():
+    data = raspi_csv(500)
+    assert_same_frames(*load_raspi_csv(BytesIO(data)), *parse_python(data))
+
+
+def test_calc_mean_pressures_matches_original():
+    data = raspi_csv(500, seed=1)
+    df_p, df_data = calc_mean_pressures(BytesIO(data))
+    ref_p, ref_data = calc_mean_pressures_python(data)
+    pd.testing.assert_frame_equal(df_p, ref_p, check_names=False, rtol=1e-12)
+    assert list(df_p.index) == ["dp1", "dp2", "p1", "p2", "p10"]
+    pd.testing.assert_frame_equal(df_data, ref_data.astype(np.float64), check_index_type=False)
+
+
+def test_eight_row_metadata_block_in_any_order():
+    n = len(SENSORS)
+    meta_rows = {
+        "sensor height": np.linspace(0.5, 3.5, n),
+        "sensor offset": np.zeros(n),
+        "sensor number": np.arange(n),
+        "sensor gain": np.ones(n),
+        "calibration correction mbar": np.linspace(-0.1, 0.1, n),
+        "sensor range": np.full(n, 10),
+        "sensor serial": np.arange(100, 100 + n),
+        "sensor channel": np.arange(n),
+    }
+    data = raspi_csv(100, meta_rows=meta_rows)
+    df_meta, df_data = load_raspi_csv(BytesIO(data))
+    assert list(df_meta.index) == list(meta_rows) # the whole block before the first timestamp
+    ref_meta, ref_data = parse_python(data, meta_rows)
+    assert_same_frames(df_meta, df_data, ref_meta, ref_data)
+    assert len(df_data) == 100
+
+
+def test_trailing_comma_on_every_line():
+    # the python engine reads an empty "Unnamed: 8" column (all NaN)
+    data = raspi_csv(100, trailing_header=True, trailing_rows=True)
+    df_meta, df_data = load_raspi_csv(BytesIO(data))
+    assert df_data.columns[-1] == "Unnamed: 8" and df_data["Unnamed: 8"].isna().all()
+    assert_same_frames(df_meta, df_data, *parse_python(data))
+
+
+def test_trailing_comma_on_header_only():
+    data = raspi_csv(100, trailing_header=True)
+    assert_same_frames(*load_raspi_csv(BytesIO(data)), *parse_python(data))
+
+
+def test_trailing_comma_on_rows_only():
+    # the python engine shifts every column by one here; the loader drops the empty last field
+    data = raspi_csv(100, trailing_rows=True)
+    assert_same_frames(*load_raspi_csv(BytesIO(data)), *parse_python(raspi_csv(100)))
+
+
+def test_float32_body():
+    data = raspi_csv(100)
+    _, df_data = load_raspi_csv(BytesIO(data), dtype=np.float32)
+    _, ref_data = parse_python(data)
+    assert (df_data.dtypes == np.float32).all()
+    np.testing.assert_array_equal(df_data.to_numpy(), ref_data.to_numpy(dtype=np.float32))
+
+
+def test_missing_metadata_row():
+    data = raspi_csv(10).replace(b"sensor range", b"sensor rang")
+    with pytest.raises(ValueError, match="sensor range"):
+        load_raspi_csv(BytesIO(data))
+
+
+# =========================
+# Gas analyser window across midnight
+# =========================
+
+def gas_log_txt(start_s, n_rows, seed=0):
+    """Synthetic gas analyser log (bytes), one row per second from start_s."""
+    rng = np.random.default_rng(seed)
+    lines = ["Date\tTime\tCh1:Conce:Vol%\tCh2:Conce:ppm"]
+    for i in range(n_rows):
+        lines.append(f"18.02.2025\t{clock(start_s + i)[:8]}\t{rng.uniform(3, 5):.3f}\t{rng.uniform(380, 420):.1f}")
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def section_baseline(df_GM_raw, t_start_tot, t_end_tot):
+    """extract_gasAnalyser_section of the original apps: time of day, no unwrap."""
+    t = np.array([sum(a * b for a, b in zip([3600, 60, 1], map(float, s.split(":")))) for s in df_GM_raw["t"]])
+    return df_GM_raw[(t > t_start_tot) & (t < t_end_tot)]
+
+
+def test_parse_time_seconds_unwraps_midnight():
+    t = parse_time_seconds(["18.02.2025 23:59:59.5", "19.02.2025 00:00:00.25", "00:00:01"])
+    np.testing.assert_array_equal(t, [86399.5, 86400.25, 86401.0])
+
+
+def test_log_before_midnight_raspi_after():
+    # log 23:00 -> 02:00 (unwrapped to 82800..93600 s), RaPi file 00:30 -> 00:33:20 (1800..1999.9 s)
+    gm_log = GasAnalyserLog(read_gasAnalyser_log(BytesIO(gas_log_txt(23 * 3600, 3 * 3600)), "GR"))
+    df_data = load_raspi_csv(BytesIO(raspi_csv(2000, start_s=1800)))[1]
+    df_data, _, _ = calc_Vdots_out(df_data)
+    t_start_tot, t_end_tot = df_data.iloc[0]["t_tot"], df_data.iloc[-1]["t_tot"]
+    assert (t_start_tot, t_end_tot) == (1800.0, 1999.9)
+
+    ref = section_baseline(gm_log.df, t_start_tot, t_end_tot)
+    assert len(ref) == 199
+    section = extract_gasAnalyser_section(gm_log, t_start_tot, t_end_tot)
+    assert list(section["t"]) == list(ref["t"])
+    stats = calc_gasAnalyser_stats(gm_log, t_start_tot, t_end_tot)
+    np.testing.assert_allclose(stats, [ref["CO2"].mean(), ref["CO2"].std(), ref["CO2"].min(), ref["CO2"].max()], rtol=1e-12)
+
+
+def test_manual_window_across_midnight():
+    gm_log = GasAnalyserLog(read_gasAnalyser_log(BytesIO(gas_log_txt(23 * 3600, 3 * 3600)), "CR"))
+    t_start_tot, t_end_tot = parse_time_seconds(["23:59:00", "00:01:00"]) # end after midnight -> +24 h
+    assert len(extract_gasAnalyser_section(gm_log, t_start_tot, t_end_tot)) == 119
+    t_start_tot, t_end_tot = parse_time_seconds(["00:10:00", "00:11:00"]) # both after midnight
+    assert len(extract_gasAnalyser_section(gm_log, t_start_tot, t_end_tot)) == 59
+
+
+def test_window_same_day_not_shifted():
+    # RaPi file starting a little before the log: the window stays on the same day
+    gm_log = GasAnalyserLog(read_gasAnalyser_log(BytesIO(gas_log_txt(9 * 3600, 3600)), "GR"))
+    ref = section_baseline(gm_log.df, 8 * 3600 + 3000, 9 * 3600 + 100)
+    assert len(extract_gasAnalyser_section(gm_log, 8 * 3600 + 3000, 9 * 3600 + 100)) == len(ref) == 100
+    assert len(extract_gasAnalyser_section(gm_log, 3600, 7200)) == 0
+
+
+# =========================
+# Gas meter pulses and debounce
+# =========================
+
+def gm_signal_to_Vdot_baseline(time_array, signal_array):
+    """gm_signal_to_Vdot of the original apps (np.roll, > 30)."""
+    pulses = signal_array - np.roll(signal_array, 1)
+    pulse_times = time_array[np.where(pulses[1:] > 30)[0] + 1]
+    pulse_dts = pulse_times[1:] - pulse_times[:-1]
+    V_dots = 0.1 / pulse_dts * 3600
+    return V_dots, V_dots.mean(), V_dots.std(), V_dots.size, len(pulse_dts) * 0.1 / sum(pulse_dts) * 3600
+
+
+def test_gm_signal_to_Vdot_matches_original():
+    rng = np.random.default_rng(3)
+    time_array = np.cumsum(rng.uniform(0.05, 0.15, 5000))
+    signal = np.where(np.sin(np.arange(5000) / 17.0) > 0, 200.0, 0.0) + rng.normal(0, 1, 5000)
+    for a, b in zip(gm_signal_to_Vdot(time_array, signal), gm_signal_to_Vdot_baseline(time_array, signal)):
+        np.testing.assert_allclose(a, b, rtol=1e-12)
+
+
+def test_debounce_counts_from_last_kept_edge():
+    # rising edges at 0, 0.4, 0.8 and 1.2 s (bounces every 0.4 s): a debounce of 1 s keeps 0 and 1.2 s
+    signal = np.array([0, 100, 0, 100, 0, 100, 0, 100, 0], dtype=float)
+    time_array = np.array([-0.2, 0.0, 0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4])
+    assert detect_pulses(signal)[0].tolist() == [1, 3, 5, 7]
+    assert detect_pulses(signal, debounce_s=1.0, time_array=time_array)[0].tolist() == [1, 7]
+
+
+def test_debounce_needs_time_array():
+    with pytest.raises(ValueError, match="time_array"):
+        detect_pulses(np.array([0, 100, 0, 100.0]), debounce_s=1.0)
+
+
+def test_debounce_per_meter():
+    signals = np.array([[0, 0], [100, 0], [0, 100], [100, 0], [0, 100]], dtype=float)
+    time_array = np.arange(5) * 0.5
+    pulses = detect_pulses(signals, debounce_s=0.9, time_array=time_array)
+    assert [p.tolist() for p in pulses] == [[1, 3], [2, 4]]
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 2, 3, 4, 7, 1000])
+def test_edge_across_chunk_boundary(chunk_rows):
+    # rises from row 3 to row 4 and from row 7 to row 8: on a chunk boundary for several chunk_rows
+    signals = np.zeros((12, 2))
+    signals[4:7, 0] = 100
+    signals[8:, 0] = 100
+    signals[4:, 1] = 100
+    pulses = detect_pulses(signals, chunk_rows=chunk_rows, rearm=50)
+    assert [p.tolist() for p in pulses] == [[4, 8], [4]]
+
+
+# =========================
+# Streaming mode vs in-memory parity
+# =========================
+
+def assert_stream_matches(data, chunk_rows):
+    df_p, df_data = calc_mean_pressures(BytesIO(data))
+    df_data, df_Vdot_stats, df_V_dots = calc_Vdots_out(df_data)
+    s_p, s_Vdot_stats, s_V_dots, t_range = calc_raspi_stream(BytesIO(data), chunk_rows)
+    pd.testing.assert_frame_equal(s_p, df_p, check_exact=True)
+    pd.testing.assert_frame_equal(s_Vdot_stats, df_Vdot_stats, check_exact=True)
+    pd.testing.assert_frame_equal(s_V_dots, df_V_dots, check_exact=True)
+    assert t_range == (df_data["t_tot"].iloc[0], df_data["t_tot"].iloc[-1])
+
+
+@pytest.mark.parametrize("chunk_rows", [1, 7, 14, 97, 10_000])
+def test_stream_matches_in_memory(chunk_rows):
+    # row 97 is the first one after midnight (on a chunk boundary for 97 and 1);
+    # the gas meters rise every 14 rows (edges straddle the chunk boundaries for 1, 7 and 14)
+    data = raspi_csv(1000, start_s=86400 - 97 * 0.5, dt=0.5, seed=2)
+    assert_stream_matches(data, chunk_rows)
+
+
+@pytest.mark.parametrize("chunk_rows", [997, 3 * STATS_BLOCK_ROWS])
+def test_stream_matches_in_memory_over_several_stats_blocks(chunk_rows):
+    # more than two stats blocks: the rows of an unfinished block wait for the next chunk
+    assert_stream_matches(raspi_csv(2 * STATS_BLOCK_ROWS + 4321, seed=4), chunk_rows)
+
+
+def test_stream_without_data_rows():
+    data = raspi_csv(0)
+    with pytest.raises(ValueError, match="without data rows"):
+        calc_raspi_stream(BytesIO(data), 10)
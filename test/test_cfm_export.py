@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Tests of the CFM export helpers. Run from test/: python -m pytest -q"""
+
+import zipfile
+from io import BytesIO
+
+from cfm_export import ZipStream
+
+
+def zip_names(data):
+    return zipfile.ZipFile(BytesIO(data)).namelist()
+
+
+def test_zip_stream_keeps_upload_order():
+    zs = ZipStream()
+    # files finish in the order 2, 0, 3, 1; file 1 failed (no entry)
+    zs.add("c.xlsx", b"c", index=2)
+    zs.add("c.csv", b"c", index=2)
+    zs.done(2)
+    zs.add("a.xlsx", b"a", index=0)
+    zs.done(0)
+    zs.add("d.xlsx", b"d", index=3)
+    zs.done(3)
+    assert zs.names == ["a.xlsx"] and len(zs) == 4 # c and d wait for file 1
+    zs.done(1)
+    assert zs.names == ["a.xlsx", "c.xlsx", "c.csv", "d.xlsx"]
+    assert zip_names(zs.getvalue()) == ["a.xlsx", "c.xlsx", "c.csv", "d.xlsx"]
+
+
+def test_zip_stream_without_index_writes_at_once():
+    zs = ZipStream()
+    zs.add("b.xlsx", b"b")
+    zs.add("a.xlsx", b"a")
+    assert zip_names(zs.getvalue()) == ["b.xlsx", "a.xlsx"]
+
+
+def test_zip_stream_close_writes_unfinished_indexes():
+    zs = ZipStream()
+    zs.add("b.xlsx", b"b", index=1)
+    assert zip_names(zs.getvalue()) == ["b.xlsx"]
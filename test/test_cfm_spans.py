@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Tests of the stage spans. Run from test/: python -m pytest -q"""
+
+import os
+import threading
+import time
+import tracemalloc
+
+import cfm_spans
+from cfm_batch import run_batch, PROFILE_APP2
+from cfm_spans import recording, span
+from test_cfm_core import raspi_csv
+
+
+def test_span_leaves_a_shared_tracemalloc_alone():
+    # the server traces for someone else: a session span neither resets the peak nor reports one
+    assert not cfm_spans._traced
+    tracemalloc.start()
+    try:
+        big = bytearray(8 * 2**20)
+        del big
+        peak = tracemalloc.get_traced_memory()[1]
+        with recording(file="a.csv") as rec:
+            with span("parse"):
+                pass
+        assert tracemalloc.is_tracing() and tracemalloc.get_traced_memory()[1] >= peak
+        assert "peak_mb" not in rec.records[0]
+    finally:
+        tracemalloc.stop()
+
+
+def test_span_cpu_time_is_its_own_thread():
+    # another session busy in the same server process: not counted in this span
+    stop = threading.Event()
+    busy = threading.Thread(target=lambda: [None for _ in iter(stop.is_set, True)])
+    busy.start()
+    try:
+        with recording(file="a.csv") as rec:
+            with span("wait"):
+                time.sleep(0.3)
+    finally:
+        stop.set()
+        busy.join()
+    assert rec.records[0]["wall_s"] >= 0.3 and rec.records[0]["cpu_s"] < 0.05
+
+
+def test_run_batch_measures_peaks_in_a_worker_process():
+    files = [("a.csv", raspi_csv(200))]
+    [(i, result, error)] = run_batch(files, None, None, {**PROFILE_APP2, "raw_export": "summary"}, max_workers=1, trace_memory=True)
+    assert error is None
+    assert all("peak_mb" in record and record["pid"] != os.getpid() for record in result["spans"])
+    assert not tracemalloc.is_tracing()
+    [(i, result, error)] = run_batch(files, None, None, {**PROFILE_APP2, "raw_export": "summary"}, max_workers=1)
+    assert error is None and not any("peak_mb" in record for record in result["spans"])
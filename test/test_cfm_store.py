@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Tests of the CFM run history. Run from test/: python -m pytest -q"""
+
+import numpy as np
+import pandas as pd
+
+from cfm_store import ResultStore
+
+
+def run_frames(p_mean):
+    df_p = pd.DataFrame({"h_m": [0.0, 1.0], "p_mean": [p_mean, 2 * p_mean], "p_std": [0.1, 0.2], "p_mean_not_corr": [p_mean, 2 * p_mean]},
+                        index=["dp1", "dp2"])
+    df_Vdot_stats = pd.DataFrame({"ZR": [1.0, 0.1, 3.0, 1.0], "ZL": [2.0, 0.2, 3.0, 2.0]})
+    df_GM_stats = pd.DataFrame({"CO2_CR": [400.0, 5.0, 390.0, 410.0]})
+    return df_p, df_Vdot_stats, df_GM_stats
+
+
+def test_add_run_again_keeps_the_stored_run(tmp_path):
+    # a rerun of the app records its cached results again: same run, same processing time, same stats
+    store = ResultStore(str(tmp_path / "history.sqlite"))
+    run_id = store.add_run("a.csv", "h", "logs", (10.0, 20.0), *run_frames(1.0))
+    processed_at = store.query("SELECT processed_at FROM runs")["processed_at"].tolist()
+    assert store.add_run("a.csv", "h", "logs", (10.0, 20.0), *run_frames(1.0)) == run_id
+    assert store.query("SELECT processed_at FROM runs")["processed_at"].tolist() == processed_at
+    assert store.sensor_history([run_id]).loc[run_id].tolist() == [1.0, 2.0]
+    assert len(store.query("SELECT * FROM co2_stats")) == 1
+
+
+def test_add_run_with_other_stats_replaces_them(tmp_path):
+    store = ResultStore(str(tmp_path / "history.sqlite"))
+    run_id = store.add_run("a.csv", "h", "logs", (10.0, 20.0), *run_frames(1.0))
+    processed_at = store.query("SELECT processed_at FROM runs")["processed_at"].iloc[0]
+    df_p, df_Vdot_stats, _ = run_frames(5.0)
+    assert store.add_run("a.csv", "h", "logs", (10.0, 20.0), df_p, df_Vdot_stats) == run_id
+    assert store.query("SELECT processed_at FROM runs")["processed_at"].iloc[0] >= processed_at
+    assert store.sensor_history([run_id]).loc[run_id].tolist() == [5.0, 10.0]
+    assert len(store.query("SELECT * FROM co2_stats")) == 0
+
+
+def test_add_run_other_window_is_a_new_run(tmp_path):
+    store = ResultStore(str(tmp_path / "history.sqlite"))
+    run_a = store.add_run("a.csv", "h", "logs", (10.0, 20.0), *run_frames(1.0))
+    run_b = store.add_run("a.csv", "h", "logs", (np.nan, np.nan), *run_frames(3.0))
+    assert run_a != run_b
+    assert store.add_run("a.csv", "h", "logs", (np.nan, np.nan), *run_frames(4.0)) == run_b
+    assert len(store.runs()) == 2
+
+
+def test_cli_store_sees_a_log_edited_in_place(tmp_path):
+    from cfm_cli import main
+    from test_cfm_core import raspi_csv, gas_log_txt
+    (tmp_path / "a.csv").write_bytes(raspi_csv(200))
+    gr = tmp_path / "GR.txt"
+    recaps = []
+    for seed in (1, 2): # same path, new content
+        gr.write_bytes(gas_log_txt(9 * 3600, 7200, seed))
+        out = tmp_path / f"out{seed}"
+        main([str(tmp_path / "a.csv"), "--gm-gr", str(gr), "--profile", "app2", "--workers", "1", "--out", str(out),
+              "--store", str(tmp_path / "history.sqlite")])
+        recaps.append(pd.read_excel(out / "recapitulatif_global.xlsx"))
+    main([str(tmp_path / "a.csv"), "--gm-gr", str(gr), "--profile", "app2", "--workers", "1", "--out", str(tmp_path / "out_ref")])
+    ref = pd.read_excel(tmp_path / "out_ref" / "recapitulatif_global.xlsx")
+    assert recaps[0]["CO2 Mean"][0] != recaps[1]["CO2 Mean"][0]
+    assert recaps[1]["CO2 Mean"][0] == ref["CO2 Mean"][0]